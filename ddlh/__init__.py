@@ -61,8 +61,11 @@ def create_app() -> Flask:
     )
     app.config.from_prefixed_env()  # type:ignore
     app.config["airtable_instance"] = _get_airtable_instance()
+    app.config["documents_repository"] = repositories.get_repository_provider_instance(
+        app.config["airtable_instance"]
+    )
     app.config["rag_index"] = rag.get_rag_index_instance(
-        repositories.DocumentsRepository(app.config["airtable_instance"])
+        app.config["documents_repository"]
     )
     celery_init_app(app)
     app.jinja_env.add_extension(MarkdownExtension)
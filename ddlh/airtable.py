@@ -1,16 +1,38 @@
+import itertools
 import os
 from dataclasses import dataclass
-from time import sleep
-from typing import Optional, Sequence
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional, Sequence
 
-from pyairtable import Api
+import more_itertools as mit
+import requests
+from pyairtable import Api, Table
 from pyairtable.api.types import RecordDict
 
+from ddlh.rate_limiting import RedisTokenBucket
 from ddlh.redis_cache import RedisCache, create_cache
 
 # Maximum 5 requests per second per base:
 # see https://airtable.com/developers/web/api/rate-limits
-REQUEST_TIMEOUT = 1 / 5.0
+REQUESTS_PER_SECOND = 5.0
+
+# The rate limiter holds a single token, refilled often enough that it and
+# a second of refills together stay within the limit, so no one second ever
+# sees more requests than that, even after being idle.
+RATE_LIMITER_CAPACITY = 1
+
+# Airtable asks clients to wait 30 seconds after being rate limited,
+# we back off exponentially up to that unless told otherwise.
+MAX_BACKOFF = 30.0
+MAX_RETRIES = 5
+
+# Incremental syncs fetch records modified since slightly before the previous
+# sync started, so that records modified during it, or skew between our clock
+# and airtable's, can't cause changes to be missed.
+SYNC_WATERMARK_MARGIN = timedelta(minutes=1)
+
+# Records fetched by id are looked up with a formula, which we keep short
+MAX_IDS_PER_REQUEST = 50
 
 
 @dataclass
@@ -19,13 +41,64 @@ class AirtableConfig:
     base_id: str
     table_ids: dict[str, str]
     view_ids: dict[str, str]
+    full_sync_interval: Optional[int] = None
+
+
+class RateLimitedApi(Api):
+    """
+    An Airtable API client which takes a token from a shared rate limiter
+    before every request (including each page of paginated requests), and
+    makes every client sharing the limiter back off when rate limited.
+    """
+
+    def __init__(self, api_key: str, rate_limiter: RedisTokenBucket):
+        super().__init__(api_key, retry_strategy=None)
+        self.rate_limiter = rate_limiter
+
+    def request(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                return super().request(method, url, *args, **kwargs)
+            except requests.HTTPError as e:
+                if not _is_rate_limited(e) or attempt >= MAX_RETRIES:
+                    raise
+                self.rate_limiter.penalize(_backoff(e, attempt))
+                attempt += 1
+
+
+def _is_rate_limited(error: requests.HTTPError) -> bool:
+    return error.response is not None and error.response.status_code == 429
+
+
+def _backoff(error: requests.HTTPError, attempt: int) -> float:
+    retry_after = error.response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return float(min(MAX_BACKOFF, 2**attempt))
 
 
 class AirtableDB:
-    def __init__(self, config: AirtableConfig, cache: RedisCache):
+    def __init__(
+        self,
+        config: AirtableConfig,
+        cache: RedisCache,
+        rate_limiter: Optional[RedisTokenBucket] = None,
+    ):
         self.config = config
         self.cache = cache
-        self.api = Api(config.token)
+        if rate_limiter is None:
+            rate_limiter = RedisTokenBucket(
+                cache.redis,
+                cache.key("rate_limit", [config.base_id]),
+                rate=REQUESTS_PER_SECOND - RATE_LIMITER_CAPACITY,
+                capacity=RATE_LIMITER_CAPACITY,
+            )
+        self.api = RateLimitedApi(config.token, rate_limiter)
 
     def all(self, table_name: str) -> Sequence[RecordDict]:
         return self.cache.cached("all", [table_name], self._uncached_all)
@@ -33,22 +106,87 @@ class AirtableDB:
     def get(self, table_name: str, id: str) -> Optional[RecordDict]:
         return self.cache.cached("get", [table_name, id], self._uncached_get)
 
+    def get_many(
+        self, table_name: str, ids: Sequence[str]
+    ) -> list[Optional[RecordDict]]:
+        return self.cache.cached_many(
+            "get",
+            [[table_name, id] for id in ids],
+            self._uncached_get,
+            batch_func=self._uncached_get_many,
+        )
+
     def _uncached_all(self, table_name: str) -> Sequence[RecordDict]:
-        table_id = self._table_id(table_name)
-        if table_id:
-            result = self.api.table(self.config.base_id, table_id).all(
-                view=self._view_id(table_name)
-            )
-            sleep(REQUEST_TIMEOUT)
-            return result
-        return []
+        table = self._table(table_name)
+        if table is None:
+            return []
+        view_id = self._view_id(table_name)
+        if self.config.full_sync_interval is None or view_id is not None:
+            return table.all(view=view_id)
+        return self._synced_all(table_name, table)
+
+    def _synced_all(self, table_name: str, table: Table) -> list[RecordDict]:
+        """
+        Incrementally sync tables, by merging records created or modified since
+        the last sync into the records we already have.
+
+        Airtable can't tell us which records have been deleted, so we fall back
+        to fetching the whole table every `full_sync_interval` seconds. Tables
+        read through a view are always fetched in full, as records leaving the
+        view don't show up as modified, and the view also defines their order.
+        """
+        started_at = datetime.now(timezone.utc)
+        state = self.cache.get_if_cached("sync", [table_name])
+        if state is None or self._full_sync_due(state, started_at):
+            records = table.all()
+            full_sync_at = _format_timestamp(started_at)
+        else:
+            records_by_id = {record["id"]: record for record in state["records"]}
+            for record in table.all(formula=_modified_since(state["watermark"])):
+                records_by_id[record["id"]] = record
+            records = list(records_by_id.values())
+            full_sync_at = state["full_sync_at"]
+        self.cache.store(
+            "sync",
+            [table_name],
+            {
+                "watermark": _format_timestamp(started_at - SYNC_WATERMARK_MARGIN),
+                "full_sync_at": full_sync_at,
+                "records": records,
+            },
+            expire=False,
+        )
+        return records
+
+    def _full_sync_due(self, state: dict[str, Any], now: datetime) -> bool:
+        interval = timedelta(seconds=self.config.full_sync_interval or 0)
+        return now - _parse_timestamp(state["full_sync_at"]) > interval
 
     def _uncached_get(self, table_name: str, id: str) -> Optional[RecordDict]:
+        table = self._table(table_name)
+        if table is not None:
+            return table.get(id)
+        return None
+
+    def _uncached_get_many(
+        self, args_list: list[list[str]]
+    ) -> list[Optional[RecordDict]]:
+        records: dict[tuple[str, str], RecordDict] = {}
+        for table_name, ids in itertools.groupby(
+            sorted(args_list), key=lambda args: args[0]
+        ):
+            table = self._table(table_name)
+            if table is None:
+                continue
+            for chunk in mit.chunked([id for (_table, id) in ids], MAX_IDS_PER_REQUEST):
+                for record in table.all(formula=_record_id_in(chunk)):
+                    records[(table_name, record["id"])] = record
+        return [records.get((table_name, id)) for (table_name, id) in args_list]
+
+    def _table(self, table_name: str) -> Optional[Table]:
         table_id = self._table_id(table_name)
         if table_id:
-            result = self.api.table(self.config.base_id, table_id).get(id)
-            sleep(REQUEST_TIMEOUT)
-            return result
+            return self.api.table(self.config.base_id, table_id)
         return None
 
     def _table_id(self, table_name: str) -> Optional[str]:
@@ -58,6 +196,24 @@ class AirtableDB:
         return self.config.view_ids.get(table_name)
 
 
+def _format_timestamp(timestamp: datetime) -> str:
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def _parse_timestamp(timestamp: str) -> datetime:
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ").replace(
+        tzinfo=timezone.utc
+    )
+
+
+def _record_id_in(ids: list[str]) -> str:
+    return "OR(" + ", ".join(f"RECORD_ID()='{id}'" for id in ids) + ")"
+
+
+def _modified_since(timestamp: str) -> str:
+    return f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{timestamp}'))"
+
+
 def get_db_instance() -> AirtableDB:
     airtable_config = AirtableConfig(
         token=os.environ["AIRTABLE_TOKEN"],
@@ -74,14 +230,25 @@ def get_db_instance() -> AirtableDB:
         },
     )
 
+    if "AIRTABLE_FULL_SYNC_INTERVAL" in os.environ:
+        airtable_config.full_sync_interval = int(
+            os.environ["AIRTABLE_FULL_SYNC_INTERVAL"]
+        )
+
     if "REDIS_DOCUMENT_CACHE_TIMEOUT" in os.environ:
         timeout = int(os.environ["REDIS_DOCUMENT_CACHE_TIMEOUT"])
     else:
         timeout = None
 
+    if "REDIS_DOCUMENT_CACHE_STALE_TIMEOUT" in os.environ:
+        stale_timeout = int(os.environ["REDIS_DOCUMENT_CACHE_STALE_TIMEOUT"])
+    else:
+        stale_timeout = None
+
     cache = create_cache(
         prefix=os.environ["REDIS_DOCUMENT_CACHE_PREFIX"],
         timeout=timeout,
+        stale_timeout=stale_timeout,
     )
 
     return AirtableDB(airtable_config, cache)
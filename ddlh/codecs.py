@@ -0,0 +1,115 @@
+import json
+import zlib
+from typing import Any, Callable, NamedTuple
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+# Encoded values start with a NUL byte, which JSON text never does, followed
+# by one byte naming their codec and one naming their compression. Values
+# without this header are JSON, as written before codecs were introduced.
+HEADER_MARKER = b"\x00"
+HEADER_LENGTH = 3
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec(NamedTuple):
+    tag: bytes
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes], Any]
+
+
+class Compression(NamedTuple):
+    tag: bytes
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+CODECS: dict[str, Codec] = {
+    "json": Codec(
+        b"j",
+        lambda value: json.dumps(value, separators=(",", ":")).encode("UTF-8"),
+        json.loads,
+    ),
+}
+
+if msgpack is not None:
+    CODECS["msgpack"] = Codec(
+        b"m",
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+
+COMPRESSIONS: dict[str, Compression] = {
+    "none": Compression(b"n", lambda data: data, lambda data: data),
+    "zlib": Compression(b"z", zlib.compress, zlib.decompress),
+}
+
+if zstandard is not None:
+    COMPRESSIONS["zstd"] = Compression(
+        b"s",
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+CODECS_BY_TAG = {codec.tag: codec for codec in CODECS.values()}
+COMPRESSIONS_BY_TAG = {
+    compression.tag: compression for compression in COMPRESSIONS.values()
+}
+
+
+class ValueCodec:
+    """
+    Encodes values with the named codec, compressing them when their encoded
+    size is at least `compression_threshold` bytes. Every value is tagged
+    with how it was encoded, so values can still be decoded after the
+    configuration changes.
+    """
+
+    def __init__(
+        self,
+        codec: str = "json",
+        compression: str = "none",
+        compression_threshold: int = 1024,
+    ):
+        if codec not in CODECS:
+            raise CodecError(f"Unknown or unavailable codec {codec}")
+        if compression not in COMPRESSIONS:
+            raise CodecError(f"Unknown or unavailable compression {compression}")
+        self.codec = CODECS[codec]
+        self.compression = COMPRESSIONS[compression]
+        self.compression_threshold = compression_threshold
+
+    def encode(self, value: Any) -> bytes:
+        data = self.codec.dumps(value)
+        compression = self.compression
+        if len(data) < self.compression_threshold:
+            compression = COMPRESSIONS["none"]
+        return (
+            HEADER_MARKER
+            + self.codec.tag
+            + compression.tag
+            + compression.compress(data)
+        )
+
+    def decode(self, data: bytes) -> Any:
+        if not data.startswith(HEADER_MARKER):
+            return json.loads(data)
+        codec = CODECS_BY_TAG.get(data[1:2])
+        compression = COMPRESSIONS_BY_TAG.get(data[2:3])
+        if codec is None or compression is None:
+            raise CodecError("Value encoded with an unknown or unavailable codec")
+        try:
+            return codec.loads(compression.decompress(data[HEADER_LENGTH:]))
+        except Exception as e:
+            raise CodecError("Corrupt encoded value") from e
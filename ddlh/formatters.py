@@ -1,23 +1,39 @@
+from typing import Any, Optional
+
 from flask import current_app as app
 from flask import render_template
 
-from ddlh.models import SearchResult
-from ddlh.repositories import DocumentsRepository
-from ddlh.utils import downcase_first
+from ddlh.models import DocumentSummary, SearchResult
+from ddlh.utils import compact, downcase_first
+
+
+def _document_summary_context(
+    document_summary: DocumentSummary,
+) -> Optional[dict[str, Any]]:
+    repository = app.config["documents_repository"].get()
+    document = repository.get_document(document_summary.document)
+    if document is None:
+        return None
+    return {
+        "document": document,
+        "summary": downcase_first(document_summary.summary),
+    }
+
+
+def format_document_summary(document_summary: DocumentSummary) -> Optional[str]:
+    summary = _document_summary_context(document_summary)
+    if summary is None:
+        return None
+    return render_template("partials/search_result_summary.j2", summary=summary)
 
 
 def format_search_result(result: SearchResult) -> str:
-    document_summaries = []
-    repository = DocumentsRepository(app.config["airtable_instance"])
-    for document_summary in result.summary.document_summaries:
-        document = repository.get_document(document_summary.document)
-        if document:
-            document_summaries.append(
-                {
-                    "document": document,
-                    "summary": downcase_first(document_summary.summary),
-                }
-            )
+    document_summaries = compact(
+        [
+            _document_summary_context(document_summary)
+            for document_summary in result.summary.document_summaries
+        ]
+    )
     return render_template(
         "partials/search_summary.j2",
         query=result.query,
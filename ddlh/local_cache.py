@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, NamedTuple, Optional
+
+
+class LocalCacheEntry(NamedTuple):
+    value: Any
+    size: int
+    expires_at: Optional[float]
+
+
+class LocalCache:
+    """
+    A bounded, in-process LRU cache of already deserialized values.
+
+    Entries are evicted least recently used first once the total of their
+    sizes (as given by the caller, usually the length of their serialized
+    form) goes over `max_bytes`, and expire after `ttl` seconds.
+
+    Values are shared between callers, so must not be modified.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.generation = 0
+        self._entries: OrderedDict[str, LocalCacheEntry] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at is not None and entry.expires_at < monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def set(
+        self, key: str, value: Any, size: int, generation: Optional[int] = None
+    ) -> None:
+        """
+        Store a value. When given the generation read before fetching the
+        value, the value is dropped if anything was invalidated since, as
+        it might be out of date already.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            expires_at = monotonic() + self.ttl if self.ttl is not None else None
+            self._entries[key] = LocalCacheEntry(value, size, expires_at)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self.generation += 1
+            self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
@@ -3,6 +3,7 @@ from __future__ import annotations
 import traceback
 import warnings
 from dataclasses import asdict, dataclass, fields
+from functools import cached_property
 from typing import TYPE_CHECKING, Any, NewType, Optional, TypeVar, cast
 
 from ddlh.utils import compact, url_to_id
@@ -78,7 +79,7 @@ class Document(Model):
     invisible_link: Optional[str]
     invisible_text: Optional[str]
 
-    @property
+    @cached_property
     def id(self) -> str:
         return url_to_id(self.link)
 
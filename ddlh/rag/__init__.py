@@ -1,9 +1,9 @@
 import re
 from collections import defaultdict
+from hashlib import sha256
 from os import environ
-from typing import List, Optional, TypedDict
+from typing import Callable, Collection, List, Optional, TypedDict
 
-from ddlh import airtable
 from ddlh.models import (
     Document,
     DocumentSummary,
@@ -11,14 +11,21 @@ from ddlh.models import (
     SearchResult,
     Summary,
 )
+from ddlh.rag.embeddings import normalize_text
 from ddlh.rag.llamaindex import (
     GenerationResult,
     LlamaIndex,
     RetrievalResult,
     get_llamaindex_instance,
 )
+from ddlh.rag.related import RelatedDocuments
+from ddlh.rag.semantic_cache import SemanticQueryCache
+from ddlh.rag.summarization import BatchedSummarizer, ConcurrentSummarizer
 from ddlh.redis_cache import RedisCache, create_cache
-from ddlh.repositories import DocumentsRepository
+from ddlh.repositories import (
+    DocumentsRepositoryProvider,
+    get_repository_provider_instance,
+)
 from ddlh.utils import compact
 
 DOCUMENT_SUMMARY_PROMPT: str = """
@@ -32,6 +39,47 @@ TOP_SENTENCE_PROMPT: str = """
  based on the information given.[/INST] {query}</s>
 """
 
+BATCHED_SUMMARY_PROMPT: str = """
+<s>[INST]Below are excerpts from numbered documents. For each document, decide
+ whether it contains information about the theme of \"{query}\", and if it does,
+ explain in one sentence starting with \"This document\" how it relates to the
+ theme of \"{query}\". Then provide a one or two sentence description of
+ \"{query}\" based on the information given.
+ Answer with a JSON object of the form {{"documents": [{{"number": 1,
+ "relevant": true, "summary": "This document ..."}}], "top_sentence": "..."}},
+ listing every document.
+
+{context}[/INST]</s>
+"""
+
+# How many related documents are precomputed for each document.
+RELATED_DOCUMENTS_LIMIT = 10
+
+# How many document summaries are generated at once, and how long to wait for
+# each of them before moving on without it.
+SUMMARY_CONCURRENCY = 4
+SUMMARY_TIMEOUT = 60
+
+# How similar the embeddings of two queries must be for the summary of one
+# to be served for the other.
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# How many of the most recently answered queries the semantic cache keeps.
+SEMANTIC_CACHE_MAX_QUERIES = 1000
+
+# Summarization modes: "per_document" asks for each document summary and the
+# top sentence separately, "batched" asks for all of them in one call.
+SUMMARIZATION_MODES = ("per_document", "batched")
+
+# How many tokens of document excerpts are sent in batched mode.
+SUMMARY_CONTEXT_TOKENS = 8000
+
+# Generating a summary takes several LLM calls, so concurrent queries for the
+# same text wait this long for the first one to finish before running their own.
+QUERY_LOCK_TIMEOUT = 300
+
+DocumentSummaryCallback = Callable[[DocumentSummary], None]
+
 DocumentResult = TypedDict(
     "DocumentResult",
     {
@@ -46,14 +94,26 @@ class RAGIndex:
     def __init__(
         self,
         llamaindex: LlamaIndex,
-        document_repository: DocumentsRepository,
+        document_repository: DocumentsRepositoryProvider,
         cache: RedisCache,
         max_document_summaries: int,
+        related_documents: Optional[RelatedDocuments] = None,
+        summarizer: Optional[
+            ConcurrentSummarizer[DocumentResult, GenerationResult]
+        ] = None,
+        semantic_cache: Optional[SemanticQueryCache] = None,
+        batched_summarizer: Optional[BatchedSummarizer] = None,
     ):
         self.llamaindex = llamaindex
         self.document_repository = document_repository
         self.cache = cache
         self.max_document_summaries = max_document_summaries
+        self.related_documents = related_documents
+        self.summarizer = summarizer or ConcurrentSummarizer(
+            SUMMARY_CONCURRENCY, SUMMARY_TIMEOUT
+        )
+        self.semantic_cache = semantic_cache
+        self.batched_summarizer = batched_summarizer
 
     def _collate_and_rerank_by_document_ids(
         self,
@@ -62,9 +122,10 @@ class RAGIndex:
         scores: dict[str, float] = defaultdict(float)
         counter: dict[str, int] = defaultdict(int)
         results_by_doc_id: dict[str, List[RetrievalResult]] = defaultdict(list)
+        repository = self.document_repository.get()
         for result in results:
             doc_id = self.llamaindex.get_document_id_for_result(result)
-            if doc_id:
+            if doc_id and repository.has_document(doc_id):
                 counter[doc_id] += 1
                 scores[doc_id] = (
                     scores[doc_id] * (counter[doc_id] - 1) / counter[doc_id]
@@ -84,21 +145,92 @@ class RAGIndex:
         ]
 
     def _generate_document_summaries(
-        self, sorted_docs: List[DocumentResult], query: str
+        self,
+        sorted_docs: List[DocumentResult],
+        query: str,
+        on_document_summary: Optional[DocumentSummaryCallback] = None,
     ) -> List[tuple[DocumentResult, GenerationResult]]:
-        responses: list[tuple[DocumentResult, GenerationResult]] = []
-        for doc in sorted_docs:
-            if len(responses) > self.max_document_summaries - 1:
-                break
-            response = self.llamaindex.synthesize(
+        def summarize(doc: DocumentResult) -> GenerationResult:
+            return self._summarize_document(doc, query)
+
+        def is_relevant(response: GenerationResult) -> bool:
+            return bool(response.response) and not re.search(
+                "(not |ir)relevant", response.response or ""
+            )
+
+        def on_relevant(doc: DocumentResult, response: GenerationResult) -> None:
+            document_summary = self._make_document_summary(doc, response)
+            if on_document_summary is not None and document_summary is not None:
+                on_document_summary(document_summary)
+
+        return self.summarizer.first_relevant(
+            sorted_docs,
+            summarize,
+            is_relevant,
+            self.max_document_summaries,
+            on_relevant,
+        )
+
+    def _summarize_document(self, doc: DocumentResult, query: str) -> GenerationResult:
+        """
+        Summarize a document for a query. Summaries are cached by normalized
+        query, document and retrieved chunks, so that they are reused by
+        other queries ranking the same document, and by retries.
+        """
+        query_hash = sha256(normalize_text(query).encode("UTF-8")).hexdigest()
+        chunks_hash = sha256(
+            "\n".join(
+                sorted(
+                    f"{result.node.node_id}:{result.node.hash}"
+                    for result in doc["results"]
+                )
+            ).encode("UTF-8")
+        ).hexdigest()
+        return self.cache.cached(
+            "document_summary",
+            [query_hash, doc["doc_id"], chunks_hash],
+            lambda *_args: self.llamaindex.synthesize(
                 DOCUMENT_SUMMARY_PROMPT.format(query=query),
                 nodes=doc["results"],
-            )
-            if response.response and not re.search(
-                "(not |ir)relevant", response.response
-            ):
-                responses.append((doc, response))
-        return responses
+            ),
+            serializer=lambda response: {"response": response.response},
+            deserializer=lambda attrs: GenerationResult(attrs["response"]),
+        )
+
+    def _generate_batched_summary(
+        self,
+        sorted_docs: List[DocumentResult],
+        query: str,
+        on_document_summary: Optional[DocumentSummaryCallback] = None,
+    ) -> Optional[Summary]:
+        """
+        Generate the whole summary with a single LLM call, when in batched
+        mode. Returns None when the LLM's answer can't be used, in which case
+        the summary is generated one document at a time instead.
+        """
+        if self.batched_summarizer is None:
+            return None
+        batched_summary = self.batched_summarizer.summarize(
+            BATCHED_SUMMARY_PROMPT,
+            query,
+            [
+                [result.node.get_content() for result in doc["results"]]
+                for doc in sorted_docs
+            ],
+        )
+        if batched_summary is None:
+            return None
+        responses = [
+            (sorted_docs[index], GenerationResult(summary))
+            for (index, summary) in batched_summary.summaries
+        ][0 : self.max_document_summaries]
+        summary = self._make_summary(
+            GenerationResult(batched_summary.top_sentence), responses
+        )
+        if on_document_summary is not None:
+            for document_summary in summary.document_summaries:
+                on_document_summary(document_summary)
+        return summary
 
     def _generate_top_sentence(
         self, responses: list[tuple[DocumentResult, GenerationResult]], query: str
@@ -120,28 +252,44 @@ class RAGIndex:
         top_sentence: GenerationResult,
         responses: list[tuple[DocumentResult, GenerationResult]],
     ) -> Summary:
-        document_summaries = []
-        for document, response in responses:
-            if response.response:
-                summary = re.sub(
-                    "^th(e|is) document", "", response.response, flags=re.IGNORECASE
-                )
-                document_summaries.append(
-                    DocumentSummary(document=document["doc_id"], summary=summary)
-                )
+        document_summaries = compact(
+            [
+                self._make_document_summary(document, response)
+                for document, response in responses
+            ]
+        )
         return Summary(
             top_sentence=top_sentence.response or "",
             document_summaries=document_summaries,
         )
 
+    def _make_document_summary(
+        self, document: DocumentResult, response: GenerationResult
+    ) -> Optional[DocumentSummary]:
+        if not response.response:
+            return None
+        summary = re.sub(
+            "^th(e|is) document", "", response.response, flags=re.IGNORECASE
+        )
+        return DocumentSummary(document=document["doc_id"], summary=summary)
+
     def _uncached_query(
         self,
         query: str,
+        on_document_summary: Optional[DocumentSummaryCallback] = None,
     ) -> SearchResult:
         sorted_docs = self._query_docs(query)
-        responses = self._generate_document_summaries(sorted_docs, query)
-        top_sentence = self._generate_top_sentence(responses, query)
-        summary = self._make_summary(top_sentence, responses)
+        summary = self._generate_batched_summary(
+            sorted_docs, query, on_document_summary
+        )
+        if summary is None:
+            responses = self._generate_document_summaries(
+                sorted_docs, query, on_document_summary
+            )
+            top_sentence = self._generate_top_sentence(responses, query)
+            summary = self._make_summary(top_sentence, responses)
+        if self.semantic_cache is not None:
+            self.semantic_cache.add(query, self.llamaindex.get_query_embedding)
         return SearchResult(
             query=query,
             documents=[d["doc_id"] for d in sorted_docs],
@@ -150,27 +298,44 @@ class RAGIndex:
 
     def get_documents_for_query(self, query: str) -> List[Document]:
         sorted_docs = self._query_docs(query)
-        return compact(
-            [
-                self.document_repository.get_document(doc["doc_id"])
-                for doc in sorted_docs
-            ]
-        )
+        repository = self.document_repository.get()
+        return compact([repository.get_document(doc["doc_id"]) for doc in sorted_docs])
 
     def get_related_documents(
         self, query_doc: Document, limit: Optional[int] = None
     ) -> List[Document]:
+        related_ids = (
+            self.related_documents.get(query_doc.id)
+            if self.related_documents is not None
+            else None
+        )
+        if related_ids is not None:
+            repository = self.document_repository.get()
+            return compact([repository.get_document(id) for id in related_ids])[0:limit]
         return [
             doc
             for doc in self.get_documents_for_query(query_doc.embeddable_text)
             if doc != query_doc
         ][0:limit]
 
-    def query(self, query: str) -> SearchResult:
+    def query(
+        self,
+        query: str,
+        on_document_summary: Optional[DocumentSummaryCallback] = None,
+    ) -> SearchResult:
+        """
+        Get the summary for a query. When it has to be generated, each
+        document summary is passed to `on_document_summary` as soon as it is
+        ready, before the top sentence is generated. A query meaning the
+        same as one answered before is served that query's summary.
+        """
+        cached_response = self.get_cached_query_response(query)
+        if cached_response is not None and cached_response.query != query:
+            return cached_response
         return self.cache.cached(
             "query",
             [query],
-            self._uncached_query,
+            lambda query: self._uncached_query(query, on_document_summary),
             serializer=lambda sr: sr.asdict(),
             deserializer=lambda attrs: SearchResult.from_dict(**attrs),
         )
@@ -180,18 +345,112 @@ class RAGIndex:
             "query",
             [query],
             deserializer=lambda attrs: SearchResult.from_dict(**attrs),
+        ) or self._get_similar_query_response(query)
+
+    def _get_similar_query_response(self, query: str) -> Optional[SearchResult]:
+        if self.semantic_cache is None:
+            return None
+        similar_query = self.semantic_cache.find(
+            query, self.llamaindex.get_query_embedding
         )
+        if similar_query is None:
+            return None
+        return self.cache.get_if_cached(
+            "query",
+            [similar_query],
+            deserializer=lambda attrs: SearchResult.from_dict(**attrs),
+        )
+
+    def index_documents(
+        self, documents: List[DocumentWithText], prune: bool = False
+    ) -> None:
+        """
+        Index new and changed documents. When pruning, the documents are
+        taken to be every live document, and any other indexed document is
+        removed from the index. An empty list never prunes, as it is more
+        likely to be a failed ingest than an empty hub.
+        """
+        self.add_documents(documents)
+        self.finish_indexing({document.id for document in documents} if prune else None)
 
-    def index_documents(self, documents: List[DocumentWithText]) -> None:
-        self.llamaindex.index_documents(documents)
+    def add_documents(
+        self, documents: List[DocumentWithText], version: Optional[int] = None
+    ) -> None:
+        """
+        Index new and changed documents, leaving what is derived from the
+        whole index to `finish_indexing`, so that documents can be added in
+        many small batches. When given an index version being built, the
+        documents are added to it rather than to the live index.
+        """
+        self.llamaindex.index_documents(documents, export=False, version=version)
+
+    def finish_indexing(
+        self,
+        document_ids: Optional[Collection[str]] = None,
+        version: Optional[int] = None,
+    ) -> None:
+        """
+        Swap in the given index version, once checked to hold the given live
+        documents, or else prune any indexed document which isn't one of
+        them, if given any. Then export the local vector index and rebuild
+        the related documents table.
+        """
+        if version is not None:
+            self.llamaindex.swap_index_version(version, document_ids or [])
+        elif document_ids:
+            self.llamaindex.prune_documents(document_ids, export=False)
+        self.llamaindex.export_vector_index()
+        if self.related_documents is not None:
+            repository = self.document_repository.get()
+            self.related_documents.rebuild(
+                self.llamaindex.get_document_embeddings(), list(repository.documents)
+            )
 
 
 def get_rag_index_instance(
-    documents_repository: Optional[DocumentsRepository] = None,
+    documents_repository: Optional[DocumentsRepositoryProvider] = None,
 ) -> RAGIndex:
     llamaindex = get_llamaindex_instance()
     if documents_repository is None:
-        documents_repository = DocumentsRepository(airtable.get_db_instance())
-    cache = create_cache(prefix=environ["REDIS_QUERY_CACHE_PREFIX"])
+        documents_repository = get_repository_provider_instance()
+    cache = create_cache(
+        prefix=environ["REDIS_QUERY_CACHE_PREFIX"],
+        lock_timeout=QUERY_LOCK_TIMEOUT,
+    )
     max_document_summaries = int(environ["RETRIEVAL_MAX_DOCUMENT_SUMMARIES"])
-    return RAGIndex(llamaindex, documents_repository, cache, max_document_summaries)
+    related_documents = RelatedDocuments(
+        create_cache(
+            prefix=environ.get("REDIS_RELATED_DOCUMENTS_CACHE_PREFIX", "related")
+        ),
+        RELATED_DOCUMENTS_LIMIT,
+    )
+    summarizer: ConcurrentSummarizer[DocumentResult, GenerationResult] = (
+        ConcurrentSummarizer(
+            int(environ.get("SUMMARY_CONCURRENCY", SUMMARY_CONCURRENCY)),
+            float(environ.get("SUMMARY_TIMEOUT", SUMMARY_TIMEOUT)),
+        )
+    )
+    summarization_mode = environ.get("SUMMARIZATION_MODE", "per_document")
+    if summarization_mode not in SUMMARIZATION_MODES:
+        raise ValueError(f"Unknown summarization mode {summarization_mode}")
+    batched_summarizer = None
+    if summarization_mode == "batched":
+        batched_summarizer = BatchedSummarizer(
+            llamaindex.complete_json,
+            int(environ.get("SUMMARY_CONTEXT_TOKENS", SUMMARY_CONTEXT_TOKENS)),
+        )
+    semantic_cache = SemanticQueryCache(
+        cache,
+        float(environ.get("SEMANTIC_CACHE_THRESHOLD", SEMANTIC_CACHE_THRESHOLD)),
+        int(environ.get("SEMANTIC_CACHE_MAX_QUERIES", SEMANTIC_CACHE_MAX_QUERIES)),
+    )
+    return RAGIndex(
+        llamaindex,
+        documents_repository,
+        cache,
+        max_document_summaries,
+        related_documents,
+        summarizer,
+        semantic_cache,
+        batched_summarizer,
+    )
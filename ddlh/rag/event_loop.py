@@ -0,0 +1,84 @@
+import asyncio
+from selectors import SelectorKey
+from threading import Lock
+from typing import Any, Callable, Coroutine, Optional, TypeVar
+
+import gevent
+from gevent.selectors import GeventSelector
+
+_T = TypeVar("_T")
+
+
+class _LoopSelector(GeventSelector):
+    """
+    gevent's cooperative selector, which stops its loop from being the
+    running loop while it waits for events. asyncio keeps track of the
+    running loop per native thread rather than per greenlet, so other
+    greenlets would otherwise see it as theirs.
+    """
+
+    loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def select(self, timeout: Optional[float] = None) -> list[tuple[SelectorKey, int]]:
+        asyncio._set_running_loop(None)
+        try:
+            return super().select(timeout)
+        finally:
+            asyncio._set_running_loop(self.loop)
+
+
+class SharedEventLoop:
+    """
+    An asyncio event loop running forever in a greenlet of its own, started
+    when first used.
+
+    Under gevent every greenlet is a thread of its own as far as asyncio can
+    tell, so would get an event loop of its own, while asynchronous clients
+    belong to the loop they were first used from. Running every coroutine on
+    this one loop instead lets a single client be shared by every greenlet
+    of the process.
+    """
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._greenlet: Optional[gevent.Greenlet[..., None]] = None
+        self._lock = Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                selector = _LoopSelector()
+                self._loop = selector.loop = asyncio.SelectorEventLoop(selector)
+                self._greenlet = gevent.spawn(self._loop.run_forever)
+            return self._loop
+
+    def run(self, coroutine: Coroutine[Any, Any, _T]) -> _T:
+        """
+        Run the coroutine on the loop, blocking only the calling greenlet
+        until it is done.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call(self, function: Callable[[], _T]) -> _T:
+        """
+        Call the function on the loop, for objects which look up the running
+        event loop when created.
+        """
+        if gevent.getcurrent() is self._greenlet:
+            return function()
+
+        async def call() -> _T:
+            return function()
+
+        return self.run(call())
+
+    def stop(self) -> None:
+        with self._lock:
+            loop, self._loop = self._loop, None
+            greenlet, self._greenlet = self._greenlet, None
+        if loop is None or greenlet is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        greenlet.join()
+        loop.close()
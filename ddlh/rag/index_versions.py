@@ -0,0 +1,190 @@
+from typing import Any, Optional
+
+from elasticsearch import AsyncElasticsearch
+
+# Settings for indexes being bulk loaded: nothing is searchable or
+# replicated until the load is finished.
+BULK_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+
+
+class IndexVersionError(ValueError):
+    pass
+
+
+def versioned_index_name(alias: str, version: int) -> str:
+    return f"{alias}-v{version}"
+
+
+def index_version(alias: str, index_name: str) -> Optional[int]:
+    prefix = f"{alias}-v"
+    if not index_name.startswith(prefix) or not index_name[len(prefix) :].isdigit():
+        return None
+    return int(index_name[len(prefix) :])
+
+
+class IndexVersions:
+    """
+    Versions of a set of elasticsearch indexes, each read and written
+    through an alias named after it. A new version is built alongside the
+    live one, then swapped in by moving every alias in a single atomic
+    update, leaving the previous version in place to roll back to.
+    """
+
+    def __init__(self, client: AsyncElasticsearch, aliases: list[str], replicas: int):
+        self.client = client
+        self.aliases = aliases
+        self.replicas = replicas
+
+    def index_names(self, version: int) -> list[str]:
+        return [versioned_index_name(alias, version) for alias in self.aliases]
+
+    async def versions(self) -> list[int]:
+        """
+        The versions which exist for every alias, oldest first.
+        """
+        versions: Optional[set[int]] = None
+        for alias in self.aliases:
+            alias_versions = await self._alias_versions(alias)
+            versions = alias_versions if versions is None else versions & alias_versions
+        return sorted(versions or [])
+
+    async def next_version(self) -> int:
+        return max(await self._any_versions(), default=0) + 1
+
+    async def live_version(self) -> Optional[int]:
+        alias = self.aliases[0]
+        if not await self.client.indices.exists_alias(name=alias):
+            return None
+        for index_name in await self.client.indices.get_alias(name=alias):
+            version = index_version(alias, index_name)
+            if version is not None:
+                return version
+        return None
+
+    async def create(
+        self, version: int, mappings: Optional[dict[str, dict[str, Any]]] = None
+    ) -> None:
+        mappings = mappings or {}
+        for alias in self.aliases:
+            await self.client.indices.create(
+                index=versioned_index_name(alias, version),
+                settings=BULK_SETTINGS,
+                mappings=mappings.get(alias),
+            )
+
+    async def finish(self, version: int) -> None:
+        """
+        Restore the usual settings of a bulk loaded version, and make
+        everything loaded into it searchable.
+        """
+        index_names = self.index_names(version)
+        await self.client.indices.put_settings(
+            index=index_names,
+            settings={"number_of_replicas": self.replicas, "refresh_interval": None},
+        )
+        await self.client.indices.refresh(index=index_names)
+
+    async def swap(self, version: int) -> None:
+        """
+        Point every alias at the given version at once. Indexes from before
+        versioning, which have the name of their alias, are first copied to
+        version 0, to have a version to roll back to, then deleted in the
+        same update, as an alias can't share its name with an index.
+        """
+        actions: list[dict[str, Any]] = []
+        unversioned = []
+        missing = []
+        for alias in self.aliases:
+            if await self.client.indices.exists_alias(name=alias):
+                for index_name in await self.client.indices.get_alias(name=alias):
+                    actions.append({"remove": {"index": index_name, "alias": alias}})
+            elif await self.client.indices.exists(index=alias):
+                unversioned.append(alias)
+                actions.append({"remove_index": {"index": alias}})
+            else:
+                missing.append(alias)
+            actions.append(
+                {
+                    "add": {
+                        "index": versioned_index_name(alias, version),
+                        "alias": alias,
+                    }
+                }
+            )
+        if unversioned:
+            await self._copy_unversioned(unversioned, missing)
+        await self.client.indices.update_aliases(actions=actions)
+
+    async def rollback(self) -> int:
+        live_version = await self.live_version()
+        previous_versions = [
+            version
+            for version in await self.versions()
+            if live_version is None or version < live_version
+        ]
+        if not previous_versions:
+            raise IndexVersionError("No previous index version to roll back to")
+        await self.swap(previous_versions[-1])
+        return previous_versions[-1]
+
+    async def delete(self, version: int) -> None:
+        await self.client.indices.delete(
+            index=self.index_names(version), ignore_unavailable=True
+        )
+
+    async def prune(self, retained_versions: int) -> list[int]:
+        """
+        Delete all but the latest `retained_versions` versions, never
+        deleting the live one. Returns the deleted versions.
+        """
+        live_version = await self.live_version()
+        versions = await self._any_versions()
+        deleted_versions = [
+            version
+            for version in sorted(versions)[: max(len(versions) - retained_versions, 0)]
+            if version != live_version
+        ]
+        for version in deleted_versions:
+            await self.delete(version)
+        return deleted_versions
+
+    async def _copy_unversioned(
+        self, unversioned: list[str], missing: list[str]
+    ) -> None:
+        """
+        Copy indexes from before versioning to version 0, along with empty
+        indexes for any which were never created, so that version 0 is
+        complete.
+        """
+        for alias in unversioned + missing:
+            index_name = versioned_index_name(alias, 0)
+            await self.client.indices.delete(index=index_name, ignore_unavailable=True)
+            if alias in missing:
+                await self.client.indices.create(index=index_name)
+                continue
+            mappings = await self.client.indices.get_mapping(index=alias)
+            await self.client.indices.create(
+                index=index_name, mappings=mappings[alias]["mappings"]
+            )
+            await self.client.reindex(
+                source={"index": alias},
+                dest={"index": index_name},
+                refresh=True,
+                wait_for_completion=True,
+            )
+
+    async def _any_versions(self) -> set[int]:
+        versions: set[int] = set()
+        for alias in self.aliases:
+            versions |= await self._alias_versions(alias)
+        return versions
+
+    async def _alias_versions(self, alias: str) -> set[int]:
+        response = await self.client.indices.get(
+            index=f"{alias}-v*", allow_no_indices=True
+        )
+        return {
+            version
+            for index_name in response
+            if (version := index_version(alias, index_name)) is not None
+        }
@@ -1,11 +1,28 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from functools import cached_property
 from os import environ
-from typing import Optional, Sequence, Union, cast
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Union,
+    cast,
+)
 
+import numpy as np
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_scan
 from llama_index.core import Document as LlamaDocument
 from llama_index.core import QueryBundle, VectorStoreIndex, get_response_synthesizer
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.base.response.schema import Response
+from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.llms import LLM
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.response_synthesizers import ResponseMode
 from llama_index.core.schema import (
@@ -14,6 +31,14 @@ from llama_index.core.schema import (
     NodeWithScore,
     RelatedNodeInfo,
 )
+from llama_index.core.storage.kvstore.types import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_COLLECTION,
+)
+from llama_index.core.vector_stores.types import (
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
 from llama_index.embeddings.mistralai import MistralAIEmbedding  # type: ignore
 from llama_index.llms.mistralai import MistralAI  # type: ignore
 from llama_index.storage.docstore.elasticsearch import (  # type: ignore
@@ -22,8 +47,21 @@ from llama_index.storage.docstore.elasticsearch import (  # type: ignore
 from llama_index.storage.kvstore.elasticsearch import (  # type: ignore
     ElasticsearchKVStore,
 )
+from numpy.typing import NDArray
 
 from ddlh.models import DocumentWithText
+from ddlh.rag.embeddings import ConcurrentEmbedding, EmbeddingCache
+from ddlh.rag.event_loop import SharedEventLoop
+from ddlh.rag.index_versions import (
+    IndexVersionError,
+    IndexVersions,
+    versioned_index_name,
+)
+from ddlh.rag.providers import LOCAL_PROVIDER, PROVIDERS, EchoLLM, HashingEmbedding
+from ddlh.rag.related import document_embeddings
+from ddlh.rag.vector_index import IndexedChunk, LocalVectorIndex, write_vector_index
+from ddlh.rate_limiting import RedisTokenBucket
+from ddlh.redis_cache import create_cache
 
 from llama_index.vector_stores.elasticsearch import (  # type: ignore # isort:skip
     ElasticsearchStore as ElasticsearchVectorStore,
@@ -31,6 +69,19 @@ from llama_index.vector_stores.elasticsearch import (  # type: ignore # isort:sk
 
 AnyNode = Union[BaseNode, NodeWithScore]
 
+# How many embedding requests are made per second, across every worker.
+EMBEDDING_REQUESTS_PER_SECOND = 5.0
+
+# The configured index names, which are the names of the aliases to the
+# live version of each index once it has been reindexed.
+INDEX_FIELDS = [
+    "es_embeddings_index",
+    "es_kv_index",
+    "es_node_index",
+    "es_ref_doc_index",
+    "es_metadata_index",
+]
+
 GenerationResult = Response
 RetrievalResult = NodeWithScore
 
@@ -53,77 +104,519 @@ class LlamaIndexConfig:
     embedding_chunk_overlap: int
     retrieval_top_k: int
     safe_prompt: bool
+    llm_timeout: float = 120
+    provider: str = "mistral"
+    local_embedding_dimensions: int = 1024
+    local_embedding_latency: float = 0.0
+    local_llm_latency: float = 0.0
+    local_vector_index_path: Optional[str] = None
+    embedding_batch_size: int = 32
+    embedding_concurrency: int = 4
+    es_bulk_size: int = 500
+    es_connections_per_node: int = 10
+    es_max_retries: int = 3
+    es_replicas: int = 1
+    es_retained_versions: int = 2
+    es_quantize_vectors: bool = False
+
+
+class LoopElasticsearchKVStore(ElasticsearchKVStore):  # type: ignore[misc]
+    """
+    An elasticsearch KV store making its requests on the event loop its
+    client belongs to, rather than on an event loop of the calling thread.
+    """
+
+    def __init__(self, event_loop: SharedEventLoop, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._event_loop = event_loop
+
+    def put_all(
+        self,
+        kv_pairs: list[tuple[str, dict[str, Any]]],
+        collection: str = DEFAULT_COLLECTION,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        self._event_loop.run(self.aput_all(kv_pairs, collection, batch_size))
+
+    def get(
+        self, key: str, collection: str = DEFAULT_COLLECTION
+    ) -> Optional[dict[str, Any]]:
+        return cast(
+            Optional[dict[str, Any]], self._event_loop.run(self.aget(key, collection))
+        )
+
+    def get_all(
+        self, collection: str = DEFAULT_COLLECTION
+    ) -> dict[str, dict[str, Any]]:
+        return cast(
+            dict[str, dict[str, Any]], self._event_loop.run(self.aget_all(collection))
+        )
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return cast(bool, self._event_loop.run(self.adelete(key, collection)))
+
+
+class LoopElasticsearchVectorStore(ElasticsearchVectorStore):  # type: ignore[misc]
+    """
+    An elasticsearch vector store making its requests on the event loop its
+    client belongs to, rather than on an event loop of the calling thread.
+    """
+
+    _event_loop: SharedEventLoop = PrivateAttr()
+
+    def __init__(self, event_loop: SharedEventLoop, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._event_loop = event_loop
+
+    def add(
+        self,
+        nodes: list[BaseNode],
+        *,
+        create_index_if_not_exists: bool = True,
+        **add_kwargs: Any,
+    ) -> list[str]:
+        return cast(
+            list[str],
+            self._event_loop.run(
+                self.async_add(
+                    nodes,
+                    create_index_if_not_exists=create_index_if_not_exists,
+                    **add_kwargs,
+                )
+            ),
+        )
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._event_loop.run(self.adelete(ref_doc_id, **delete_kwargs))
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        custom_query: Optional[
+            Callable[[dict[str, Any], Optional[VectorStoreQuery]], dict[str, Any]]
+        ] = None,
+        es_filter: Optional[list[dict[str, Any]]] = None,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        return cast(
+            VectorStoreQueryResult,
+            self._event_loop.run(self.aquery(query, custom_query, es_filter, **kwargs)),
+        )
+
+
+class ElasticsearchStores(NamedTuple):
+    client: AsyncElasticsearch
+    docstore: ElasticsearchDocumentStore
+    vector_store: ElasticsearchVectorStore
+    vector_store_index: VectorStoreIndex
 
 
 class LlamaIndex:
-    def __init__(self, config: LlamaIndexConfig):
+    """
+    Clients are created once and reused for the lifetime of the process, so
+    their pooled keep-alive connections are shared between queries.
+
+    The elasticsearch client is asynchronous, and its connections belong to
+    the event loop they were opened from, so every elasticsearch request is
+    made on one shared event loop, whichever greenlet it comes from. Versions
+    of the index share the client and event loop of the live one.
+    """
+
+    def __init__(
+        self,
+        config: LlamaIndexConfig,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_rate_limiter: Optional[RedisTokenBucket] = None,
+        event_loop: Optional[SharedEventLoop] = None,
+        es_client: Optional[AsyncElasticsearch] = None,
+    ):
+        if config.provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider {config.provider}")
         self.config = config
+        self.embedding_cache = embedding_cache
+        self.embedding_rate_limiter = embedding_rate_limiter
+        self.local_vector_index = (
+            LocalVectorIndex(config.local_vector_index_path)
+            if config.local_vector_index_path
+            else None
+        )
+        self.event_loop = event_loop or SharedEventLoop()
+        self._es_client = es_client
+        self._stores: Optional[ElasticsearchStores] = None
+        self._stores_lock = Lock()
+
+    @property
+    def stores(self) -> ElasticsearchStores:
+        with self._stores_lock:
+            if self._stores is None:
+                self._stores = self.event_loop.call(self._make_stores)
+            return self._stores
 
     @property
     def docstore(self) -> ElasticsearchDocumentStore:
-        return ElasticsearchDocumentStore(
-            elasticsearch_kvstore=ElasticsearchKVStore(
+        return self.stores.docstore
+
+    @property
+    def vector_store(self) -> ElasticsearchVectorStore:
+        return self.stores.vector_store
+
+    @property
+    def index(self) -> VectorStoreIndex:
+        return self.stores.vector_store_index
+
+    @cached_property
+    def embedding_model(self) -> BaseEmbedding:
+        if self.config.provider == LOCAL_PROVIDER:
+            return HashingEmbedding(
+                dimensions=self.config.local_embedding_dimensions,
+                latency=self.config.local_embedding_latency,
+                embed_batch_size=self.config.embedding_batch_size,
+            )
+        return cast(
+            BaseEmbedding,
+            MistralAIEmbedding(
+                self.config.embedding_model_name,
+                api_key=self.config.mistral_api_key,
+                embed_batch_size=self.config.embedding_batch_size,
+            ),
+        )
+
+    @cached_property
+    def llm(self) -> LLM:
+        if self.config.provider == LOCAL_PROVIDER:
+            return EchoLLM(latency=self.config.local_llm_latency)
+        return cast(
+            LLM,
+            MistralAI(
+                self.config.llm_model_name,
+                api_key=self.config.mistral_api_key,
+                timeout=self.config.llm_timeout,
+            ),
+        )
+
+    def _make_es_client(self) -> AsyncElasticsearch:
+        basic_auth = None
+        if self.config.es_username and self.config.es_password:
+            basic_auth = (self.config.es_username, self.config.es_password)
+        return AsyncElasticsearch(
+            self.config.es_url,
+            basic_auth=basic_auth,
+            connections_per_node=self.config.es_connections_per_node,
+            http_compress=True,
+            max_retries=self.config.es_max_retries,
+            retry_on_timeout=True,
+        )
+
+    def _make_stores(self) -> ElasticsearchStores:
+        client = self._es_client or self._make_es_client()
+        docstore = ElasticsearchDocumentStore(
+            elasticsearch_kvstore=LoopElasticsearchKVStore(
+                self.event_loop,
                 index_name=self.config.es_kv_index,
-                es_url=self.config.es_url,
-                es_user=self.config.es_username,
-                es_password=self.config.es_password,
-                es_client=None,
+                es_client=client,
             ),
             node_collection_index=self.config.es_node_index,
             ref_doc_collection_index=self.config.es_ref_doc_index,
             metadata_collection_index=self.config.es_metadata_index,
         )
-
-    @property
-    def vector_store(self) -> ElasticsearchVectorStore:
-        return ElasticsearchVectorStore(
-            es_url=self.config.es_url,
-            es_user=self.config.es_username,
-            es_password=self.config.es_password,
+        vector_store = LoopElasticsearchVectorStore(
+            self.event_loop,
+            es_client=client,
             index_name=self.config.es_embeddings_index,
             vector_field=self.config.es_embeddings_field,
+            batch_size=self.config.es_bulk_size,
         )
-
-    @property
-    def embedding_model(self) -> MistralAIEmbedding:
-        return MistralAIEmbedding(
-            self.config.embedding_model_name, api_key=self.config.mistral_api_key
+        vector_store_index = VectorStoreIndex.from_vector_store(
+            vector_store, embed_model=self.embedding_model
         )
+        vector_store_index.storage_context.docstore = docstore
+        return ElasticsearchStores(client, docstore, vector_store, vector_store_index)
 
     def make_pipeline(self) -> IngestionPipeline:
         splitter = SentenceSplitter(
             chunk_size=self.config.embedding_chunk_size,
             chunk_overlap=self.config.embedding_chunk_overlap,
         )
+        embedding = ConcurrentEmbedding(
+            self.embedding_model,
+            self.config.embedding_concurrency,
+            self.embedding_rate_limiter,
+        )
         return IngestionPipeline(
-            transformations=[splitter, self.embedding_model],
+            transformations=[splitter, embedding],
             vector_store=self.vector_store,
             docstore=self.docstore,
         )
 
-    def index_documents(self, documents: list[DocumentWithText]) -> None:
-        pipeline = self.make_pipeline()
+    def index_documents(
+        self,
+        documents: list[DocumentWithText],
+        export: bool = True,
+        version: Optional[int] = None,
+    ) -> list[BaseNode]:
+        """
+        Index the documents, returning the embedded nodes of those which were
+        new or had changed.
+
+        The ingestion pipeline compares the content hash of every document
+        with the one stored in the docstore, and skips unchanged documents
+        without chunking or embedding them. When not exporting, the local
+        vector index is left for the caller to export once done. When given
+        a version, the documents are indexed into that version rather than
+        the live indexes.
+        """
+        if version is not None:
+            return self.for_version(version).index_documents(documents, export=False)
         llama_documents = [
             LlamaDocument(text=document.embeddable_text, doc_id=document.id)
             for document in documents
         ]
-        pipeline.run(documents=llama_documents)
+        pipeline = self.make_pipeline()
+        nodes = cast(list[BaseNode], pipeline.run(documents=llama_documents))
+        if export:
+            self.export_vector_index()
+        return nodes
+
+    def prune_documents(
+        self, document_ids: Collection[str], export: bool = True
+    ) -> list[str]:
+        """
+        Delete the chunks of every indexed document which isn't one of the
+        given documents, returning the ids of the deleted documents.
+        """
+        removed_ids = [
+            doc_id
+            for doc_id in self.get_stored_document_hashes()
+            if doc_id not in document_ids
+        ]
+        for doc_id in removed_ids:
+            self.vector_store.delete(doc_id)
+            self.docstore.delete_ref_doc(doc_id, raise_error=False)
+            self.docstore.delete_document(doc_id, raise_error=False)
+        if removed_ids and export:
+            self.export_vector_index()
+        return removed_ids
 
-    def get_document_id_for_result(self, result: NodeWithScore) -> Optional[str]:
-        source_node = cast(
-            RelatedNodeInfo, result.node.relationships[NodeRelationship.SOURCE]
+    def for_version(self, version: int) -> "LlamaIndex":
+        """
+        A LlamaIndex over the given version of the indexes, rather than over
+        the live ones, sharing this one's elasticsearch client.
+        """
+        index_names: dict[str, Any] = {
+            field: versioned_index_name(getattr(self.config, field), version)
+            for field in INDEX_FIELDS
+        }
+        config = replace(self.config, local_vector_index_path=None, **index_names)
+        return LlamaIndex(
+            config,
+            self.embedding_cache,
+            self.embedding_rate_limiter,
+            self.event_loop,
+            self.stores.client,
         )
-        doc_id = source_node.node_id
+
+    def create_index_version(self) -> int:
+        """
+        Create a new, empty version of every index, set up for bulk loading,
+        to be indexed into and then swapped in with `swap_index_version`.
+        """
+        index_versions = self._index_versions()
+        version = self.event_loop.run(index_versions.next_version())
+        mappings = {self.config.es_embeddings_index: self._embeddings_mappings()}
+        self.event_loop.run(index_versions.create(version, mappings))
+        return version
+
+    def swap_index_version(self, version: int, document_ids: Collection[str]) -> None:
+        """
+        Check that the given version holds every one of the documents, then
+        make it the live version. Only the latest `es_retained_versions`
+        versions are kept. A version which fails the check is deleted.
+        """
+        index_versions = self._index_versions()
         try:
-            self.docstore.get_document(doc_id)
-            return doc_id
+            self.event_loop.run(index_versions.finish(version))
+            self._check_index_version(version, document_ids)
+            self.event_loop.run(index_versions.swap(version))
         except Exception:
+            self.event_loop.run(index_versions.delete(version))
+            raise
+        self.event_loop.run(index_versions.prune(self.config.es_retained_versions))
+
+    def rollback_index_version(self) -> int:
+        """
+        Make the version before the live one live again, returning it.
+        """
+        version = self.event_loop.run(self._index_versions().rollback())
+        self.export_vector_index()
+        return version
+
+    def _index_versions(self) -> IndexVersions:
+        return IndexVersions(
+            self.stores.client,
+            [getattr(self.config, field) for field in INDEX_FIELDS],
+            self.config.es_replicas,
+        )
+
+    def _check_index_version(self, version: int, document_ids: Collection[str]) -> None:
+        if not document_ids:
+            raise IndexVersionError(
+                "Refusing to swap in an index version without documents"
+            )
+        versioned_llama_index = self.for_version(version)
+        stored_ids = versioned_llama_index.get_stored_document_hashes()
+        count = self.event_loop.run(
+            self.stores.client.count(
+                index=versioned_llama_index.config.es_embeddings_index
+            )
+        )
+        missing_ids = set(document_ids) - set(stored_ids)
+        if missing_ids:
+            raise IndexVersionError(
+                f"{len(missing_ids)} documents are missing from index version {version}"
+            )
+        if not count["count"]:
+            raise IndexVersionError(f"Index version {version} has no embeddings")
+
+    def _embeddings_mappings(self) -> dict[str, Any]:
+        """
+        The mappings the elasticsearch vector store would create its index
+        with, with quantized vectors if configured.
+        """
+        vector_mapping: dict[str, Any] = {
+            "type": "dense_vector",
+            "dims": len(self.get_query_embedding("dimensions")),
+            "index": True,
+            "similarity": "cosine",
+        }
+        if self.config.es_quantize_vectors:
+            vector_mapping["index_options"] = {"type": "int8_hnsw"}
+        metadata_mappings = {
+            field: {"type": "keyword"}
+            for field in ["document_id", "doc_id", "ref_doc_id"]
+        }
+        return {
+            "properties": {
+                self.config.es_embeddings_field: vector_mapping,
+                "metadata": {"properties": metadata_mappings},
+            }
+        }
+
+    def close(self) -> None:
+        """
+        Close the elasticsearch client and stop the event loop it runs on,
+        unless they were shared with this index by another one.
+        """
+        if self._es_client is not None:
+            return
+        with self._stores_lock:
+            stores, self._stores = self._stores, None
+        if stores is not None:
+            self.event_loop.run(stores.client.close())
+        self.event_loop.stop()
+
+    def get_stored_document_hashes(self) -> dict[str, str]:
+        """
+        The content hash of every indexed document, by document id.
+        """
+        return self.event_loop.run(self._scan_document_hashes())
+
+    async def _scan_document_hashes(self) -> dict[str, str]:
+        # The docstore can only list its hashes one search page at a time,
+        # then fetches them one document at a time, so they are scanned
+        # from the metadata index it keeps them in instead.
+        client = self.stores.client
+        index = self.config.es_metadata_index
+        if not await client.indices.exists(index=index):
+            return {}
+        await client.indices.refresh(index=index)
+        hashes = {}
+        async for hit in async_scan(
+            client,
+            index=index,
+            query={"query": {"match_all": {}}},
+            _source=["doc_hash", "ref_doc_id"],
+        ):
+            source = hit["_source"]
+            if source.get("doc_hash") and not source.get("ref_doc_id"):
+                hashes[hit["_id"]] = source["doc_hash"]
+        return hashes
+
+    def export_vector_index(self) -> None:
+        """
+        Write every chunk embedding stored in elasticsearch to the local
+        vector index file, if there is one.
+        """
+        if self.local_vector_index is None:
+            return
+        chunks, embeddings = self.event_loop.run(self._scan_embeddings())
+        write_vector_index(
+            self.local_vector_index.path,
+            chunks,
+            np.asarray(embeddings, dtype=np.float32),
+        )
+
+    async def _scan_embeddings(self) -> tuple[list[IndexedChunk], list[list[float]]]:
+        client = self.stores.client
+        index = self.config.es_embeddings_index
+        await client.indices.refresh(index=index)
+        chunks = []
+        embeddings = []
+        async for hit in async_scan(
+            client,
+            index=index,
+            query={"query": {"match_all": {}}},
+            _source=["content", "metadata", self.config.es_embeddings_field],
+        ):
+            source = hit["_source"]
+            embedding = source.get(self.config.es_embeddings_field)
+            if embedding and isinstance(source.get("metadata"), dict):
+                chunks.append(
+                    IndexedChunk(
+                        hit["_id"], source.get("content") or "", source["metadata"]
+                    )
+                )
+                embeddings.append(embedding)
+        return chunks, embeddings
+
+    def get_document_embeddings(self) -> dict[str, NDArray[np.float32]]:
+        """
+        The unit length mean of the chunk embeddings of each document, as
+        stored in elasticsearch.
+        """
+        return self.event_loop.run(self._scan_document_embeddings())
+
+    async def _scan_document_embeddings(self) -> dict[str, NDArray[np.float32]]:
+        client = self.stores.client
+        index = self.config.es_embeddings_index
+        await client.indices.refresh(index=index)
+        chunks = []
+        async for hit in async_scan(
+            client,
+            index=index,
+            query={"query": {"match_all": {}}},
+            _source=["metadata.ref_doc_id", self.config.es_embeddings_field],
+        ):
+            source = hit["_source"]
+            doc_id = (source.get("metadata") or {}).get("ref_doc_id")
+            embedding = source.get(self.config.es_embeddings_field)
+            if doc_id and embedding:
+                chunks.append((doc_id, embedding))
+        return document_embeddings(chunks)
+
+    def get_document_id_for_result(self, result: NodeWithScore) -> Optional[str]:
+        """
+        The id of the document a result was taken from, as recorded on the
+        node when it was indexed. Callers check it against the documents
+        they know about, rather than asking the docstore for every result.
+        """
+        source_node = result.node.relationships.get(NodeRelationship.SOURCE)
+        if source_node is None:
             return None
+        return cast(RelatedNodeInfo, source_node).node_id
 
     def synthesize(self, prompt: str, nodes: Sequence[AnyNode]) -> Response:
-        llm = MistralAI(self.config.llm_model_name, api_key=self.config.mistral_api_key)
         response_synthesizer = get_response_synthesizer(
-            llm=llm,
+            llm=self.llm,
             response_mode=ResponseMode.REFINE,
         )
         return cast(
@@ -133,19 +626,42 @@ class LlamaIndex:
             ),
         )
 
-    def query_results(self, query: str) -> list[NodeWithScore]:
-        bundle = QueryBundle(
-            query, embedding=self.embedding_model.get_query_embedding(query)
+    def get_query_embedding(self, query: str) -> list[float]:
+        if self.embedding_cache is None:
+            return cast(list[float], self.embedding_model.get_query_embedding(query))
+        return self.embedding_cache.get_embedding(
+            query, self.embedding_model.get_query_embedding
         )
-        index = VectorStoreIndex.from_vector_store(
-            self.vector_store, embed_model=self.embedding_model
+
+    def complete_json(self, prompt: str) -> str:
+        response = self.llm.complete(
+            prompt,
+            safe_prompt=self.config.safe_prompt,
+            response_format={"type": "json_object"},
         )
-        index.storage_context.docstore = self.docstore
+        return response.text
 
-        retriever = index.as_retriever(similarity_top_k=self.config.retrieval_top_k)
+    def query_results(self, query: str) -> list[NodeWithScore]:
+        embedding = self.get_query_embedding(query)
+        if self.local_vector_index is not None:
+            results = self.local_vector_index.query(
+                embedding, self.config.retrieval_top_k
+            )
+            if results is not None:
+                return results
+        bundle = QueryBundle(query, embedding=embedding)
+        retriever = self.index.as_retriever(
+            similarity_top_k=self.config.retrieval_top_k
+        )
         return cast(list[NodeWithScore], retriever.retrieve(bundle))
 
 
+def embedding_model_id(config: LlamaIndexConfig) -> str:
+    if config.provider == LOCAL_PROVIDER:
+        return f"{LOCAL_PROVIDER}-hashing-{config.local_embedding_dimensions}"
+    return config.embedding_model_name
+
+
 def get_llamaindex_instance() -> LlamaIndex:
     config = LlamaIndexConfig(
         es_url=environ["ELASTICSEARCH_URL"],
@@ -164,5 +680,42 @@ def get_llamaindex_instance() -> LlamaIndex:
         embedding_chunk_overlap=int(environ["EMBEDDING_CHUNK_OVERLAP"]),
         retrieval_top_k=int(environ["RETRIEVAL_TOP_K"]),
         safe_prompt=environ.get("DISABLE_MISTRAL_AI_GUARDRALS") != "1",
+        llm_timeout=float(environ.get("MISTRAL_TIMEOUT", "120")),
+        provider=environ.get("LLAMAINDEX_PROVIDER", "mistral"),
+        local_embedding_dimensions=int(
+            environ.get("LOCAL_EMBEDDING_DIMENSIONS", "1024")
+        ),
+        local_embedding_latency=float(environ.get("LOCAL_EMBEDDING_LATENCY", "0")),
+        local_llm_latency=float(environ.get("LOCAL_LLM_LATENCY", "0")),
+        local_vector_index_path=environ.get("LOCAL_VECTOR_INDEX_PATH") or None,
+        embedding_batch_size=int(environ.get("EMBEDDING_BATCH_SIZE", "32")),
+        embedding_concurrency=int(environ.get("EMBEDDING_CONCURRENCY", "4")),
+        es_bulk_size=int(environ.get("ELASTICSEARCH_BULK_SIZE", "500")),
+        es_connections_per_node=int(
+            environ.get("ELASTICSEARCH_CONNECTIONS_PER_NODE", "10")
+        ),
+        es_max_retries=int(environ.get("ELASTICSEARCH_MAX_RETRIES", "3")),
+        es_replicas=int(environ.get("ELASTICSEARCH_REPLICAS", "1")),
+        es_retained_versions=int(environ.get("ELASTICSEARCH_RETAINED_VERSIONS", "2")),
+        es_quantize_vectors=environ.get("ELASTICSEARCH_QUANTIZE_VECTORS") == "1",
+    )
+    embedding_cache = EmbeddingCache(
+        create_cache(
+            prefix=environ.get("REDIS_EMBEDDING_CACHE_PREFIX", "embeddings"),
+            timeout=(
+                int(environ["REDIS_EMBEDDING_CACHE_TIMEOUT"])
+                if "REDIS_EMBEDDING_CACHE_TIMEOUT" in environ
+                else None
+            ),
+        ),
+        embedding_model_id(config),
+    )
+    embedding_rate_limiter = RedisTokenBucket(
+        embedding_cache.cache.redis,
+        embedding_cache.cache.key("rate_limit", [embedding_model_id(config)]),
+        float(
+            environ.get("EMBEDDING_REQUESTS_PER_SECOND", EMBEDDING_REQUESTS_PER_SECOND)
+        ),
+        config.embedding_concurrency,
     )
-    return LlamaIndex(config)
+    return LlamaIndex(config, embedding_cache, embedding_rate_limiter)
@@ -0,0 +1,114 @@
+import json
+import re
+from hashlib import blake2b
+from time import sleep
+from typing import Any
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+# Providers which run entirely in process, without network access, so that
+# indexing and querying can be tested and benchmarked offline. Their output
+# is deterministic, but has no meaning.
+
+LOCAL_PROVIDER = "local"
+MISTRAL_PROVIDER = "mistral"
+PROVIDERS = (MISTRAL_PROVIDER, LOCAL_PROVIDER)
+
+LOCAL_LLM_RESPONSE = "This document is a local response to a prompt of {words} words."
+
+
+def _digest(text: str) -> int:
+    return int.from_bytes(blake2b(text.encode("UTF-8"), digest_size=8).digest())
+
+
+class HashingEmbedding(BaseEmbedding):
+    """
+    Embeds texts by hashing their lowercased words into `dimensions`
+    buckets, so texts sharing words have similar embeddings.
+    """
+
+    dimensions: int = Field(default=1024, description="Embedding dimensions.")
+    latency: float = Field(default=0.0, description="Seconds to wait per call.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashingEmbedding"
+
+    def _embed(self, text: str) -> list[float]:
+        if self.latency:
+            sleep(self.latency)
+        embedding = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.casefold()):
+            digest = _digest(word)
+            sign = 1.0 if digest & 1 else -1.0
+            embedding[(digest >> 1) % self.dimensions] += sign
+        norm = sum(value * value for value in embedding) ** 0.5
+        if norm == 0:
+            return embedding
+        return [value / norm for value in embedding]
+
+    def _get_query_embedding(self, query: str) -> list[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> list[float]:
+        return self._embed(text)
+
+    async def _aget_query_embedding(self, query: str) -> list[float]:
+        return self._embed(query)
+
+
+class EchoLLM(CustomLLM):
+    """
+    Answers every prompt with a templated response after `latency` seconds.
+
+    When asked for JSON, answers as the batched summarization prompt
+    expects, finding every document relevant.
+    """
+
+    latency: float = Field(default=0.0, description="Seconds to wait per call.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "EchoLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="echo")
+
+    def _respond(self, prompt: str, **kwargs: Any) -> str:
+        if self.latency:
+            sleep(self.latency)
+        response = LOCAL_LLM_RESPONSE.format(words=len(prompt.split()))
+        if kwargs.get("response_format") == {"type": "json_object"}:
+            numbers = sorted({int(n) for n in re.findall(r"Document (\d+):", prompt)})
+            return json.dumps(
+                {
+                    "documents": [
+                        {"number": number, "relevant": True, "summary": response}
+                        for number in numbers
+                    ],
+                    "top_sentence": response,
+                }
+            )
+        return response
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return CompletionResponse(text=self._respond(prompt, **kwargs))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        text = self._respond(prompt, **kwargs)
+        yield CompletionResponse(text=text, delta=text)
@@ -0,0 +1,77 @@
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ddlh.redis_cache import RedisCache
+
+# Similarities are computed this many documents at a time, to keep the
+# similarity matrix small however many documents there are.
+SIMILARITY_BLOCK_SIZE = 512
+
+
+def document_embeddings(
+    chunks: Iterable[tuple[str, Sequence[float]]]
+) -> dict[str, NDArray[np.float32]]:
+    """
+    The unit length mean of the chunk embeddings of each document, given
+    the document id and embedding of every chunk.
+    """
+    sums: dict[str, NDArray[np.float32]] = {}
+    for doc_id, embedding in chunks:
+        vector = np.asarray(embedding, dtype=np.float32)
+        if doc_id in sums:
+            sums[doc_id] += vector
+        else:
+            sums[doc_id] = vector.copy()
+    embeddings = {}
+    for doc_id, total in sums.items():
+        norm = np.linalg.norm(total)
+        if norm > 0:
+            embeddings[doc_id] = total / norm
+    return embeddings
+
+
+class RelatedDocuments:
+    """
+    A table of the most similar documents to each document, by the cosine
+    similarity of their mean chunk embeddings.
+
+    The table is rebuilt from the chunk embeddings stored in the index, so
+    it never needs documents to be re-embedded or fetched.
+    """
+
+    def __init__(self, cache: RedisCache, limit: int):
+        self.cache = cache
+        self.limit = limit
+
+    def rebuild(
+        self, embeddings: dict[str, NDArray[np.float32]], doc_ids: list[str]
+    ) -> None:
+        """
+        Recompute the related documents of the given documents, among
+        themselves. Documents without an embedding are left out.
+        """
+        ids = [doc_id for doc_id in doc_ids if doc_id in embeddings]
+        vectors = [embeddings[doc_id] for doc_id in ids]
+        if not vectors or len({len(vector) for vector in vectors}) > 1:
+            return
+        matrix = np.stack(vectors)
+        limit = min(self.limit, len(ids) - 1)
+        related: list[list[str]] = []
+        for start in range(0, len(ids), SIMILARITY_BLOCK_SIZE):
+            similarities = matrix[start : start + SIMILARITY_BLOCK_SIZE] @ matrix.T
+            for row, similarity in enumerate(similarities):
+                similarity[start + row] = -np.inf
+                if limit <= 0:
+                    related.append([])
+                    continue
+                top = np.argpartition(-similarity, limit - 1)[:limit]
+                top = top[np.argsort(-similarity[top])]
+                related.append([ids[index] for index in top])
+        self.cache.store_many(
+            "related", [[doc_id] for doc_id in ids], related, expire=False
+        )
+
+    def get(self, doc_id: str) -> Optional[list[str]]:
+        return self.cache.get_if_cached("related", [doc_id])
@@ -0,0 +1,142 @@
+import re
+from threading import Lock
+from typing import Callable, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+from ddlh.rag.embeddings import pack_embedding, unpack_embedding
+from ddlh.redis_cache import RedisCache
+
+# Adds an answered query, numbered by the version it brings the cache to,
+# and evicts the least recently answered ones beyond the maximum, all at once
+# so that whoever sees a version also sees the query which brought it.
+ADD_SCRIPT = """
+local version = redis.call("INCR", KEYS[1])
+local max_queries = tonumber(ARGV[3])
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+redis.call("ZADD", KEYS[3], version, ARGV[1])
+local evicted = redis.call("ZRANGE", KEYS[3], 0, -max_queries - 1)
+if #evicted > 0 then
+  redis.call("ZREMRANGEBYRANK", KEYS[3], 0, -max_queries - 1)
+  redis.call("HDEL", KEYS[2], unpack(evicted))
+end
+return version
+"""
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(re.sub(r"[\W_]+", " ", query).split()).casefold()
+
+
+def _unit(vector: NDArray[np.float32]) -> Optional[NDArray[np.float32]]:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+
+class SemanticQueryCache:
+    """
+    Finds previously answered queries which mean the same as a new query.
+
+    Queries match when they are the same once normalized, or when the cosine
+    similarity of the embeddings of their normalized forms is at least
+    `threshold`. The embeddings of answered queries are kept in redis, and
+    in memory. Only the `max_queries` most recently answered queries are
+    kept, and each process only loads the queries answered since it last
+    looked, so memory, and the time taken to catch up with queries answered
+    by other processes, are bounded by `max_queries` whatever the traffic.
+    """
+
+    def __init__(self, cache: RedisCache, threshold: float, max_queries: int):
+        self.cache = cache
+        self.threshold = threshold
+        self.max_queries = max_queries
+        self._version = 0
+        self._queries: dict[str, tuple[int, list[float]]] = {}
+        self._normalized_queries: dict[str, str] = {}
+        self._embeddings: tuple[list[str], Optional[NDArray[np.float32]]] = ([], None)
+        self._lock = Lock()
+        self._add = cache.redis.register_script(ADD_SCRIPT)
+
+    def add(self, query: str, embed: Callable[[str], list[float]]) -> None:
+        embedding = _unit(np.asarray(embed(normalize_query(query)), np.float32))
+        if embedding is None:
+            return
+        self._add(
+            keys=[
+                self.cache.key("semantic", ["version"]),
+                self.cache.key("semantic", ["queries"]),
+                self.cache.key("semantic", ["order"]),
+            ],
+            args=[query, pack_embedding(embedding.tolist()), self.max_queries],
+        )
+
+    def find(self, query: str, embed: Callable[[str], list[float]]) -> Optional[str]:
+        """
+        The previously answered query most similar to the given one, if it
+        is similar enough.
+        """
+        self._reload()
+        normalized = normalize_query(query)
+        if normalized in self._normalized_queries:
+            return self._normalized_queries[normalized]
+        queries, embeddings = self._embeddings
+        if embeddings is None:
+            return None
+        embedding = _unit(np.asarray(embed(normalized), np.float32))
+        if embedding is None or embedding.shape[0] != embeddings.shape[1]:
+            return None
+        similarities = embeddings @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return queries[best]
+
+    def _reload(self) -> None:
+        version = int(self.cache.get_bytes("semantic", ["version"]) or 0)
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            if version < self._version:
+                # The cache was emptied since we last looked
+                self._version = 0
+                self._queries = {}
+            self._load_queries(version)
+            queries = list(self._queries)
+            vectors = [vector for _version, vector in self._queries.values()]
+            dimensions = {len(vector) for vector in vectors}
+            self._normalized_queries = {
+                normalize_query(query): query for query in queries
+            }
+            self._embeddings = (
+                queries,
+                np.asarray(vectors, np.float32) if len(dimensions) == 1 else None,
+            )
+            self._version = version
+
+    def _load_queries(self, version: int) -> None:
+        redis = self.cache.redis
+        added = redis.zrangebyscore(
+            self.cache.key("semantic", ["order"]),
+            f"({self._version}",
+            version,
+            withscores=True,
+        )
+        if not added:
+            return
+        values = redis.hmget(
+            self.cache.key("semantic", ["queries"]), [query for query, _ in added]
+        )
+        for (query, query_version), value in zip(added, values):
+            if value is not None:
+                self._queries[query.decode("UTF-8")] = (
+                    int(query_version),
+                    unpack_embedding(value),
+                )
+        if len(self._queries) > self.max_queries:
+            latest = sorted(
+                self._queries.items(), key=lambda item: item[1][0], reverse=True
+            )
+            self._queries = dict(latest[: self.max_queries])
@@ -0,0 +1,176 @@
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Generic, NamedTuple, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class ConcurrentSummarizer(Generic[T, R]):
+    """
+    Summarizes ranked candidates concurrently, keeping the first `limit`
+    relevant summaries in rank order.
+
+    At most `concurrency` summaries are generated at once. Once enough
+    relevant summaries have been found, summaries which haven't started are
+    cancelled and those still running are abandoned. A summary which takes
+    longer than `timeout` seconds from when it started is skipped.
+
+    Summaries which are skipped or abandoned are not cancelled: their LLM
+    calls run on to the end, or to the LLM client's own timeout, holding
+    whatever `summarize` holds, such as a lock on the summary's cache entry,
+    and their results are still cached for the next query.
+
+    Relevant summaries are passed to `on_relevant` as soon as they are known
+    to be part of the result, so they can be shown before the rest are done.
+    """
+
+    def __init__(self, concurrency: int, timeout: Optional[float] = None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def first_relevant(
+        self,
+        candidates: list[T],
+        summarize: Callable[[T], R],
+        is_relevant: Callable[[R], bool],
+        limit: int,
+        on_relevant: Optional[Callable[[T, R], None]] = None,
+    ) -> list[tuple[T, R]]:
+        if limit <= 0 or not candidates:
+            return []
+        started: list[Optional[float]] = [None] * len(candidates)
+
+        def run(index: int) -> R:
+            started[index] = time.monotonic()
+            return summarize(candidates[index])
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            futures: list[Future[R]] = [
+                executor.submit(run, index) for index in range(len(candidates))
+            ]
+            summaries: list[tuple[T, R]] = []
+            for index, (candidate, future) in enumerate(zip(candidates, futures)):
+                try:
+                    summary = self._result(future, lambda: started[index])
+                except FutureTimeoutError:
+                    future.cancel()
+                    continue
+                if is_relevant(summary):
+                    summaries.append((candidate, summary))
+                    if on_relevant is not None:
+                        on_relevant(candidate, summary)
+                    if len(summaries) >= limit:
+                        break
+            return summaries
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _result(self, future: Future[R], started: Callable[[], Optional[float]]) -> R:
+        """
+        Wait for the result of a summary until `timeout` seconds after it
+        started, however long it waited for a free worker.
+        """
+        if self.timeout is None:
+            return future.result()
+        while True:
+            start = started()
+            if start is None:
+                remaining = self.timeout
+            else:
+                remaining = start + self.timeout - time.monotonic()
+            try:
+                return future.result(timeout=max(remaining, 0))
+            except FutureTimeoutError:
+                if start is not None:
+                    raise
+
+
+class BatchedSummary(NamedTuple):
+    top_sentence: str
+    summaries: list[tuple[int, str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A rough estimate of the number of tokens in a text, at about four
+    characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+class BatchedSummarizer:
+    """
+    Summarizes every candidate and the whole query in one LLM call, asking
+    for the result as JSON.
+
+    The context holds as many chunks as fit in `context_tokens`, taking the
+    first chunk of each candidate in rank order, then their second chunks,
+    and so on, so that the best candidates are all represented. Candidates
+    without any chunk in the context are left out.
+    """
+
+    def __init__(self, complete: Callable[[str], str], context_tokens: int):
+        self.complete = complete
+        self.context_tokens = context_tokens
+
+    def summarize(
+        self, prompt_template: str, query: str, candidates: list[list[str]]
+    ) -> Optional[BatchedSummary]:
+        """
+        Summarize the candidates, given as lists of chunk texts. Returns the
+        relevant summaries in rank order, each with the index of its
+        candidate, or None if the LLM's answer isn't valid.
+        """
+        excerpts = self._select_excerpts(candidates)
+        if not excerpts:
+            return None
+        context = "\n\n".join(
+            f"Document {index + 1}:\n" + "\n...\n".join(chunks)
+            for index, chunks in sorted(excerpts.items())
+        )
+        output = self.complete(prompt_template.format(query=query, context=context))
+        return self._parse(output, set(excerpts))
+
+    def _select_excerpts(self, candidates: list[list[str]]) -> dict[int, list[str]]:
+        excerpts: dict[int, list[str]] = {}
+        budget = self.context_tokens
+        depth = 0
+        while any(depth < len(chunks) for chunks in candidates):
+            for index, chunks in enumerate(candidates):
+                if depth >= len(chunks):
+                    continue
+                tokens = estimate_tokens(chunks[depth])
+                if tokens > budget:
+                    return excerpts
+                budget -= tokens
+                excerpts.setdefault(index, []).append(chunks[depth])
+            depth += 1
+        return excerpts
+
+    def _parse(self, output: str, indexes: set[int]) -> Optional[BatchedSummary]:
+        try:
+            result = json.loads(output[output.index("{") : output.rindex("}") + 1])
+        except ValueError:
+            return None
+        if not isinstance(result, dict):
+            return None
+        top_sentence = result.get("top_sentence")
+        documents = result.get("documents")
+        if not isinstance(top_sentence, str) or not isinstance(documents, list):
+            return None
+        summaries: dict[int, str] = {}
+        for document in documents:
+            if not isinstance(document, dict):
+                return None
+            number = document.get("number")
+            summary = document.get("summary")
+            if not isinstance(number, int) or number - 1 not in indexes:
+                return None
+            if document.get("relevant") is True and isinstance(summary, str):
+                if summary.strip():
+                    summaries.setdefault(number - 1, summary.strip())
+        return BatchedSummary(top_sentence.strip(), sorted(summaries.items()))
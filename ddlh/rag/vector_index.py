@@ -0,0 +1,157 @@
+import json
+import os
+import struct
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Any, NamedTuple, Optional
+
+import numpy as np
+from llama_index.core.schema import BaseNode, NodeWithScore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from numpy.typing import NDArray
+
+VECTOR_INDEX_MAGIC = b"DDLHVEC1"
+VECTOR_INDEX_HEADER = struct.Struct("<8sQQQ")
+# The embeddings matrix starts on a boundary of this many bytes.
+VECTOR_INDEX_ALIGNMENT = 64
+
+
+class VectorIndexError(ValueError):
+    pass
+
+
+class IndexedChunk(NamedTuple):
+    node_id: str
+    text: str
+    metadata: dict[str, Any]
+
+
+class LoadedVectorIndex(NamedTuple):
+    file_id: tuple[int, int, int]
+    chunks: list[IndexedChunk]
+    embeddings: NDArray[np.float32]
+
+
+def write_vector_index(
+    path: str, chunks: list[IndexedChunk], embeddings: NDArray[np.float32]
+) -> None:
+    """
+    Write chunks and their embeddings to a file, replacing it atomically.
+
+    The file holds a header, the chunks as JSON, and the unit length
+    embeddings as a little-endian float32 matrix which can be memory-mapped.
+    """
+    matrix = np.asarray(embeddings, dtype="<f4").reshape(len(chunks), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms > 0, norms, 1)
+    metadata = json.dumps([list(chunk) for chunk in chunks]).encode("UTF-8")
+    offset = VECTOR_INDEX_HEADER.size + len(metadata)
+    padding = -offset % VECTOR_INDEX_ALIGNMENT
+    directory = os.path.dirname(os.path.abspath(path))
+    with NamedTemporaryFile(dir=directory, delete=False) as file:
+        file.write(
+            VECTOR_INDEX_HEADER.pack(
+                VECTOR_INDEX_MAGIC, matrix.shape[0], matrix.shape[1], len(metadata)
+            )
+        )
+        file.write(metadata)
+        file.write(b"\0" * padding)
+        file.write(matrix.astype("<f4").tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(file.name, path)
+
+
+class LocalVectorIndex:
+    """
+    Answers nearest neighbour queries from the file written by
+    `write_vector_index`, with a single matrix product.
+
+    The embeddings are memory-mapped read-only, so every worker on a machine
+    shares the same pages. The file is reloaded when it is replaced.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._loaded: Optional[LoadedVectorIndex] = None
+        self._lock = Lock()
+
+    def query(
+        self, embedding: list[float], top_k: int
+    ) -> Optional[list[NodeWithScore]]:
+        """
+        The `top_k` chunks most similar to the embedding, or None when there
+        is no usable index file.
+        """
+        loaded = self._load()
+        if loaded is None or not loaded.chunks:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape != (loaded.embeddings.shape[1],):
+            return None
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        scores = loaded.embeddings @ query
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            NodeWithScore(
+                node=self._node(loaded.chunks[index]), score=float(scores[index])
+            )
+            for index in top
+        ]
+
+    def _node(self, chunk: IndexedChunk) -> BaseNode:
+        node = metadata_dict_to_node(chunk.metadata, text=chunk.text)
+        node.id_ = chunk.node_id
+        return node
+
+    def _load(self) -> Optional[LoadedVectorIndex]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        loaded = self._loaded
+        if loaded is not None and loaded.file_id == file_id:
+            return loaded
+        with self._lock:
+            if self._loaded is None or self._loaded.file_id != file_id:
+                try:
+                    self._loaded = self._read(file_id)
+                except VectorIndexError:
+                    self._loaded = None
+            return self._loaded
+
+    def _read(self, file_id: tuple[int, int, int]) -> LoadedVectorIndex:
+        with open(self.path, "rb") as file:
+            header = file.read(VECTOR_INDEX_HEADER.size)
+            try:
+                magic, rows, dimensions, metadata_length = VECTOR_INDEX_HEADER.unpack(
+                    header
+                )
+            except struct.error as e:
+                raise VectorIndexError("Truncated vector index") from e
+            if magic != VECTOR_INDEX_MAGIC:
+                raise VectorIndexError("Unsupported vector index format")
+            try:
+                chunks = [
+                    IndexedChunk(*chunk)
+                    for chunk in json.loads(file.read(metadata_length))
+                ]
+            except (ValueError, TypeError) as e:
+                raise VectorIndexError("Corrupt vector index") from e
+        offset = VECTOR_INDEX_HEADER.size + metadata_length
+        offset += -offset % VECTOR_INDEX_ALIGNMENT
+        if len(chunks) != rows or file_id[2] < offset + rows * dimensions * 4:
+            raise VectorIndexError("Truncated vector index")
+        if rows == 0:
+            return LoadedVectorIndex(file_id, [], np.zeros((0, dimensions), "<f4"))
+        embeddings = np.memmap(
+            self.path, dtype="<f4", mode="r", offset=offset, shape=(rows, dimensions)
+        )
+        return LoadedVectorIndex(file_id, chunks, embeddings)
@@ -0,0 +1,80 @@
+from time import sleep
+
+import redis
+
+# Both scripts use the redis server clock, so that every process sharing a
+# bucket agrees on how many tokens have been refilled.
+ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at", "blocked_until")
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+local blocked_until = tonumber(state[3]) or 0
+if now < blocked_until then
+  return tostring(blocked_until - now)
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+PENALIZE_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local blocked_until = now + tonumber(ARGV[1])
+local current = tonumber(redis.call("HGET", KEYS[1], "blocked_until")) or 0
+if blocked_until > current then
+  redis.call(
+    "HSET", KEYS[1],
+    "tokens", 0, "updated_at", blocked_until, "blocked_until", blocked_until
+  )
+  redis.call("EXPIRE", KEYS[1], math.ceil(tonumber(ARGV[1])) + 1)
+end
+return tostring(math.max(blocked_until, current) - now)
+"""
+
+
+class RedisTokenBucket:
+    """
+    A token bucket rate limiter whose state lives in redis, so that it is
+    shared by every greenlet, web worker and celery worker using the same key.
+    """
+
+    def __init__(
+        self, redis: "redis.Redis[bytes]", key: str, rate: float, capacity: int
+    ):
+        self.redis = redis
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self._acquire = redis.register_script(ACQUIRE_SCRIPT)
+        self._penalize = redis.register_script(PENALIZE_SCRIPT)
+
+    def try_acquire(self) -> float:
+        """
+        Take a token if one is available, returning 0. Otherwise, return
+        the number of seconds to wait before trying again.
+        """
+        wait = self._acquire(keys=[self.key], args=[self.rate, self.capacity])
+        return float(wait)
+
+    def acquire(self) -> None:
+        while (wait := self.try_acquire()) > 0:
+            sleep(wait)
+
+    def penalize(self, seconds: float) -> None:
+        """
+        Stop handing out tokens to anyone for the given number of seconds,
+        for instance after the remote API has told us to back off.
+        """
+        self._penalize(keys=[self.key], args=[seconds])
@@ -1,9 +1,16 @@
-import json
 import os
 from dataclasses import dataclass
-from typing import Any, Callable, Optional, TypeVar
+from threading import Thread
+from typing import Any, Callable, Optional, TypeVar, cast
 
+import more_itertools as mit
 import redis
+from redis.client import Pipeline, PubSubWorkerThread
+from redis.exceptions import LockError
+from redis.lock import Lock
+
+from ddlh.codecs import CodecError, ValueCodec
+from ddlh.local_cache import LocalCache
 
 
 @dataclass
@@ -11,15 +18,69 @@ class RedisCacheConfig:
     redis_url: str
     prefix: str
     timeout: Optional[int]
+    stale_timeout: Optional[int] = None
+    lock_timeout: int = 60
+    local_max_bytes: int = 0
+    local_timeout: Optional[int] = None
+    codec: str = "json"
+    compression: str = "none"
+    compression_threshold: int = 1024
 
 
 T = TypeVar("T")
 
+# Cache prefixes of more than one word, which splitting keys on underscores
+# would take the first word of.
+COMPOUND_PREFIXES = ["document_summary", "rate_limit"]
+
+
+def _key_prefix(key: str) -> str:
+    for prefix in COMPOUND_PREFIXES:
+        if key.startswith(prefix + "_"):
+            return prefix
+    return key.split("_")[0]
+
 
 class RedisCache:
+    """
+    Caches JSON-serializable values in redis.
+
+    Values are fresh for `timeout` seconds, then served stale for a further
+    `stale_timeout` seconds while a single caller recomputes them in the
+    background. On a miss, only the caller holding a redis lock computes the
+    value, while other callers wait up to `lock_timeout` seconds for it to
+    appear before giving up and computing it themselves.
+
+    When `local_max_bytes` is set, fresh values are also kept, deserialized,
+    in an in-process LRU of roughly that size for up to `local_timeout`
+    seconds, and no longer than `timeout` seconds. That time counts from
+    when the value is copied locally, so a local copy can outlive its
+    freshness in redis by up to that long. Every write publishes the
+    written key on a redis channel, which every process listens to in order
+    to drop its local copy.
+
+    Values are encoded with the configured codec and compression (see
+    `ddlh.codecs`), and can be decoded whatever the configuration they
+    were written with.
+    """
+
     def __init__(self, config: RedisCacheConfig):
         self.config = config
         self.redis = redis.from_url(config.redis_url)
+        self.codec = ValueCodec(
+            config.codec, config.compression, config.compression_threshold
+        )
+        self.local: Optional[LocalCache] = None
+        self._pubsub: Optional[PubSubWorkerThread] = None
+        if config.local_max_bytes > 0:
+            local_timeouts = [
+                timeout
+                for timeout in [config.timeout, config.local_timeout]
+                if timeout is not None
+            ]
+            self.local = LocalCache(
+                config.local_max_bytes, min(local_timeouts, default=None)
+            )
 
     def cached(
         self,
@@ -29,21 +90,105 @@ class RedisCache:
         serializer: Optional[Callable[[T], dict[str, Any]]] = None,
         deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
     ) -> T:
-        key = self._get_key(prefix, args)
-        cached_value = self.get_if_cached(prefix, args, deserializer)
+        key = self.key(prefix, args)
+        cached_value, fresh = self._get_with_freshness(key, deserializer)
         if cached_value is not None:
+            if not fresh:
+                lock = self._lock(key)
+                if lock.acquire(blocking=False):
+                    Thread(
+                        target=self._refresh,
+                        args=(lock, prefix, args, func, serializer),
+                        daemon=True,
+                    ).start()
             return cached_value
+
+        lock = self._lock(key)
+        if lock.acquire(blocking_timeout=self.config.lock_timeout):
+            try:
+                cached_value = self.get_if_cached(prefix, args, deserializer)
+                if cached_value is not None:
+                    return cached_value
+                value = func(*args)
+                self.store(prefix, args, value, serializer)
+                return value
+            finally:
+                self._release(lock)
         else:
-            value = func(*args)
-            if serializer:
-                serialized_value = serializer(value)
-                json_value = json.dumps(serialized_value)
-            else:
-                json_value = json.dumps(value)
-            self.redis.set(key, json_value)
-            if self.config.timeout is not None:
-                self.redis.expire(key, self.config.timeout)
-            return value
+            cached_value = self.get_if_cached(prefix, args, deserializer)
+            if cached_value is not None:
+                return cached_value
+            return func(*args)
+
+    def cached_many(
+        self,
+        prefix: str,
+        args_list: list[list[str]],
+        func: Callable[..., T],
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+        deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
+        batch_func: Optional[Callable[[list[list[str]]], list[T]]] = None,
+    ) -> list[T]:
+        """
+        Look up many values with a single MGET, computing only the missing
+        ones and storing them with a single pipeline. When given a
+        `batch_func`, it is called once with the args of every missing value,
+        and must return their values in the same order; otherwise `func` is
+        called for each missing value.
+
+        Stale values are returned, and refreshed in the background. Unlike
+        `cached`, concurrent misses are not coordinated between callers.
+        """
+        keys = [self.key(prefix, args) for args in args_list]
+        cached_values = self._get_many_with_freshness(keys, deserializer)
+        values = [value for (value, _fresh) in cached_values]
+        missing = [i for (i, value) in enumerate(values) if value is None]
+        stale = [
+            args_list[i]
+            for (i, (value, fresh)) in enumerate(cached_values)
+            if value is not None and not fresh
+        ]
+        if missing:
+            missing_args = [args_list[i] for i in missing]
+            computed = self._compute_many(missing_args, func, batch_func)
+            self.store_many(prefix, missing_args, computed, serializer)
+            for i, value in zip(missing, computed):
+                values[i] = value
+        if stale:
+            Thread(
+                target=self._refresh_many,
+                args=(prefix, stale, func, serializer, batch_func),
+                daemon=True,
+            ).start()
+        return cast(list[T], values)
+
+    def store(
+        self,
+        prefix: str,
+        args: list[str],
+        value: T,
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+        expire: bool = True,
+    ) -> None:
+        with self.redis.pipeline() as pipeline:
+            self._write(pipeline, self.key(prefix, args), value, serializer, expire)
+            pipeline.execute()
+        self._invalidate_local(self.key(prefix, args))
+
+    def store_many(
+        self,
+        prefix: str,
+        args_list: list[list[str]],
+        values: list[T],
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+        expire: bool = True,
+    ) -> None:
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for args, value in zip(args_list, values):
+                self._write(pipeline, self.key(prefix, args), value, serializer, expire)
+            pipeline.execute()
+        for args in args_list:
+            self._invalidate_local(self.key(prefix, args))
 
     def get_if_cached(
         self,
@@ -51,24 +196,269 @@ class RedisCache:
         args: list[str],
         deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
     ) -> Optional[T]:
-        key = self._get_key(prefix, args)
-        cached_value = self.redis.get(key)
-        if cached_value is not None:
-            json_value = json.loads(cached_value)
-            if deserializer:
-                deserialized = deserializer(json_value)
+        return self._get_with_freshness(self.key(prefix, args), deserializer)[0]
+
+    def get_many(
+        self,
+        prefix: str,
+        args_list: list[list[str]],
+        deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
+    ) -> list[Optional[T]]:
+        keys = [self.key(prefix, args) for args in args_list]
+        return [
+            value
+            for (value, _fresh) in self._get_many_with_freshness(keys, deserializer)
+        ]
+
+    def _get_with_freshness(
+        self,
+        key: str,
+        deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
+    ) -> tuple[Optional[T], bool]:
+        return self._get_many_with_freshness([key], deserializer)[0]
+
+    def _get_many_with_freshness(
+        self,
+        keys: list[str],
+        deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
+    ) -> list[tuple[Optional[T], bool]]:
+        results: dict[str, tuple[Optional[T], bool]] = {}
+        if self.local is not None:
+            self._subscribe()
+            for key in keys:
+                local_value = self.local.get(key)
+                if local_value is not None:
+                    results[key] = (local_value, True)
+            generation = self.local.generation
+        remote_keys = [key for key in keys if key not in results]
+        if remote_keys:
+            if self.config.timeout is None:
+                cached_values = self.redis.mget(remote_keys)
+                fresh_markers: list[Any] = [True] * len(remote_keys)
             else:
-                deserialized = json_value
-            return deserialized
+                fresh_keys = [self._fresh_key(key) for key in remote_keys]
+                values = self.redis.mget(remote_keys + fresh_keys)
+                cached_values = values[: len(remote_keys)]
+                fresh_markers = values[len(remote_keys) :]
+            for key, cached_value, marker in zip(
+                remote_keys, cached_values, fresh_markers
+            ):
+                value = self._decode(cached_value, deserializer)
+                fresh = marker is not None
+                if self.local is not None and value is not None and fresh:
+                    size = len(cast(bytes, cached_value))
+                    self.local.set(key, value, size, generation)
+                results[key] = (value, fresh)
+        return [results[key] for key in keys]
+
+    def _write(
+        self,
+        pipeline: "Pipeline[bytes]",
+        key: str,
+        value: T,
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+        expire: bool = True,
+    ) -> None:
+        encoded_value = self._encode(value, serializer)
+        timeout = self.config.timeout
+        if expire and timeout is not None:
+            pipeline.set(key, encoded_value, ex=timeout + self._stale_timeout())
+            pipeline.set(self._fresh_key(key), 1, ex=timeout)
         else:
+            pipeline.set(key, encoded_value)
+        if self.local is not None:
+            pipeline.publish(self._invalidation_channel(), key)
+
+    def _encode(
+        self,
+        value: T,
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+    ) -> bytes:
+        if serializer:
+            return self.codec.encode(serializer(value))
+        return self.codec.encode(value)
+
+    def _decode(
+        self,
+        cached_value: Optional[bytes],
+        deserializer: Optional[Callable[[dict[str, Any]], T]] = None,
+    ) -> Optional[T]:
+        if cached_value is None:
+            return None
+        try:
+            decoded_value = self.codec.decode(cached_value)
+        except CodecError:
+            # Written by a process with codecs we don't have:
+            # treat it as a miss, so that it gets recomputed
             return None
+        if deserializer:
+            return deserializer(decoded_value)
+        return cast(T, decoded_value)
+
+    def _compute_many(
+        self,
+        args_list: list[list[str]],
+        func: Callable[..., T],
+        batch_func: Optional[Callable[[list[list[str]]], list[T]]] = None,
+    ) -> list[T]:
+        if batch_func:
+            return batch_func(args_list)
+        return [func(*args) for args in args_list]
+
+    def _refresh(
+        self,
+        lock: Lock,
+        prefix: str,
+        args: list[str],
+        func: Callable[..., T],
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+    ) -> None:
+        try:
+            self.store(prefix, args, func(*args), serializer)
+        finally:
+            self._release(lock)
+
+    def _refresh_many(
+        self,
+        prefix: str,
+        args_list: list[list[str]],
+        func: Callable[..., T],
+        serializer: Optional[Callable[[T], dict[str, Any]]] = None,
+        batch_func: Optional[Callable[[list[list[str]]], list[T]]] = None,
+    ) -> None:
+        locked = []
+        for args in args_list:
+            lock = self._lock(self.key(prefix, args))
+            if lock.acquire(blocking=False):
+                locked.append((args, lock))
+        try:
+            if locked:
+                locked_args = [args for (args, _lock) in locked]
+                values = self._compute_many(locked_args, func, batch_func)
+                self.store_many(prefix, locked_args, values, serializer)
+        finally:
+            for _args, lock in locked:
+                self._release(lock)
+
+    def _subscribe(self) -> None:
+        if self._pubsub is None:
+            pubsub = self.redis.pubsub()
+            pubsub.subscribe(**{self._invalidation_channel(): self._on_invalidation})
+            self._pubsub = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def _on_invalidation(self, message: dict[str, Any]) -> None:
+        if self.local is not None:
+            self.local.invalidate(message["data"].decode("UTF-8"))
+
+    def _invalidate_local(self, key: str) -> None:
+        if self.local is not None:
+            self.local.invalidate(key)
+
+    def _invalidation_channel(self) -> str:
+        return f"{self.config.prefix}:invalidate"
+
+    def _lock(self, key: str) -> Lock:
+        return self.redis.lock(f"{key}:lock", timeout=self.config.lock_timeout)
+
+    def _release(self, lock: Lock) -> None:
+        try:
+            lock.release()
+        except LockError:
+            # The lock expired while computing the value, and might
+            # now be held by someone else
+            pass
+
+    def _fresh_key(self, key: str) -> str:
+        return f"{key}:fresh"
+
+    def _stale_timeout(self) -> int:
+        return self.config.stale_timeout or 0
+
+    def size_metrics(self) -> dict[str, dict[str, int]]:
+        """
+        Count the keys stored under each cache prefix (such as "all",
+        "get" or "query"), and the bytes taken up by their values. The
+        values of hashes and sorted sets are counted as the bytes of their
+        fields and members.
+        """
+        metrics: dict[str, dict[str, int]] = {}
+        namespace = self.config.prefix + "_"
+        keys = [
+            key.decode("UTF-8")
+            for key in self.redis.scan_iter(match=namespace + "*", count=1000)
+            if b":" not in key
+        ]
+        for chunk in mit.chunked(keys, 1000):
+            for key, size in zip(chunk, self._value_sizes(chunk)):
+                prefix = _key_prefix(key[len(namespace) :])
+                prefix_metrics = metrics.setdefault(prefix, {"keys": 0, "bytes": 0})
+                prefix_metrics["keys"] += 1
+                prefix_metrics["bytes"] += size
+        return metrics
+
+    def _value_sizes(self, keys: list[str]) -> list[int]:
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.type(key)
+            key_types = pipeline.execute()
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for key, key_type in zip(keys, key_types):
+                if key_type == b"string":
+                    pipeline.strlen(key)
+                elif key_type == b"hash":
+                    pipeline.hgetall(key)
+                elif key_type == b"zset":
+                    pipeline.zrange(key, 0, -1)
+            values = iter(pipeline.execute())
+        sizes = []
+        for key_type in key_types:
+            if key_type == b"string":
+                sizes.append(next(values))
+            elif key_type == b"hash":
+                sizes.append(sum(map(len, mit.flatten(next(values).items()))))
+            elif key_type == b"zset":
+                sizes.append(sum(map(len, next(values))))
+            else:
+                sizes.append(0)
+        return sizes
+
+    def get_bytes(self, prefix: str, args: list[str]) -> Optional[bytes]:
+        return self.redis.get(self.key(prefix, args))
+
+    def set_bytes(self, prefix: str, args: list[str], value: bytes) -> None:
+        self.redis.set(self.key(prefix, args), value, ex=self.config.timeout)
+
+    def increment(self, prefix: str, args: list[str]) -> int:
+        return self.redis.incr(self.key(prefix, args))
 
-    def _get_key(self, prefix: str, args: list[str]) -> str:
+    def key(self, prefix: str, args: list[str]) -> str:
         return "_".join([self.config.prefix, prefix] + args)
 
 
-def create_cache(prefix: str, timeout: Optional[int] = None) -> RedisCache:
+def create_cache(
+    prefix: str,
+    timeout: Optional[int] = None,
+    stale_timeout: Optional[int] = None,
+    lock_timeout: Optional[int] = None,
+) -> RedisCache:
     config = RedisCacheConfig(
-        redis_url=os.environ["REDIS_URL"], prefix=prefix, timeout=timeout
+        redis_url=os.environ["REDIS_URL"],
+        prefix=prefix,
+        timeout=timeout,
+        stale_timeout=stale_timeout,
     )
+    if lock_timeout is not None:
+        config.lock_timeout = lock_timeout
+    if "REDIS_LOCAL_CACHE_MAX_BYTES" in os.environ:
+        config.local_max_bytes = int(os.environ["REDIS_LOCAL_CACHE_MAX_BYTES"])
+    if "REDIS_LOCAL_CACHE_TIMEOUT" in os.environ:
+        config.local_timeout = int(os.environ["REDIS_LOCAL_CACHE_TIMEOUT"])
+    if "REDIS_CACHE_CODEC" in os.environ:
+        config.codec = os.environ["REDIS_CACHE_CODEC"]
+    if "REDIS_CACHE_COMPRESSION" in os.environ:
+        config.compression = os.environ["REDIS_CACHE_COMPRESSION"]
+    if "REDIS_CACHE_COMPRESSION_THRESHOLD" in os.environ:
+        config.compression_threshold = int(
+            os.environ["REDIS_CACHE_COMPRESSION_THRESHOLD"]
+        )
     return RedisCache(config)
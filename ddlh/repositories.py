@@ -1,49 +1,149 @@
+import os
+import pickle
+import struct
+import zlib
 from collections import OrderedDict, defaultdict
-from typing import Optional, cast
+from dataclasses import fields
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Optional, cast
 
 import more_itertools as mit
 from pyairtable.api.types import RecordDict
 from pydash import _
 
+from . import airtable as airtable_db
 from .airtable import AirtableDB
 from .models import Document, Stats, Theme
-from .utils import url_to_id
+from .redis_cache import RedisCache, create_cache
+from .utils import compact, url_to_id
+
+SNAPSHOT_MAGIC = b"DDLHREPO"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct(">8sHQ")
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def snapshot_version(snapshot: bytes) -> int:
+    try:
+        magic, format_version, version = SNAPSHOT_HEADER.unpack_from(snapshot)
+    except struct.error as e:
+        raise SnapshotError("Truncated repository snapshot") from e
+    if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotError("Unsupported repository snapshot format")
+    return cast(int, version)
 
 
 class DocumentsRepository:
 
-    def __init__(self, airtable: AirtableDB):
-        self.airtable: AirtableDB = airtable
+    def __init__(self, airtable: Optional[AirtableDB], version: int = 0):
+        self.airtable: Optional[AirtableDB] = airtable
+        self.version = version
         self.documents: dict[str, Document] = {}
         self.featured_document_ids: list[str] = []
+        self.featured_ids: list[str] = []
         self.airtable_ids_to_ids: dict[str, str] = {}
         self.themes: OrderedDict[str, Theme] = OrderedDict()
+        self.themes_by_name: dict[str, Theme] = {}
         self.tags: dict[str, list[str]] = defaultdict(list)
         self.authors: set[str] = set()
         self.by_format_type: dict[str, list[str]] = defaultdict(list)
+        self.formats: dict[str, dict[str, Any]] = {}
+        self.stats = Stats.from_dict()
+
+        if airtable is not None:
+            self._ingest(airtable)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: bytes) -> "DocumentsRepository":
+        repository = cls(None, version=snapshot_version(snapshot))
+        try:
+            state = pickle.loads(zlib.decompress(snapshot[SNAPSHOT_HEADER.size :]))
+        except (zlib.error, pickle.UnpicklingError, EOFError) as e:
+            raise SnapshotError("Corrupt repository snapshot") from e
+        document_fields = state["document_fields"]
+        for values in state["documents"]:
+            document = Document.from_dict(**dict(zip(document_fields, values)))
+            repository.documents[document.id] = document
+        for id, name, summary, documents, tags in state["themes"]:
+            theme = Theme(name=name, summary=summary, documents=documents, tags=tags)
+            repository.themes[id] = theme
+            repository.themes_by_name.setdefault(name, theme)
+        repository.tags.update(state["tags"])
+        repository.by_format_type.update(state["by_format_type"])
+        repository.featured_ids = state["featured_ids"]
+        repository.stats = Stats.from_dict(**state["stats"])
+        return repository
 
-        for row in self.airtable.all("featured_documents"):
+    def to_snapshot(self) -> bytes:
+        document_fields = [f.name for f in fields(Document)]
+        state = {
+            "document_fields": document_fields,
+            "documents": [
+                tuple(getattr(document, name) for name in document_fields)
+                for document in self.documents.values()
+            ],
+            "themes": [
+                (id, theme.name, theme.summary, theme.documents, theme.tags)
+                for id, theme in self.themes.items()
+            ],
+            "tags": dict(self.tags),
+            "by_format_type": dict(self.by_format_type),
+            "featured_ids": self.featured_ids,
+            "stats": self.stats.asdict(),
+        }
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, self.version
+        )
+        return header + zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    def _ingest(self, airtable: AirtableDB) -> None:
+        for row in airtable.all("formats"):
+            self._ingest_format(row)
+
+        for row in airtable.all("featured_documents"):
             self._ingest_featured_document(row)
 
-        for row in self.airtable.all("themes"):
+        for row in airtable.all("themes"):
             self._ingest_theme(row)
 
-        for row in self.airtable.all("documents"):
+        for row in airtable.all("documents"):
             self._ingest_document(row)
 
+        for theme in self.themes.values():
+            self.themes_by_name.setdefault(theme.name, theme)
+
+        self.featured_ids = compact(
+            [self.airtable_ids_to_ids.get(id) for id in self.featured_document_ids]
+        )
+
+        self.stats = Stats(
+            total_documents=len(self.documents),
+            total_themes=len(self.themes),
+            total_text_format=len(self.by_format_type["text"]),
+            total_audiovisual_format=len(self.by_format_type["audiovisual"]),
+            total_tool_format=len(self.by_format_type["tool"]),
+            total_course_format=len(self.by_format_type["course"]),
+            total_unique_authors=len(self.authors),
+        )
+
     def _ingest_featured_document(self, row: RecordDict) -> None:
         airtable_id = _.get(row, "fields.document.0")
         if airtable_id:
             self.featured_document_ids.append(airtable_id)
 
     def _ingest_document(self, row: RecordDict) -> None:
-        document = row["fields"]
+        document = dict(row["fields"])
         if document.get("live"):
+            id = url_to_id(document["link"])
             theme_names = []
             for theme_id in document.get("themes", []):
                 theme = self.themes.get(theme_id)
                 if theme:
-                    theme.documents.append(document["link"])
+                    theme.documents.append(id)
                     theme.tags.update(document.get("tags", []))
                     theme_names.append(theme.name)
             document["themes"] = theme_names
@@ -51,23 +151,25 @@ class DocumentsRepository:
             if "tags" not in document:
                 document["tags"] = []
             for tag in document["tags"]:
-                self.tags[tag].append(document["link"])
+                self.tags[tag].append(id)
 
             format_id = mit.nth(document.get("format", []), 0)
             if format_id is not None:
-                format = _.get(self.airtable.get("formats", format_id), "fields")
+                format = self.formats.get(format_id)
                 if format is not None and format.get("live"):
                     document["format"] = format["name"]
                     document["format_type"] = format["type"]
-                    self.by_format_type[format["type"]].append(document["link"])
+                    self.by_format_type[format["type"]].append(id)
 
             if "author" in document:
                 self.authors.add(document["author"])
 
-            id = url_to_id(document["link"])
             self.airtable_ids_to_ids[row["id"]] = id
             self.documents[id] = Document.from_dict(**document)
 
+    def _ingest_format(self, row: RecordDict) -> None:
+        self.formats[row["id"]] = row["fields"]
+
     def _ingest_theme(self, row: RecordDict) -> None:
         fields = row["fields"]
         if fields.get("live"):
@@ -86,58 +188,137 @@ class DocumentsRepository:
         return list(self.tags.keys())
 
     def get_all_themes(self) -> list[str]:
-        return [theme.name for theme in self.themes.values()]
+        return list(self.themes_by_name.keys())
 
     def get_documents_for_tag(self, tag: str) -> list[Document]:
-        return [self.documents[url_to_id(link)] for link in self.tags[tag]]
+        return [self.documents[id] for id in self.tags.get(tag, [])]
 
     def get_documents_for_theme(self, theme_name: str) -> list[Document]:
-        for theme in self.themes.values():
-            if theme_name == theme.name:
-                return [self.documents[url_to_id(link)] for link in theme.documents]
+        theme = self.themes_by_name.get(theme_name)
+        if theme:
+            return [self.documents[id] for id in theme.documents]
         return []
 
     def get_documents_for_format_type(self, format_type: str) -> list[Document]:
-        if format_type in self.by_format_type:
-            return [
-                self.documents[url_to_id(link)]
-                for link in self.by_format_type[format_type]
-            ]
-        return []
+        return [self.documents[id] for id in self.by_format_type.get(format_type, [])]
 
     def get_tags_for_theme(self, theme_name: str) -> list[str]:
-        for theme in self.themes.values():
-            if theme_name == theme.name:
-                return list(theme.tags)
+        theme = self.themes_by_name.get(theme_name)
+        if theme:
+            return list(theme.tags)
         return []
 
     def get_theme(self, theme_name: str) -> Optional[Theme]:
-        for theme in self.themes.values():
-            if theme_name == theme.name:
-                return theme
-        return None
+        return self.themes_by_name.get(theme_name)
 
     def get_document(self, id: str) -> Optional[Document]:
         return self.documents.get(id)
 
+    def has_document(self, id: str) -> bool:
+        return id in self.documents
+
     def get_featured_documents(self) -> list[Document]:
-        return cast(
-            list[Document],
-            _.compact(
-                [
-                    self.get_document(self.airtable_ids_to_ids[id])
-                    for id in self.featured_document_ids
-                ]
-            ),
-        )
+        return compact([self.get_document(id) for id in self.featured_ids])
 
     def get_stats(self) -> Stats:
-        return Stats(
-            total_documents=len(self.documents),
-            total_themes=len(self.themes),
-            total_text_format=len(self.by_format_type["text"]),
-            total_audiovisual_format=len(self.by_format_type["audiovisual"]),
-            total_tool_format=len(self.by_format_type["tool"]),
-            total_course_format=len(self.by_format_type["course"]),
-            total_unique_authors=len(self.authors),
+        return self.stats
+
+
+class DocumentsRepositoryProvider:
+    """
+    Holds a long-lived DocumentsRepository snapshot for the current process.
+
+    The snapshot is built on first use, and rebuilt in the background once it
+    is older than `refresh_interval` seconds. Callers keep being served the
+    previous snapshot until the new one is complete, at which point it is
+    swapped in atomically. Snapshots must be treated as read-only.
+
+    When given a cache, built snapshots are published to redis so that
+    other processes can load them with a single GET instead of rebuilding
+    them from the airtable tables. Their version numbers are shared
+    across processes.
+    """
+
+    def __init__(
+        self,
+        airtable: AirtableDB,
+        cache: Optional[RedisCache] = None,
+        refresh_interval: Optional[int] = None,
+    ):
+        self.airtable = airtable
+        self.cache = cache
+        self.refresh_interval = refresh_interval
+        self._repository: Optional[DocumentsRepository] = None
+        self._built_at = 0.0
+        self._lock = Lock()
+
+    @property
+    def version(self) -> int:
+        repository = self._repository
+        return repository.version if repository is not None else 0
+
+    def get(self) -> DocumentsRepository:
+        repository = self._repository
+        if repository is None:
+            with self._lock:
+                if self._repository is None:
+                    self._swap(self._load() or self._build())
+                return cast(DocumentsRepository, self._repository)
+        if self._is_stale() and self._lock.acquire(blocking=False):
+            Thread(target=self._refresh_in_background, daemon=True).start()
+        return repository
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self._swap(self._load() or self._build())
+        finally:
+            self._lock.release()
+
+    def _load(self) -> Optional[DocumentsRepository]:
+        if self.cache is None:
+            return None
+        snapshot = self.cache.get_bytes("repository", ["snapshot"])
+        if snapshot is None:
+            return None
+        try:
+            if self._repository and snapshot_version(snapshot) == self.version:
+                return self._repository
+            return DocumentsRepository.from_snapshot(snapshot)
+        except SnapshotError:
+            return None
+
+    def _build(self) -> DocumentsRepository:
+        if self.cache is None:
+            return DocumentsRepository(self.airtable, version=self.version + 1)
+        version = self.cache.increment("repository", ["version"])
+        repository = DocumentsRepository(self.airtable, version=version)
+        self.cache.set_bytes("repository", ["snapshot"], repository.to_snapshot())
+        return repository
+
+    def _swap(self, repository: DocumentsRepository) -> None:
+        self._built_at = monotonic()
+        self._repository = repository
+
+    def _is_stale(self) -> bool:
+        return (
+            self.refresh_interval is not None
+            and monotonic() - self._built_at > self.refresh_interval
         )
+
+
+def get_repository_provider_instance(
+    airtable: Optional[AirtableDB] = None,
+) -> DocumentsRepositoryProvider:
+    if airtable is None:
+        airtable = airtable_db.get_db_instance()
+    if "DOCUMENTS_REPOSITORY_REFRESH_INTERVAL" in os.environ:
+        refresh_interval = int(os.environ["DOCUMENTS_REPOSITORY_REFRESH_INTERVAL"])
+    elif "REDIS_DOCUMENT_CACHE_TIMEOUT" in os.environ:
+        refresh_interval = int(os.environ["REDIS_DOCUMENT_CACHE_TIMEOUT"])
+    else:
+        refresh_interval = None
+    cache = create_cache(
+        prefix=os.environ["REDIS_DOCUMENT_CACHE_PREFIX"],
+        timeout=refresh_interval,
+    )
+    return DocumentsRepositoryProvider(airtable, cache, refresh_interval)
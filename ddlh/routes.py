@@ -6,12 +6,11 @@ from flask import render_template, request, url_for
 from . import tasks, utils
 from .formatters import format_search_result
 from .models import Document, Theme
-from .repositories import DocumentsRepository
 
 
 @app.route("/", methods=["GET"])
 def homepage() -> str:
-    db = DocumentsRepository(app.config["airtable_instance"])
+    db = app.config["documents_repository"].get()
 
     documents = db.get_featured_documents()
     themes = db.get_all_themes()
@@ -30,7 +29,7 @@ def homepage() -> str:
 
 @app.route("/themes/<theme_name>", methods=["GET"])
 def theme(theme_name: str) -> str:
-    db = DocumentsRepository(app.config["airtable_instance"])
+    db = app.config["documents_repository"].get()
 
     documents = db.get_documents_for_theme(theme_name)
     tags = db.get_tags_for_theme(theme_name)
@@ -55,7 +54,7 @@ def theme(theme_name: str) -> str:
 
 @app.route("/tags/<tag>", methods=["GET"])
 def tag(tag: str) -> str:
-    db = DocumentsRepository(app.config["airtable_instance"])
+    db = app.config["documents_repository"].get()
 
     documents = db.get_documents_for_tag(tag)
 
@@ -79,7 +78,7 @@ def format(format: str) -> str:
         "course": "Interactive learning resources",
     }
 
-    db = DocumentsRepository(app.config["airtable_instance"])
+    db = app.config["documents_repository"].get()
 
     documents = db.get_documents_for_format_type(format)
 
@@ -100,7 +99,7 @@ def format(format: str) -> str:
 
 @app.route("/documents/<document_id>", methods=["GET"])
 def document(document_id: str) -> str:
-    db = DocumentsRepository(app.config["airtable_instance"])
+    db = app.config["documents_repository"].get()
     rag_index = app.config["rag_index"]
 
     document = cast(Document, db.get_document(document_id))
@@ -110,7 +109,7 @@ def document(document_id: str) -> str:
         {"title": "Documents"},
         {
             "title": document.title,
-            "url": url_for("document", document_id=utils.url_to_id(document.link)),
+            "url": url_for("document", document_id=document.id),
         },
     )
     return render_template(
@@ -0,0 +1,22 @@
+from os import environ
+
+from ddlh.redis_cache import create_cache
+
+
+def cache_stats() -> None:
+    for prefix_variable in [
+        "REDIS_DOCUMENT_CACHE_PREFIX",
+        "REDIS_QUERY_CACHE_PREFIX",
+        "REDIS_EMBEDDING_CACHE_PREFIX",
+        "REDIS_RELATED_DOCUMENTS_CACHE_PREFIX",
+    ]:
+        cache = create_cache(prefix=environ[prefix_variable])
+        for prefix, metrics in sorted(cache.size_metrics().items()):
+            print(
+                f"{cache.config.prefix}_{prefix}: "
+                f"{metrics['keys']} keys, {metrics['bytes']} bytes"
+            )
+
+
+if __name__ == "__main__":
+    cache_stats()
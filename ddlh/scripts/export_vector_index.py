@@ -0,0 +1,9 @@
+from ddlh.rag.llamaindex import get_llamaindex_instance
+
+
+def export_vector_index() -> None:
+    get_llamaindex_instance().export_vector_index()
+
+
+if __name__ == "__main__":
+    export_vector_index()
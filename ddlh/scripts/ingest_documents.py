@@ -1,15 +1,43 @@
+from os import environ
+
+import more_itertools as mit
 from celery import chord
 
 from ddlh import airtable, tasks
 from ddlh.celery import celery_app  # noqa: F401
+from ddlh.rag.llamaindex import get_llamaindex_instance
 from ddlh.repositories import DocumentsRepository
 
+INGESTION_MODES = ["streaming", "reindex", "chord"]
+INGESTION_BATCH_SIZE = 20
+
 
 def ingest_documents() -> None:
+    """
+    In streaming mode, documents are fetched and indexed in micro-batches,
+    each one as soon as its own documents are fetched, and the index is
+    pruned and exported once every batch is done. Reindex mode streams
+    documents into a new version of every index instead, which is swapped
+    in once every batch is done. In chord mode, every document is fetched
+    before all of them are indexed at once.
+    """
+    mode = environ.get("INGESTION_MODE", "streaming")
+    if mode not in INGESTION_MODES:
+        raise ValueError(f"Unknown ingestion mode {mode}")
     db = airtable.get_db_instance()
     repo = DocumentsRepository(db)
     documents = repo.get_all_documents()
-    chord(tasks.fetch.s(document) for document in documents)(tasks.index.s())
+    if mode == "chord":
+        chord(tasks.fetch.s(document) for document in documents)(tasks.index.s())
+        return
+    version = None
+    if mode == "reindex":
+        version = get_llamaindex_instance().create_index_version()
+    batch_size = int(environ.get("INGESTION_BATCH_SIZE", INGESTION_BATCH_SIZE))
+    chord(
+        tasks.fetch_and_index.s(batch, version=version)
+        for batch in mit.chunked(documents, batch_size)
+    )(tasks.finish_indexing.s(version=version))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,10 @@
+from ddlh.rag.llamaindex import get_llamaindex_instance
+
+
+def rollback_index() -> None:
+    version = get_llamaindex_instance().rollback_index_version()
+    print(f"Rolled back to index version {version}")
+
+
+if __name__ == "__main__":
+    rollback_index()
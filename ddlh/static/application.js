@@ -144,8 +144,30 @@ const setupSocket = () => {
         socket.emit("join_room", { room_id: roomId });
       });
 
+      var complete = false;
+
+      socket.on("document_summary", (data) => {
+        const element = document.getElementById("theme-summary-container");
+        const template = document.createElement("template");
+        template.innerHTML = data.msg.trim();
+        const summary = template.content.firstElementChild;
+        const documentId = summary.dataset["documentId"];
+        if (
+          complete ||
+          element.querySelector(
+            `.search-result-summary[data-document-id="${documentId}"]`,
+          )
+        ) {
+          return;
+        }
+        const waitMessage = element.querySelector(".wait-mesage");
+        element.insertBefore(summary, waitMessage);
+        setupDocumentLinkHighlight();
+      });
+
       socket.on("msg", (data) => {
         const element = document.getElementById("theme-summary-container");
+        complete = true;
         element.innerHTML = data.msg;
         setupDocumentLinkHighlight();
       });
@@ -166,7 +188,11 @@ const setupDocumentLinkHighlight = () => {
     const links = container.querySelectorAll("a");
     links.forEach((link) => {
       const href = link.getAttribute("href");
+      if (link.dataset["highlight"]) {
+        return;
+      }
       if (href && href.match(urlRegex)) {
+        link.dataset["highlight"] = "true";
         const doc_id = href.replace(urlRegex, "");
         link.addEventListener("mouseover", () => {
           const elems = document.querySelectorAll(`.document-${doc_id}`);
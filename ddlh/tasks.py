@@ -1,5 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
-from typing import List
+from typing import List, Optional
 
 from celery import current_task, shared_task
 from celery.app.task import Task
@@ -8,8 +9,10 @@ from flask_socketio import SocketIO
 
 from ddlh.extraction import extract_html, extract_pdf
 from ddlh.fetching import content_type, get
-from ddlh.formatters import format_search_result
-from ddlh.models import Document, DocumentWithText
+from ddlh.formatters import format_document_summary, format_search_result
+from ddlh.models import Document, DocumentSummary, DocumentWithText
+
+FETCH_CONCURRENCY = 8
 
 # Monkey-patch needed for celery-types: https://github.com/sbdchd/celery-types
 Task.__class_getitem__ = classmethod(lambda cls, *args, **kwargs: cls)  # type: ignore[attr-defined] # noqa
@@ -30,18 +33,49 @@ def extract_text_from_link(url: str) -> str:
     return text
 
 
-@shared_task(ignore_result=False)
-def fetch(document: Document) -> DocumentWithText:
+def fetch_document(document: Document) -> DocumentWithText:
     text = extract_text_from_link(document.link)
     if document.invisible_link:
         text += "\n\n\n" + extract_text_from_link(document.invisible_link)
     return document.enrich_with_text(text)
 
 
+@shared_task(ignore_result=False)
+def fetch(document: Document) -> DocumentWithText:
+    return fetch_document(document)
+
+
 @shared_task
 def index(documents: List[DocumentWithText]) -> None:
     rag_index = app.config["rag_index"]
-    rag_index.index_documents(documents)
+    rag_index.index_documents(documents, prune=True)
+
+
+@shared_task(ignore_result=False)
+def fetch_and_index(
+    documents: List[Document], version: Optional[int] = None
+) -> List[str]:
+    """
+    Fetch and index one micro-batch of documents, returning only their ids,
+    so that extracted texts never go through the result backend.
+    """
+    rag_index = app.config["rag_index"]
+    concurrency = int(environ.get("INGESTION_FETCH_CONCURRENCY", FETCH_CONCURRENCY))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        rag_index.add_documents(
+            list(executor.map(fetch_document, documents)), version=version
+        )
+    return [document.id for document in documents]
+
+
+@shared_task
+def finish_indexing(
+    document_ids: List[List[str]], version: Optional[int] = None
+) -> None:
+    rag_index = app.config["rag_index"]
+    rag_index.finish_indexing(
+        [id for batch in document_ids for id in batch], version=version
+    )
 
 
 @shared_task
@@ -49,9 +83,17 @@ def query(
     query: str,
 ) -> None:
     rag_index = app.config["rag_index"]
-    response = rag_index.query(query)
+    socketio = SocketIO(message_queue=environ["REDIS_URL"])
+    room = current_task.request.id
+
+    def on_document_summary(document_summary: DocumentSummary) -> None:
+        with app.test_request_context("localhost"):
+            msg = format_document_summary(document_summary)
+            if msg:
+                socketio.emit("document_summary", {"msg": msg}, to=room)
+
+    response = rag_index.query(query, on_document_summary)
     with app.test_request_context("localhost"):
         if response.summary:
             msg = format_search_result(response)
-            socketio = SocketIO(message_queue=environ["REDIS_URL"])
-            socketio.emit("msg", {"msg": msg}, to=current_task.request.id)
+            socketio.emit("msg", {"msg": msg}, to=room)
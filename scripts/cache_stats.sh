@@ -0,0 +1,2 @@
+#!/bin/bash
+python -m ddlh.scripts.cache_stats
@@ -0,0 +1,2 @@
+#!/bin/bash
+python -m ddlh.scripts.export_vector_index
@@ -0,0 +1,263 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any
+from unittest.mock import MagicMock
+
+import fakeredis
+import pytest  # type: ignore
+import requests
+
+from ddlh.airtable import (
+    MAX_RETRIES,
+    REQUESTS_PER_SECOND,
+    AirtableConfig,
+    AirtableDB,
+    RateLimitedApi,
+)
+from ddlh.redis_cache import RedisCache, RedisCacheConfig
+
+
+class TestRateLimitedApi:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.rate_limiter = MagicMock()
+        self.super_request = mocker.patch("ddlh.airtable.Api.request")
+        self.api = RateLimitedApi("token", self.rate_limiter)
+
+    def http_error(self, status_code, headers={}):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = headers
+        return requests.HTTPError(response=response)
+
+    def test_it_takes_a_token_before_each_request(self):
+        """
+        It acquires a token from the rate limiter before making a request
+        """
+        self.super_request.return_value = {"records": []}
+        result = self.api.request("GET", "https://example.com")
+        self.rate_limiter.acquire.assert_called_once()
+        assert result == {"records": []}
+
+    def test_it_backs_off_when_rate_limited(self):
+        """
+        When airtable responds with a 429, it makes everyone sharing
+        the rate limiter back off, then retries
+        """
+        self.super_request.side_effect = [
+            self.http_error(429),
+            self.http_error(429),
+            {"records": []},
+        ]
+        result = self.api.request("GET", "https://example.com")
+        assert result == {"records": []}
+        assert self.rate_limiter.acquire.call_count == 3
+        penalties = [c.args[0] for c in self.rate_limiter.penalize.call_args_list]
+        assert penalties == [1.0, 2.0]
+
+    def test_it_respects_retry_after(self):
+        """
+        It backs off for as long as the Retry-After header asks
+        """
+        self.super_request.side_effect = [
+            self.http_error(429, {"Retry-After": "12"}),
+            {"records": []},
+        ]
+        self.api.request("GET", "https://example.com")
+        self.rate_limiter.penalize.assert_called_with(12.0)
+
+    def test_it_gives_up_eventually(self):
+        """
+        It raises once it has retried too many times
+        """
+        self.super_request.side_effect = self.http_error(429)
+        with pytest.raises(requests.HTTPError):
+            self.api.request("GET", "https://example.com")
+        assert self.rate_limiter.penalize.call_count == MAX_RETRIES
+
+    def test_it_does_not_retry_other_errors(self):
+        """
+        Errors other than rate limiting are raised straight away
+        """
+        self.super_request.side_effect = self.http_error(500)
+        with pytest.raises(requests.HTTPError):
+            self.api.request("GET", "https://example.com")
+        self.rate_limiter.penalize.assert_not_called()
+
+
+class TestIncrementalSync:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.cache = MagicMock()
+        self.stored: dict[tuple[str, tuple[str, ...]], Any] = {}
+        self.cache.get_if_cached.side_effect = lambda prefix, args: self.stored.get(
+            (prefix, tuple(args))
+        )
+        self.cache.store.side_effect = lambda prefix, args, value, expire: (
+            self.stored.__setitem__((prefix, tuple(args)), value)
+        )
+        self.table = MagicMock()
+        self.api = MagicMock()
+        self.api.table.return_value = self.table
+        mocker.patch("ddlh.airtable.RateLimitedApi", return_value=self.api)
+        self.datetime = mocker.patch("ddlh.airtable.datetime", wraps=datetime)
+        self.now = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+        self.datetime.now.side_effect = lambda tz: self.now
+        self.config = AirtableConfig(
+            token="token",
+            base_id="base",
+            table_ids={"documents": "tbl1", "themes": "tbl2"},
+            view_ids={"themes": "view1"},
+            full_sync_interval=3600,
+        )
+        self.db = AirtableDB(self.config, self.cache, rate_limiter=MagicMock())
+
+    def test_first_sync_fetches_the_whole_table(self):
+        """
+        With nothing synced yet, it fetches every record
+        """
+        self.table.all.return_value = [{"id": "rec1", "fields": {}}]
+        records = self.db._uncached_all("documents")
+        self.table.all.assert_called_once_with()
+        assert records == [{"id": "rec1", "fields": {}}]
+        state = self.stored[("sync", ("documents",))]
+        assert state["watermark"] == "2024-06-01T11:59:00.000Z"
+        assert state["records"] == records
+
+    def test_later_syncs_merge_modified_records(self):
+        """
+        Later syncs only fetch records modified since the watermark,
+        and merge them into the records already synced
+        """
+        self.table.all.return_value = [
+            {"id": "rec1", "fields": {"title": "one"}},
+            {"id": "rec2", "fields": {"title": "two"}},
+        ]
+        self.db._uncached_all("documents")
+        self.now += timedelta(minutes=10)
+        self.table.all.return_value = [
+            {"id": "rec2", "fields": {"title": "changed"}},
+            {"id": "rec3", "fields": {"title": "new"}},
+        ]
+        records = self.db._uncached_all("documents")
+        self.table.all.assert_called_with(
+            formula=(
+                "IS_AFTER(LAST_MODIFIED_TIME(), "
+                "DATETIME_PARSE('2024-06-01T11:59:00.000Z'))"
+            )
+        )
+        assert [r["fields"]["title"] for r in records] == ["one", "changed", "new"]
+
+    def test_full_sync_after_interval(self):
+        """
+        Once the full sync interval has passed, it fetches the whole table
+        again, which drops deleted records
+        """
+        self.table.all.return_value = [{"id": "rec1", "fields": {}}]
+        self.db._uncached_all("documents")
+        self.now += timedelta(hours=2)
+        self.table.all.return_value = []
+        assert self.db._uncached_all("documents") == []
+        self.table.all.assert_called_with()
+
+    def test_tables_with_views_are_always_fetched_in_full(self):
+        """
+        Tables read through a view are not synced incrementally
+        """
+        self.db._uncached_all("themes")
+        self.db._uncached_all("themes")
+        self.table.all.assert_called_with(view="view1")
+        self.cache.store.assert_not_called()
+
+    def test_no_incremental_sync_without_interval(self):
+        """
+        Without a full sync interval, tables are always fetched in full
+        """
+        self.config.full_sync_interval = None
+        self.db._uncached_all("documents")
+        self.table.all.assert_called_once_with(view=None)
+        self.cache.store.assert_not_called()
+
+
+class TestGetMany:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.cache = MagicMock()
+        self.cache.cached_many.side_effect = (
+            lambda prefix, args_list, func, batch_func: batch_func(args_list)
+        )
+        self.table = MagicMock()
+        self.api = MagicMock()
+        self.api.table.return_value = self.table
+        mocker.patch("ddlh.airtable.RateLimitedApi", return_value=self.api)
+        self.config = AirtableConfig(
+            token="token",
+            base_id="base",
+            table_ids={"formats": "tbl1"},
+            view_ids={},
+        )
+        self.db = AirtableDB(self.config, self.cache, rate_limiter=MagicMock())
+
+    def test_it_fetches_records_by_id_in_one_request(self):
+        """
+        It fetches all the missing records with a single formula query,
+        returning them in order, and None for records that don't exist
+        """
+        self.table.all.return_value = [
+            {"id": "rec2", "fields": {}},
+            {"id": "rec1", "fields": {}},
+        ]
+        records = self.db.get_many("formats", ["rec1", "rec2", "rec3"])
+        self.table.all.assert_called_once_with(
+            formula="OR(RECORD_ID()='rec1', RECORD_ID()='rec2', RECORD_ID()='rec3')"
+        )
+        assert records == [
+            {"id": "rec1", "fields": {}},
+            {"id": "rec2", "fields": {}},
+            None,
+        ]
+        args = self.cache.cached_many.call_args.args
+        assert args[0] == "get"
+        assert args[1] == [
+            ["formats", "rec1"],
+            ["formats", "rec2"],
+            ["formats", "rec3"],
+        ]
+
+
+class TestRateLimit:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        mocker.patch(
+            "ddlh.redis_cache.redis.from_url", return_value=fakeredis.FakeRedis()
+        )
+        self.now = 1000.0
+        clock = mocker.patch("fakeredis.commands_mixins.server_mixin.time")
+        clock.time.side_effect = lambda: self.now
+        cache = RedisCache(
+            RedisCacheConfig(redis_url="redis://", prefix="documents", timeout=None)
+        )
+        config = AirtableConfig(
+            token="token", base_id="base", table_ids={}, view_ids={}
+        )
+        self.db = AirtableDB(config, cache)
+
+    def test_it_never_makes_more_requests_in_a_second_than_allowed(self):
+        """
+        However hard it is pushed, and after being idle, no one second window
+        gets more than the allowed number of requests
+        """
+        grants = []
+        for step in range(1000):
+            self.now = 1000.0 + step * 0.01
+            if self.db.api.rate_limiter.try_acquire() == 0:
+                grants.append(self.now)
+        busiest_second = max(
+            len([grant for grant in grants if start <= grant <= start + 1.0])
+            for start in grants
+        )
+        assert busiest_second <= REQUESTS_PER_SECOND
+        assert len(grants) >= 35
@@ -0,0 +1,49 @@
+import pytest  # type: ignore
+
+from ddlh.codecs import CodecError, ValueCodec
+
+VALUE = {"records": [{"id": "rec1", "fields": {"title": "A title" * 100}}]}
+
+
+class TestValueCodec:
+
+    @pytest.mark.parametrize("codec", ["json", "msgpack"])
+    @pytest.mark.parametrize("compression", ["none", "zlib", "zstd"])
+    def test_round_trip(self, codec, compression):
+        """
+        Values decode to what was encoded, whatever the codec and compression
+        """
+        value_codec = ValueCodec(codec, compression, compression_threshold=0)
+        assert value_codec.decode(value_codec.encode(VALUE)) == VALUE
+
+    def test_values_are_tagged(self):
+        """
+        Values written with one configuration can be decoded with another
+        """
+        encoded = ValueCodec("msgpack", "zstd", compression_threshold=0).encode(VALUE)
+        assert ValueCodec("json", "none").decode(encoded) == VALUE
+
+    def test_it_decodes_untagged_json(self):
+        """
+        Plain JSON values, written before codecs existed, still decode
+        """
+        assert ValueCodec("msgpack", "zlib").decode(b'{"a": [1, 2]}') == {"a": [1, 2]}
+
+    def test_small_values_are_not_compressed(self):
+        """
+        Values smaller than the compression threshold are stored uncompressed
+        """
+        value_codec = ValueCodec("json", "zlib", compression_threshold=256)
+        assert value_codec.encode({"a": 1}) == b'\x00jn{"a":1}'
+        assert len(value_codec.encode(VALUE)) < len(
+            ValueCodec("json", "none").encode(VALUE)
+        )
+
+    def test_unknown_codecs(self):
+        """
+        Unknown codecs are rejected when configuring and decoding
+        """
+        with pytest.raises(CodecError):
+            ValueCodec("pickle")
+        with pytest.raises(CodecError):
+            ValueCodec().decode(b"\x00?n{}")
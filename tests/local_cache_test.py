@@ -0,0 +1,81 @@
+import pytest  # type: ignore
+
+from ddlh.local_cache import LocalCache
+
+
+class TestLocalCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.now = 1000.0
+        self.monotonic = mocker.patch("ddlh.local_cache.monotonic")
+        self.monotonic.side_effect = lambda: self.now
+
+    def test_it_returns_stored_values(self):
+        """
+        It returns the very objects that were stored
+        """
+        cache = LocalCache(max_bytes=100)
+        value = {"a": 1}
+        cache.set("key", value, 10)
+        assert cache.get("key") is value
+        assert cache.get("other") is None
+
+    def test_it_evicts_least_recently_used_entries(self):
+        """
+        It evicts the least recently used entries to stay within its budget
+        """
+        cache = LocalCache(max_bytes=30)
+        cache.set("a", "a", 10)
+        cache.set("b", "b", 10)
+        cache.set("c", "c", 10)
+        cache.get("a")
+        cache.set("d", "d", 10)
+        assert cache.get("a") == "a"
+        assert cache.get("b") is None
+        assert cache.get("c") == "c"
+        assert cache.get("d") == "d"
+        assert cache.size == 30
+
+    def test_it_ignores_values_bigger_than_the_budget(self):
+        """
+        Values which wouldn't fit at all are not stored
+        """
+        cache = LocalCache(max_bytes=30)
+        cache.set("a", "a", 10)
+        cache.set("big", "big", 31)
+        assert cache.get("big") is None
+        assert cache.get("a") == "a"
+
+    def test_entries_expire(self):
+        """
+        Entries expire after the ttl
+        """
+        cache = LocalCache(max_bytes=100, ttl=60)
+        cache.set("a", "a", 10)
+        self.now += 59
+        assert cache.get("a") == "a"
+        self.now += 2
+        assert cache.get("a") is None
+        assert cache.size == 0
+
+    def test_invalidate(self):
+        """
+        invalidate removes an entry
+        """
+        cache = LocalCache(max_bytes=100)
+        cache.set("a", "a", 10)
+        cache.invalidate("a")
+        assert cache.get("a") is None
+        assert cache.size == 0
+
+    def test_values_read_before_an_invalidation_are_dropped(self):
+        """
+        Values fetched before an invalidation happened are not stored,
+        as they may already be out of date
+        """
+        cache = LocalCache(max_bytes=100)
+        generation = cache.generation
+        cache.invalidate("a")
+        cache.set("a", "old", 10, generation)
+        assert cache.get("a") is None
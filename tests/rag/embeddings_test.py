@@ -0,0 +1,119 @@
+from unittest.mock import MagicMock
+
+import fakeredis
+import pytest  # type: ignore
+from llama_index.core import Document
+from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, TextNode
+
+from ddlh.rag.embeddings import (
+    ConcurrentEmbedding,
+    EmbeddingCache,
+    normalize_text,
+    pack_embedding,
+    unpack_embedding,
+)
+from ddlh.rag.providers import HashingEmbedding
+from ddlh.redis_cache import RedisCache, RedisCacheConfig
+
+
+class TestEmbeddingCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.redis = fakeredis.FakeRedis()
+        mocker.patch("ddlh.redis_cache.redis.from_url", return_value=self.redis)
+        self.cache = RedisCache(
+            RedisCacheConfig(redis_url="redis://", prefix="embeddings", timeout=60)
+        )
+        self.embed = MagicMock(return_value=[0.25, -0.5, 1.0])
+
+    def test_it_packs_embeddings_as_float32(self):
+        """
+        It packs embeddings into four bytes per dimension
+        """
+        data = pack_embedding([0.25, -0.5, 1.0])
+        assert len(data) == 12
+        assert unpack_embedding(data) == [0.25, -0.5, 1.0]
+
+    def test_it_normalizes_text(self):
+        """
+        It ignores case and differences in whitespace
+        """
+        assert normalize_text("  Climate\n  CHANGE ") == "climate change"
+
+    def test_it_only_embeds_each_normalized_text_once(self):
+        """
+        It calls the embedding API once for texts which only differ in case
+        and whitespace, and serves later lookups from redis
+        """
+        cache = EmbeddingCache(self.cache, "mistral-embed")
+        assert cache.get_embedding("Climate change", self.embed) == [0.25, -0.5, 1.0]
+        assert cache.get_embedding(" climate  CHANGE", self.embed) == [
+            0.25,
+            -0.5,
+            1.0,
+        ]
+        self.embed.assert_called_once_with("climate change")
+
+    def test_it_keys_embeddings_by_model(self):
+        """
+        It doesn't share embeddings between models
+        """
+        EmbeddingCache(self.cache, "model-a").get_embedding("text", self.embed)
+        EmbeddingCache(self.cache, "model-b").get_embedding("text", self.embed)
+        assert self.embed.call_count == 2
+
+    def test_it_ignores_corrupt_values(self):
+        """
+        It embeds the text again if the cached value isn't a float32 vector
+        """
+        cache = EmbeddingCache(self.cache, "mistral-embed")
+        cache.get_embedding("text", self.embed)
+        for key in self.redis.keys():
+            self.redis.set(key, b"12345")
+        assert cache.get_embedding("text", self.embed) == [0.25, -0.5, 1.0]
+        assert self.embed.call_count == 2
+
+
+class TestConcurrentEmbedding:
+
+    def test_it_embeds_nodes_in_rate_limited_batches(self):
+        """
+        It embeds nodes in batches of the model's batch size, taking a rate
+        limiter token per batch, and keeps embeddings with their nodes
+        """
+        model = HashingEmbedding(dimensions=16, embed_batch_size=2)
+        batch_sizes = []
+        original = model._get_text_embeddings
+
+        def get_text_embeddings(texts):
+            batch_sizes.append(len(texts))
+            return original(texts)
+
+        object.__setattr__(model, "_get_text_embeddings", get_text_embeddings)
+        rate_limiter = MagicMock()
+        nodes: list[BaseNode] = [TextNode(text=f"text {n}") for n in range(5)]
+        embedding = ConcurrentEmbedding(model, concurrency=3, rate_limiter=rate_limiter)
+        assert embedding(nodes) is nodes
+        assert sorted(batch_sizes) == [1, 2, 2]
+        assert rate_limiter.acquire.call_count == 3
+        for node in nodes:
+            assert node.embedding == model.get_text_embedding(node.get_content())
+
+    def test_it_runs_in_an_ingestion_pipeline(self):
+        """
+        It can replace the embedding model in an ingestion pipeline
+        """
+        model = HashingEmbedding(dimensions=16, embed_batch_size=4)
+        pipeline = IngestionPipeline(
+            transformations=[
+                SentenceSplitter(chunk_size=20, chunk_overlap=0),
+                ConcurrentEmbedding(model, concurrency=2),
+            ]
+        )
+        nodes = pipeline.run(documents=[Document(text="word " * 100, doc_id="doc1")])
+        assert len(nodes) > 1
+        assert all(node.embedding is not None for node in nodes)
+        assert all(node.ref_doc_id == "doc1" for node in nodes)
@@ -0,0 +1,190 @@
+import asyncio
+from fnmatch import fnmatch
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest  # type: ignore
+
+from ddlh.rag.index_versions import (
+    BULK_SETTINGS,
+    IndexVersionError,
+    IndexVersions,
+    index_version,
+)
+
+
+class FakeIndices:
+    """
+    Just enough of the elasticsearch indices API to manage versions, with
+    indexes mapped to the aliases pointing at them.
+    """
+
+    def __init__(self, indexes):
+        self.indexes: dict[str, set[str]] = {index: set() for index in indexes}
+        self.copies: list[tuple[str, str]] = []
+        self.create = AsyncMock(side_effect=self._create)
+        self.delete = AsyncMock(side_effect=self._delete)
+        self.update_aliases = AsyncMock(side_effect=self._update_aliases)
+        self.put_settings = AsyncMock()
+        self.refresh = AsyncMock()
+
+    async def get(self, index, allow_no_indices):
+        return {name: {} for name in self.indexes if fnmatch(name, index)}
+
+    async def exists(self, index):
+        return index in self.indexes or await self.exists_alias(index)
+
+    async def exists_alias(self, name):
+        return any(name in aliases for aliases in self.indexes.values())
+
+    async def get_alias(self, name):
+        return {index: {} for index, aliases in self.indexes.items() if name in aliases}
+
+    async def get_mapping(self, index):
+        return {index: {"mappings": {"properties": {"from": index}}}}
+
+    async def reindex(self, source, dest, refresh, wait_for_completion):
+        self.copies.append((source["index"], dest["index"]))
+
+    async def _create(self, index, settings=None, mappings=None):
+        self.indexes[index] = set()
+
+    async def _delete(self, index, ignore_unavailable):
+        for name in index:
+            self.indexes.pop(name, None)
+
+    async def _update_aliases(self, actions):
+        for action in actions:
+            if "remove_index" in action:
+                del self.indexes[action["remove_index"]["index"]]
+            elif "remove" in action:
+                self.indexes[action["remove"]["index"]].remove(
+                    action["remove"]["alias"]
+                )
+            else:
+                self.indexes[action["add"]["index"]].add(action["add"]["alias"])
+
+
+class TestIndexVersions:
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.client = MagicMock()
+        self.indices = self.client.indices = FakeIndices([])
+        self.versions = IndexVersions(self.client, ["embeddings", "nodes"], 1)
+
+    def run(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_it_parses_index_versions(self):
+        """
+        It gets versions from index names, ignoring other indexes
+        """
+        assert index_version("nodes", "nodes-v12") == 12
+        assert index_version("nodes", "nodes") is None
+        assert index_version("nodes", "nodes-vx") is None
+        assert index_version("nodes", "embeddings-v1") is None
+
+    def test_it_creates_versions_for_bulk_loading(self):
+        """
+        It creates the next version of every index with bulk settings, and
+        the given mappings
+        """
+        version = self.run(self.versions.next_version())
+        self.run(self.versions.create(version, {"embeddings": {"properties": {}}}))
+        assert version == 1
+        calls = self.indices.create.call_args_list
+        assert [call.kwargs["index"] for call in calls] == [
+            "embeddings-v1",
+            "nodes-v1",
+        ]
+        assert all(call.kwargs["settings"] == BULK_SETTINGS for call in calls)
+        assert [call.kwargs["mappings"] for call in calls] == [
+            {"properties": {}},
+            None,
+        ]
+        assert self.run(self.versions.next_version()) == 2
+
+    def test_it_restores_settings_when_finished(self):
+        """
+        It restores replicas and refreshes, and makes the version searchable
+        """
+        self.run(self.versions.finish(2))
+        settings = self.indices.put_settings.call_args.kwargs
+        assert settings["index"] == ["embeddings-v2", "nodes-v2"]
+        assert settings["settings"] == {
+            "number_of_replicas": 1,
+            "refresh_interval": None,
+        }
+        self.indices.refresh.assert_called_once_with(
+            index=["embeddings-v2", "nodes-v2"]
+        )
+
+    def test_it_swaps_aliases_in_one_update(self):
+        """
+        It moves the aliases from one version to the next in a single update
+        """
+        self.run(self.versions.create(1))
+        self.run(self.versions.swap(1))
+        assert self.indices.update_aliases.call_count == 1
+        self.run(self.versions.create(2))
+        self.run(self.versions.swap(2))
+        assert self.indices.update_aliases.call_count == 2
+        assert self.run(self.versions.live_version()) == 2
+        assert self.indices.indexes["nodes-v1"] == set()
+        assert self.indices.indexes["nodes-v2"] == {"nodes"}
+
+    def test_it_keeps_unversioned_indexes_to_roll_back_to(self):
+        """
+        On the first swap, it copies indexes from before versioning, with
+        their mappings, to version 0 before replacing them with aliases, and
+        creates any which were missing, so that it can roll back to them
+        """
+        self.indices = self.client.indices = FakeIndices(["nodes", "embeddings"])
+        self.client.reindex = AsyncMock(side_effect=self.indices.reindex)
+        versions = IndexVersions(self.client, ["embeddings", "nodes", "kv"], 1)
+        self.run(versions.create(1))
+        self.run(versions.swap(1))
+        assert self.indices.copies == [
+            ("embeddings", "embeddings-v0"),
+            ("nodes", "nodes-v0"),
+        ]
+        create = self.indices.create.call_args_list[-3:]
+        assert [call.kwargs["index"] for call in create] == [
+            "embeddings-v0",
+            "nodes-v0",
+            "kv-v0",
+        ]
+        assert create[0].kwargs["mappings"] == {"properties": {"from": "embeddings"}}
+        assert self.indices.indexes == {
+            "embeddings-v0": set(),
+            "nodes-v0": set(),
+            "kv-v0": set(),
+            "embeddings-v1": {"embeddings"},
+            "nodes-v1": {"nodes"},
+            "kv-v1": {"kv"},
+        }
+        assert self.run(versions.rollback()) == 0
+        assert self.indices.indexes["kv-v0"] == {"kv"}
+
+    def test_it_rolls_back_to_the_previous_version(self):
+        """
+        It swaps back to the latest complete version before the live one
+        """
+        for version in [1, 2, 3]:
+            self.run(self.versions.create(version))
+        del self.indices.indexes["nodes-v2"]
+        self.run(self.versions.swap(3))
+        assert self.run(self.versions.rollback()) == 1
+        assert self.run(self.versions.live_version()) == 1
+        with pytest.raises(IndexVersionError):
+            self.run(self.versions.rollback())
+
+    def test_it_prunes_old_versions(self):
+        """
+        It deletes all but the latest versions, keeping the live one
+        """
+        for version in [1, 2, 3, 4]:
+            self.run(self.versions.create(version))
+        self.run(self.versions.swap(1))
+        assert self.run(self.versions.prune(2)) == [2]
+        assert self.run(self.versions.versions()) == [1, 3, 4]
@@ -0,0 +1,450 @@
+import asyncio
+from dataclasses import replace
+from typing import Any, cast
+from unittest.mock import AsyncMock, MagicMock
+
+import gevent
+import numpy as np
+import pytest  # type: ignore
+from llama_index.core import Document as LlamaDocument
+from llama_index.core.schema import (
+    NodeRelationship,
+    NodeWithScore,
+    RelatedNodeInfo,
+    TextNode,
+)
+from llama_index.core.vector_stores.types import VectorStoreQueryResult
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from llama_index.storage.kvstore.elasticsearch import (  # type: ignore
+    ElasticsearchKVStore,
+)
+
+from ddlh.models import DocumentWithText
+from ddlh.rag.event_loop import SharedEventLoop
+from ddlh.rag.index_versions import IndexVersionError
+from ddlh.rag.llamaindex import LlamaIndex, LlamaIndexConfig, embedding_model_id
+from ddlh.rag.providers import EchoLLM, HashingEmbedding
+from ddlh.rag.vector_index import IndexedChunk, write_vector_index
+
+from llama_index.vector_stores.elasticsearch import (  # type: ignore # isort:skip
+    ElasticsearchStore as ElasticsearchVectorStore,
+)
+
+
+class TestLlamaIndex:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.es_client = mocker.patch("ddlh.rag.llamaindex.AsyncElasticsearch")
+        self.kvstore = mocker.patch("ddlh.rag.llamaindex.LoopElasticsearchKVStore")
+        self.docstore = mocker.patch("ddlh.rag.llamaindex.ElasticsearchDocumentStore")
+        self.vector_store = mocker.patch(
+            "ddlh.rag.llamaindex.LoopElasticsearchVectorStore"
+        )
+        self.vector_store_index = mocker.patch("ddlh.rag.llamaindex.VectorStoreIndex")
+        self.embedding = mocker.patch("ddlh.rag.llamaindex.MistralAIEmbedding")
+        self.llm = mocker.patch("ddlh.rag.llamaindex.MistralAI")
+        client = self.es_client.return_value
+        client.indices.exists = AsyncMock(return_value=True)
+        client.indices.refresh = AsyncMock()
+        client.close = AsyncMock()
+        self.hits: dict[str, list[dict[str, Any]]] = {}
+
+        async def scan(client, index, **kwargs):
+            for hit in self.hits.get(index, []):
+                yield hit
+
+        mocker.patch("ddlh.rag.llamaindex.async_scan", side_effect=scan)
+        self.event_loops: list[SharedEventLoop] = []
+
+        def shared_event_loop():
+            self.event_loops.append(SharedEventLoop())
+            return self.event_loops[-1]
+
+        mocker.patch(
+            "ddlh.rag.llamaindex.SharedEventLoop", side_effect=shared_event_loop
+        )
+        self.config = LlamaIndexConfig(
+            embedding_model_name="mistral-embed",
+            llm_model_name="mistral-large",
+            es_url="http://elasticsearch:9200",
+            es_username="user",
+            es_password="password",
+            es_embeddings_index="embeddings",
+            es_embeddings_field="embedding",
+            es_kv_index="kv",
+            es_node_index="nodes",
+            es_ref_doc_index="ref-docs",
+            es_metadata_index="metadata",
+            mistral_api_key="key",
+            embedding_chunk_size=512,
+            embedding_chunk_overlap=64,
+            retrieval_top_k=5,
+            safe_prompt=True,
+        )
+        yield
+        for event_loop in self.event_loops:
+            event_loop.stop()
+
+    def store_hashes(self, hashes, index="metadata"):
+        self.hits[index] = [
+            {"_id": doc_id, "_source": {"doc_hash": doc_hash}}
+            for doc_id, doc_hash in hashes.items()
+        ]
+
+    def test_it_reuses_its_clients(self):
+        """
+        It creates its clients and vector store index once, and reuses them
+        """
+        llama_index = LlamaIndex(self.config)
+        assert llama_index.docstore is llama_index.docstore
+        assert llama_index.vector_store is llama_index.vector_store
+        assert llama_index.index is llama_index.index
+        assert llama_index.embedding_model is llama_index.embedding_model
+        assert llama_index.llm is llama_index.llm
+        self.es_client.assert_called_once()
+        self.vector_store_index.from_vector_store.assert_called_once()
+        self.embedding.assert_called_once()
+        self.llm.assert_called_once()
+
+    def test_it_shares_one_pooled_elasticsearch_client(self):
+        """
+        It passes a single pooled elasticsearch client to every store
+        """
+        llama_index = LlamaIndex(self.config)
+        llama_index.stores
+        client = self.es_client.return_value
+        self.es_client.assert_called_once_with(
+            "http://elasticsearch:9200",
+            basic_auth=("user", "password"),
+            connections_per_node=10,
+            http_compress=True,
+            max_retries=3,
+            retry_on_timeout=True,
+        )
+        assert self.kvstore.call_args.kwargs["es_client"] is client
+        assert self.vector_store.call_args.kwargs["es_client"] is client
+
+    def test_it_shares_its_client_with_index_versions(self):
+        """
+        It shares its elasticsearch client and event loop with the versions
+        of its index, and only closes them itself
+        """
+        llama_index = LlamaIndex(self.config)
+        versioned = llama_index.for_version(2)
+        assert versioned.stores.client is llama_index.stores.client
+        assert versioned.event_loop is llama_index.event_loop
+        self.es_client.assert_called_once()
+        versioned.close()
+        self.es_client.return_value.close.assert_not_awaited()
+        llama_index.close()
+        self.es_client.return_value.close.assert_awaited_once()
+
+    def test_it_gets_document_ids_from_result_nodes(self):
+        """
+        It reads the id of a result's source document from the node, without
+        looking it up in the docstore
+        """
+        llama_index = LlamaIndex(self.config)
+        node = TextNode(
+            text="text",
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id="doc1")},
+        )
+        assert llama_index.get_document_id_for_result(NodeWithScore(node=node)) == (
+            "doc1"
+        )
+        assert (
+            llama_index.get_document_id_for_result(
+                NodeWithScore(node=TextNode(text="orphan"))
+            )
+            is None
+        )
+        self.docstore.assert_not_called()
+
+    def test_it_caches_query_embeddings(self):
+        """
+        It gets query embeddings through the embedding cache when it has one
+        """
+        embedding_cache = MagicMock()
+        embedding_cache.get_embedding.return_value = [1.0]
+        llama_index = LlamaIndex(self.config, embedding_cache)
+        assert llama_index.get_query_embedding("query") == [1.0]
+        embedding_cache.get_embedding.assert_called_once_with(
+            "query", self.embedding.return_value.get_query_embedding
+        )
+
+    def test_it_uses_local_providers(self):
+        """
+        It uses offline embedding and LLM providers when configured to
+        """
+        self.config.provider = "local"
+        llama_index = LlamaIndex(self.config)
+        assert isinstance(llama_index.embedding_model, HashingEmbedding)
+        assert isinstance(llama_index.llm, EchoLLM)
+        assert embedding_model_id(self.config) == "local-hashing-1024"
+        self.embedding.assert_not_called()
+        self.llm.assert_not_called()
+
+    def test_it_rejects_unknown_providers(self):
+        """
+        It refuses to start with an unknown provider
+        """
+        self.config.provider = "unknown"
+        with pytest.raises(ValueError):
+            LlamaIndex(self.config)
+
+    def test_it_retrieves_from_the_local_vector_index(self, tmp_path):
+        """
+        It answers queries from the local vector index when there is one,
+        without querying elasticsearch
+        """
+        self.config.local_vector_index_path = str(tmp_path / "vectors.bin")
+        llama_index = LlamaIndex(self.config)
+        llama_index.embedding_model.get_query_embedding.return_value = [1.0, 0.0]
+        node = TextNode(
+            id_="n1",
+            text="text",
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id="doc1")},
+        )
+        write_vector_index(
+            self.config.local_vector_index_path,
+            [IndexedChunk("n1", "text", node_to_metadata_dict(node))],
+            np.array([[1.0, 0.0]], dtype=np.float32),
+        )
+        results = llama_index.query_results("query")
+        assert [result.node.ref_doc_id for result in results] == ["doc1"]
+        self.vector_store_index.from_vector_store.assert_not_called()
+
+    def test_it_leaves_skipping_unchanged_documents_to_the_pipeline(self, mocker):
+        """
+        It runs every document through the pipeline, which skips those whose
+        content hash is already stored, returning the nodes it embedded
+        """
+        llama_index = LlamaIndex(self.config)
+        documents = cast(
+            list[DocumentWithText],
+            [
+                MagicMock(id="doc1", embeddable_text="same"),
+                MagicMock(id="doc2", embeddable_text="new text"),
+            ],
+        )
+        pipeline = mocker.patch.object(llama_index, "make_pipeline").return_value
+        pipeline.run.return_value = ["nodes"]
+        assert llama_index.index_documents(documents) == ["nodes"]
+        run_documents = pipeline.run.call_args.kwargs["documents"]
+        assert [document.doc_id for document in run_documents] == ["doc1", "doc2"]
+        assert run_documents[0].hash == LlamaDocument(text="same", doc_id="doc1").hash
+
+    def test_it_lists_every_stored_document_hash(self):
+        """
+        It lists the hash of every stored document, however many there are,
+        leaving out the entries of nodes
+        """
+        self.store_hashes({f"doc{n}": f"hash{n}" for n in range(25)})
+        self.hits["metadata"].append(
+            {"_id": "node", "_source": {"doc_hash": "hash", "ref_doc_id": "doc1"}}
+        )
+        hashes = LlamaIndex(self.config).get_stored_document_hashes()
+        assert hashes == {f"doc{n}": f"hash{n}" for n in range(25)}
+
+    def test_it_lists_no_hashes_before_anything_is_indexed(self):
+        """
+        It lists no hashes when the metadata index doesn't exist yet
+        """
+        self.es_client.return_value.indices.exists.return_value = False
+        self.store_hashes({"doc1": "hash1"})
+        assert LlamaIndex(self.config).get_stored_document_hashes() == {}
+
+    def test_it_prunes_removed_documents(self):
+        """
+        It deletes the chunks and docstore entries of every indexed document
+        which is no longer live
+        """
+        llama_index = LlamaIndex(self.config)
+        self.store_hashes({f"doc{n}": f"hash{n}" for n in range(15)})
+        removed_ids = [f"doc{n}" for n in range(1, 15)]
+        assert llama_index.prune_documents({"doc0"}) == removed_ids
+        deleted_ids = [
+            call.args[0] for call in self.vector_store.return_value.delete.mock_calls
+        ]
+        assert deleted_ids == removed_ids
+        self.docstore.return_value.delete_document.assert_any_call(
+            "doc14", raise_error=False
+        )
+        assert self.docstore.return_value.delete_document.call_count == 14
+
+    def test_it_leaves_exporting_to_the_caller_when_asked(self, mocker):
+        """
+        It only exports the local vector index after indexing or pruning
+        when asked to
+        """
+        llama_index = LlamaIndex(self.config)
+        export = mocker.patch.object(llama_index, "export_vector_index")
+        self.store_hashes({"doc1": "hash1"})
+        pipeline = mocker.patch.object(llama_index, "make_pipeline").return_value
+        pipeline.run.return_value = ["nodes"]
+        document = MagicMock(id="doc2", embeddable_text="text")
+        llama_index.index_documents([document], export=False)
+        llama_index.prune_documents({"doc2"}, export=False)
+        export.assert_not_called()
+        llama_index.index_documents([document])
+        export.assert_called_once()
+
+    def test_it_works_on_index_versions(self):
+        """
+        It indexes into versioned indexes named after the configured ones,
+        without touching the local vector index
+        """
+        self.config.local_vector_index_path = "/tmp/index"
+        versioned = LlamaIndex(self.config).for_version(3)
+        assert versioned.config.es_embeddings_index == "embeddings-v3"
+        assert versioned.config.es_node_index == "nodes-v3"
+        assert versioned.config.es_kv_index == "kv-v3"
+        assert versioned.local_vector_index is None
+
+    def test_it_creates_index_versions_with_vector_mappings(self, mocker):
+        """
+        It creates the next index version with the dense vector mappings of
+        the embedding model, quantized if configured
+        """
+        index_versions = mocker.patch("ddlh.rag.llamaindex.IndexVersions")
+        index_versions.return_value = AsyncMock(next_version=AsyncMock(return_value=2))
+        config = replace(
+            self.config,
+            provider="local",
+            local_embedding_dimensions=8,
+            es_quantize_vectors=True,
+        )
+        assert LlamaIndex(config).create_index_version() == 2
+        version, mappings = index_versions.return_value.create.call_args.args
+        assert version == 2
+        vector_mapping = mappings["embeddings"]["properties"]["embedding"]
+        assert vector_mapping["dims"] == 8
+        assert vector_mapping["index_options"] == {"type": "int8_hnsw"}
+
+    def test_it_only_swaps_in_complete_index_versions(self, mocker):
+        """
+        It deletes index versions missing any of the documents instead of
+        swapping them in, and prunes old versions after a swap, however many
+        documents there are
+        """
+        index_versions = mocker.patch("ddlh.rag.llamaindex.IndexVersions")
+        versions = index_versions.return_value = AsyncMock()
+        self.es_client.return_value.count = AsyncMock(return_value={"count": 3})
+        document_ids = [f"doc{n}" for n in range(15)]
+        self.store_hashes(
+            {doc_id: "hash" for doc_id in document_ids}, index="metadata-v2"
+        )
+        llama_index = LlamaIndex(self.config)
+        with pytest.raises(IndexVersionError):
+            llama_index.swap_index_version(2, document_ids + ["missing"])
+        versions.delete.assert_awaited_once_with(2)
+        versions.swap.assert_not_awaited()
+
+        versions.reset_mock()
+        llama_index.swap_index_version(2, document_ids)
+        versions.finish.assert_awaited_once_with(2)
+        versions.swap.assert_awaited_once_with(2)
+        versions.prune.assert_awaited_once_with(2)
+        versions.delete.assert_not_awaited()
+
+    def test_it_embeds_documents_from_stored_chunks(self):
+        """
+        It averages the chunk embeddings stored in elasticsearch by document,
+        skipping chunks without an embedding or a document
+        """
+        self.hits["embeddings"] = [
+            {"_source": {"metadata": {"ref_doc_id": "doc1"}, "embedding": [1.0, 0]}},
+            {"_source": {"metadata": {"ref_doc_id": "doc1"}, "embedding": [0, 1.0]}},
+            {"_source": {"metadata": {"ref_doc_id": "doc2"}, "embedding": [0, 2.0]}},
+            {"_source": {"metadata": {"ref_doc_id": "doc3"}}},
+            {"_source": {"embedding": [1.0, 0]}},
+        ]
+        embeddings = LlamaIndex(self.config).get_document_embeddings()
+        assert list(embeddings) == ["doc1", "doc2"]
+        assert embeddings["doc1"] == pytest.approx([2**-0.5, 2**-0.5])
+        assert embeddings["doc2"] == pytest.approx([0.0, 1.0])
+
+
+class TestLlamaIndexInGreenlets:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.es_client = mocker.patch("ddlh.rag.llamaindex.AsyncElasticsearch")
+        self.es_client.return_value.close = AsyncMock()
+        self.loops: list[asyncio.AbstractEventLoop] = []
+        self.added_ids: list[str] = []
+
+        async def query(*args, **kwargs):
+            self.loops.append(asyncio.get_running_loop())
+            node = TextNode(
+                id_="n1",
+                text="text",
+                relationships={
+                    NodeRelationship.SOURCE: RelatedNodeInfo(node_id="doc1")
+                },
+            )
+            return VectorStoreQueryResult(nodes=[node], similarities=[1.0], ids=["n1"])
+
+        async def add(nodes, **kwargs):
+            self.loops.append(asyncio.get_running_loop())
+            self.added_ids.extend(node.node_id for node in nodes)
+            return [node.node_id for node in nodes]
+
+        async def record(*args, **kwargs):
+            self.loops.append(asyncio.get_running_loop())
+
+        async def get_all(*args, **kwargs):
+            self.loops.append(asyncio.get_running_loop())
+            return {}
+
+        mocker.patch.object(ElasticsearchVectorStore, "aquery", side_effect=query)
+        mocker.patch.object(ElasticsearchVectorStore, "async_add", side_effect=add)
+        mocker.patch.object(ElasticsearchKVStore, "aget", side_effect=record)
+        mocker.patch.object(ElasticsearchKVStore, "aget_all", side_effect=get_all)
+        mocker.patch.object(ElasticsearchKVStore, "aput_all", side_effect=record)
+        self.config = LlamaIndexConfig(
+            embedding_model_name="mistral-embed",
+            llm_model_name="mistral-large",
+            es_url="http://elasticsearch:9200",
+            es_username=None,
+            es_password=None,
+            es_embeddings_index="embeddings",
+            es_embeddings_field="embedding",
+            es_kv_index="kv",
+            es_node_index="nodes",
+            es_ref_doc_index="ref-docs",
+            es_metadata_index="metadata",
+            mistral_api_key="key",
+            embedding_chunk_size=512,
+            embedding_chunk_overlap=64,
+            retrieval_top_k=5,
+            safe_prompt=True,
+            provider="local",
+            local_embedding_dimensions=8,
+        )
+        self.llama_index = LlamaIndex(self.config)
+        yield
+        self.llama_index.close()
+
+    def test_it_shares_one_event_loop_between_greenlets(self):
+        """
+        It queries and indexes from any greenlet, making every elasticsearch
+        request on one event loop with one client
+        """
+
+        def query_and_index(n):
+            results = self.llama_index.query_results(f"query {n}")
+            document = cast(
+                DocumentWithText,
+                MagicMock(id=f"doc{n}", embeddable_text=f"text {n}"),
+            )
+            self.llama_index.index_documents([document])
+            return [result.node.node_id for result in results]
+
+        greenlets = [gevent.spawn(query_and_index, n) for n in range(4)]
+        gevent.joinall(greenlets, raise_error=True)
+        assert [greenlet.value for greenlet in greenlets] == [["n1"]] * 4
+        assert len(self.added_ids) == 4
+        assert set(self.loops) == {self.llama_index.event_loop.loop}
+        self.es_client.assert_called_once()
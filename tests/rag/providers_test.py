@@ -0,0 +1,71 @@
+import json
+
+import pytest  # type: ignore
+from llama_index.core import get_response_synthesizer
+from llama_index.core.response_synthesizers import ResponseMode
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from ddlh.rag.providers import EchoLLM, HashingEmbedding
+from ddlh.rag.summarization import BatchedSummarizer
+
+
+def similarity(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class TestHashingEmbedding:
+
+    def test_it_embeds_deterministically(self):
+        """
+        It gives the same unit length embedding to the same text
+        """
+        embedding = HashingEmbedding(dimensions=64)
+        vector = embedding.get_query_embedding("Circular design")
+        assert len(vector) == 64
+        assert similarity(vector, vector) == pytest.approx(1.0)
+        assert HashingEmbedding(dimensions=64).get_text_embedding(
+            "circular DESIGN"
+        ) == pytest.approx(vector)
+
+    def test_it_embeds_texts_sharing_words_closer(self):
+        """
+        It gives texts sharing words more similar embeddings
+        """
+        embedding = HashingEmbedding(dimensions=256)
+        query = embedding.get_query_embedding("circular design")
+        near = embedding.get_text_embedding("design for a circular economy")
+        far = embedding.get_text_embedding("open source hardware")
+        assert similarity(query, near) > similarity(query, far)
+
+
+class TestEchoLLM:
+
+    def test_it_synthesizes_responses(self):
+        """
+        It can be used to synthesize responses, without network access
+        """
+        synthesizer = get_response_synthesizer(
+            llm=EchoLLM(), response_mode=ResponseMode.REFINE
+        )
+        response = synthesizer.synthesize(
+            "Summarize", nodes=[NodeWithScore(node=TextNode(text="Some text"))]
+        )
+        assert response.response.startswith("This document is a local response")
+
+    def test_it_answers_batched_summary_prompts(self):
+        """
+        It answers JSON prompts as the batched summarizer expects
+        """
+        llm = EchoLLM()
+        summarizer = BatchedSummarizer(
+            lambda prompt: llm.complete(
+                prompt, response_format={"type": "json_object"}
+            ).text,
+            context_tokens=1000,
+        )
+        summary = summarizer.summarize("{query}\n{context}", "query", [["a"], ["b"]])
+        assert summary is not None
+        assert [index for (index, _summary) in summary.summaries] == [0, 1]
+        assert json.loads(
+            llm.complete("Document 1:", response_format={"type": "json_object"}).text
+        )["documents"][0]["relevant"]
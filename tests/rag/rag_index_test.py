@@ -0,0 +1,300 @@
+import json
+from typing import cast
+from unittest.mock import MagicMock
+
+import fakeredis
+import numpy as np
+import pytest  # type: ignore
+from llama_index.core.base.response.schema import Response
+from llama_index.core.schema import (
+    NodeRelationship,
+    NodeWithScore,
+    RelatedNodeInfo,
+    TextNode,
+)
+
+from ddlh.models import DocumentSummary, DocumentWithText
+from ddlh.rag import RAGIndex
+from ddlh.rag.semantic_cache import SemanticQueryCache
+from ddlh.rag.summarization import BatchedSummarizer
+from ddlh.redis_cache import RedisCache, RedisCacheConfig
+
+
+def make_result(doc_id, score):
+    node = TextNode(
+        text="text",
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)},
+    )
+    return NodeWithScore(node=node, score=score)
+
+
+class TestRAGIndex:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self):
+        self.llamaindex = MagicMock()
+        self.llamaindex.get_document_id_for_result.side_effect = (
+            lambda result: result.node.relationships[NodeRelationship.SOURCE].node_id
+        )
+        self.repository = MagicMock()
+        self.repository.has_document.side_effect = lambda id: id in {"doc1", "doc2"}
+        self.repository_provider = MagicMock()
+        self.repository_provider.get.return_value = self.repository
+        self.cache = MagicMock()
+        self.cache.get_if_cached.return_value = None
+        self.rag_index = RAGIndex(
+            self.llamaindex, self.repository_provider, self.cache, 3
+        )
+
+    def test_it_collates_results_by_known_document(self):
+        """
+        It groups results by document, ranked by their average score, and
+        drops results for documents that aren't in the repository
+        """
+        results = [
+            make_result("doc1", 0.5),
+            make_result("doc2", 0.9),
+            make_result("gone", 1.0),
+            make_result("doc1", 0.7),
+        ]
+        docs = self.rag_index._collate_and_rerank_by_document_ids(results)
+        assert [doc["doc_id"] for doc in docs] == ["doc2", "doc1"]
+        assert docs[1]["score"] == pytest.approx(0.6)
+        assert docs[1]["results"] == [results[0], results[3]]
+        self.llamaindex.docstore.get_document.assert_not_called()
+
+    def test_it_serves_precomputed_related_documents(self):
+        """
+        It looks related documents up in the precomputed table, without
+        querying the index
+        """
+        related_documents = MagicMock()
+        related_documents.get.return_value = ["doc2", "gone", "doc3"]
+        self.repository.get_document.side_effect = lambda id: (
+            None if id == "gone" else MagicMock(id=id)
+        )
+        rag_index = RAGIndex(
+            self.llamaindex, self.repository_provider, self.cache, 3, related_documents
+        )
+        document = MagicMock(id="doc1")
+        related = rag_index.get_related_documents(document, limit=1)
+        assert [doc.id for doc in related] == ["doc2"]
+        related_documents.get.assert_called_once_with("doc1")
+        self.llamaindex.query_results.assert_not_called()
+
+    def test_it_updates_related_documents_when_indexing(self):
+        """
+        It rebuilds the related documents of every known document from the
+        stored chunk embeddings, not only those of the indexed documents
+        """
+        related_documents = MagicMock()
+        embeddings = {"doc1": np.array([1.0, 0.0], dtype=np.float32)}
+        self.llamaindex.get_document_embeddings.return_value = embeddings
+        self.repository.documents = {"doc1": MagicMock(), "doc2": MagicMock()}
+        rag_index = RAGIndex(
+            self.llamaindex, self.repository_provider, self.cache, 3, related_documents
+        )
+        rag_index.index_documents([])
+        related_documents.rebuild.assert_called_once_with(embeddings, ["doc1", "doc2"])
+
+    def test_it_reports_document_summaries_as_they_are_ready(self):
+        """
+        It passes each relevant document summary to the callback, in rank
+        order, before generating the top sentence
+        """
+        self.cache.cached.side_effect = lambda prefix, args, func, **kwargs: func(*args)
+        self.llamaindex.query_results.return_value = [
+            make_result("doc1", 0.9),
+            make_result("doc2", 0.5),
+        ]
+        events = []
+
+        def synthesize(prompt, nodes):
+            if "one or two sentence" in prompt:
+                events.append("top sentence")
+                return Response("Top sentence")
+            return Response(f"This document is about {nodes[0].node.ref_doc_id}")
+
+        self.llamaindex.synthesize.side_effect = synthesize
+        result = self.rag_index.query(
+            "query", lambda summary: events.append(summary.document)
+        )
+        assert events == ["doc1", "doc2", "top sentence"]
+        assert [summary.summary for summary in result.summary.document_summaries] == [
+            " is about doc1",
+            " is about doc2",
+        ]
+
+    def test_it_reuses_document_summaries(self, mocker):
+        """
+        It caches each document summary by normalized query, document and
+        retrieved chunks, so retries and similar queries reuse them
+        """
+        mocker.patch(
+            "ddlh.redis_cache.redis.from_url", return_value=fakeredis.FakeRedis()
+        )
+        cache = RedisCache(
+            RedisCacheConfig(redis_url="redis://", prefix="queries", timeout=None)
+        )
+        rag_index = RAGIndex(self.llamaindex, self.repository_provider, cache, 3)
+        self.llamaindex.query_results.return_value = [make_result("doc1", 0.9)]
+        calls = []
+
+        def synthesize(prompt, nodes):
+            calls.append(prompt)
+            if "one or two sentence" in prompt and len(calls) == 2:
+                raise RuntimeError("Top sentence failed")
+            return Response("This document is relevant")
+
+        self.llamaindex.synthesize.side_effect = synthesize
+        with pytest.raises(RuntimeError):
+            rag_index.query("Climate change")
+        rag_index.query("Climate change")
+        rag_index.query("climate  CHANGE")
+        document_summary_calls = [c for c in calls if "one sentence" in c]
+        assert len(document_summary_calls) == 1
+
+        self.llamaindex.query_results.return_value = [
+            make_result("doc1", 0.9),
+            make_result("doc1", 0.8),
+        ]
+        rag_index.query("Climate change?")
+        rag_index.query("climate change")
+        document_summary_calls = [c for c in calls if "one sentence" in c]
+        assert len(document_summary_calls) == 3
+
+    def test_it_serves_summaries_of_similar_queries(self, mocker):
+        """
+        It serves the summary of a previously answered query which means the
+        same, without generating a new one
+        """
+        mocker.patch(
+            "ddlh.redis_cache.redis.from_url", return_value=fakeredis.FakeRedis()
+        )
+        cache = RedisCache(
+            RedisCacheConfig(redis_url="redis://", prefix="queries", timeout=None)
+        )
+        rag_index = RAGIndex(
+            self.llamaindex,
+            self.repository_provider,
+            cache,
+            3,
+            semantic_cache=SemanticQueryCache(cache, threshold=0.95, max_queries=10),
+        )
+        self.llamaindex.get_query_embedding.return_value = [1.0, 0.0]
+        self.llamaindex.query_results.return_value = [make_result("doc1", 0.9)]
+        self.llamaindex.synthesize.return_value = Response("This document is good")
+        assert rag_index.get_cached_query_response("circular design") is None
+        rag_index.query("circular design")
+        self.llamaindex.synthesize.reset_mock()
+
+        cached = rag_index.get_cached_query_response("Circular-Design")
+        assert cached is not None
+        assert cached.query == "circular design"
+        assert rag_index.query("circularity design").query == "circular design"
+        self.llamaindex.synthesize.assert_not_called()
+
+    def test_it_summarizes_queries_in_one_call_in_batched_mode(self):
+        """
+        In batched mode, it generates the whole summary with one LLM call,
+        falling back to one call per document when the answer is invalid
+        """
+        self.cache.cached.side_effect = lambda prefix, args, func, **kwargs: func(*args)
+        self.llamaindex.query_results.return_value = [
+            make_result("doc1", 0.9),
+            make_result("doc2", 0.5),
+        ]
+        self.llamaindex.complete_json.return_value = json.dumps(
+            {
+                "documents": [
+                    {"number": 1, "relevant": True, "summary": "This document one"},
+                    {"number": 2, "relevant": False, "summary": ""},
+                ],
+                "top_sentence": "Top sentence",
+            }
+        )
+        rag_index = RAGIndex(
+            self.llamaindex,
+            self.repository_provider,
+            self.cache,
+            3,
+            batched_summarizer=BatchedSummarizer(self.llamaindex.complete_json, 1000),
+        )
+        events: list[DocumentSummary] = []
+        result = rag_index.query("query", events.append)
+        assert result.summary.top_sentence == "Top sentence"
+        assert [s.document for s in result.summary.document_summaries] == ["doc1"]
+        assert [s.document for s in events] == ["doc1"]
+        self.llamaindex.complete_json.assert_called_once()
+        self.llamaindex.synthesize.assert_not_called()
+
+        self.llamaindex.complete_json.return_value = "Sorry"
+        self.llamaindex.synthesize.return_value = Response("This document is good")
+        result = rag_index.query("query")
+        assert [s.document for s in result.summary.document_summaries] == [
+            "doc1",
+            "doc2",
+        ]
+
+    def test_it_prunes_documents_which_are_no_longer_live(self):
+        """
+        It prunes other documents from the index when asked to, unless there
+        are no documents at all
+        """
+        self.llamaindex.index_documents.return_value = []
+        documents = cast(
+            list[DocumentWithText], [MagicMock(id="doc1"), MagicMock(id="doc2")]
+        )
+        self.rag_index.index_documents(documents, prune=True)
+        self.llamaindex.prune_documents.assert_called_once_with(
+            {"doc1", "doc2"}, export=False
+        )
+        self.llamaindex.prune_documents.reset_mock()
+        self.rag_index.index_documents([], prune=True)
+        self.rag_index.index_documents(documents)
+        self.llamaindex.prune_documents.assert_not_called()
+
+    def test_it_adds_documents_without_refreshing_derived_indexes(self):
+        """
+        It indexes added documents without exporting the vector index or
+        rebuilding related documents, which is left to finishing indexing
+        """
+        related_documents = MagicMock()
+        self.llamaindex.index_documents.return_value = []
+        rag_index = RAGIndex(
+            self.llamaindex, self.repository_provider, self.cache, 3, related_documents
+        )
+        documents = cast(list[DocumentWithText], [MagicMock(id="doc1")])
+        rag_index.add_documents(documents)
+        self.llamaindex.index_documents.assert_called_once_with(
+            documents, export=False, version=None
+        )
+        self.llamaindex.export_vector_index.assert_not_called()
+        related_documents.rebuild.assert_not_called()
+
+    def test_it_finishes_indexing(self):
+        """
+        It prunes documents which are not live, exports the vector index and
+        rebuilds related documents once indexing is done
+        """
+        related_documents = MagicMock()
+        self.repository.documents = {"doc1": MagicMock()}
+        rag_index = RAGIndex(
+            self.llamaindex, self.repository_provider, self.cache, 3, related_documents
+        )
+        rag_index.finish_indexing(["doc1"])
+        self.llamaindex.prune_documents.assert_called_once_with(["doc1"], export=False)
+        self.llamaindex.export_vector_index.assert_called_once()
+        related_documents.rebuild.assert_called_once_with(
+            self.llamaindex.get_document_embeddings.return_value, ["doc1"]
+        )
+
+    def test_it_swaps_in_a_reindexed_version(self):
+        """
+        When finishing a reindex, it swaps in the new index version, with
+        the documents it should hold, instead of pruning the live one
+        """
+        self.rag_index.finish_indexing(["doc1"], version=3)
+        self.llamaindex.swap_index_version.assert_called_once_with(3, ["doc1"])
+        self.llamaindex.prune_documents.assert_not_called()
+        self.llamaindex.export_vector_index.assert_called_once()
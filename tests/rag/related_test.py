@@ -0,0 +1,67 @@
+import fakeredis
+import numpy as np
+import pytest  # type: ignore
+
+from ddlh.rag.related import RelatedDocuments, document_embeddings
+from ddlh.redis_cache import RedisCache, RedisCacheConfig
+
+
+class TestRelatedDocuments:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.redis = fakeredis.FakeRedis()
+        mocker.patch("ddlh.redis_cache.redis.from_url", return_value=self.redis)
+        self.cache = RedisCache(
+            RedisCacheConfig(redis_url="redis://", prefix="related", timeout=None)
+        )
+
+    def test_it_averages_chunk_embeddings(self):
+        """
+        It embeds each document as the unit length mean of its chunks
+        """
+        embeddings = document_embeddings(
+            [
+                ("doc1", [1.0, 0.0]),
+                ("doc1", [0.0, 1.0]),
+                ("doc2", [0.0, 3.0]),
+                ("doc3", [0.0, 0.0]),
+            ]
+        )
+        assert list(embeddings) == ["doc1", "doc2"]
+        assert embeddings["doc1"] == pytest.approx([2**-0.5, 2**-0.5])
+        assert embeddings["doc2"] == pytest.approx([0.0, 1.0])
+
+    def test_it_ranks_the_most_similar_documents(self):
+        """
+        It stores the most similar other documents for each document, most
+        similar first
+        """
+        related = RelatedDocuments(self.cache, limit=2)
+        embeddings = {
+            "a": np.array([1.0, 0.0], dtype=np.float32),
+            "b": np.array([0.8, 0.6], dtype=np.float32),
+            "c": np.array([0.0, 1.0], dtype=np.float32),
+            "d": np.array([-1.0, 0.0], dtype=np.float32),
+        }
+        related.rebuild(embeddings, ["a", "b", "c", "d", "unknown"])
+        assert related.get("a") == ["b", "c"]
+        assert related.get("b") == ["a", "c"]
+        assert related.get("c") == ["b", "a"]
+        assert related.get("unknown") is None
+
+    def test_it_only_relates_the_given_documents(self):
+        """
+        It leaves out embedded documents which aren't given, such as
+        documents which are no longer live
+        """
+        related = RelatedDocuments(self.cache, limit=5)
+        embeddings = {
+            "a": np.array([1.0, 0.0], dtype=np.float32),
+            "b": np.array([0.0, 1.0], dtype=np.float32),
+            "gone": np.array([1.0, 0.0], dtype=np.float32),
+        }
+        related.rebuild(embeddings, ["a", "b"])
+        assert related.get("a") == ["b"]
+        assert related.get("b") == ["a"]
+        assert related.get("gone") is None
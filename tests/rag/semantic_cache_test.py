@@ -0,0 +1,126 @@
+from unittest.mock import MagicMock
+
+import fakeredis
+import pytest  # type: ignore
+
+from ddlh.rag.semantic_cache import SemanticQueryCache, normalize_query
+from ddlh.redis_cache import RedisCache, RedisCacheConfig
+
+EMBEDDINGS = {
+    "circular design": [1.0, 0.0, 0.0],
+    "designing for circularity": [0.98, 0.2, 0.0],
+    "open source hardware": [0.0, 1.0, 0.0],
+}
+
+
+class TestSemanticQueryCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        mocker.patch(
+            "ddlh.redis_cache.redis.from_url", return_value=fakeredis.FakeRedis()
+        )
+        self.cache = RedisCache(
+            RedisCacheConfig(redis_url="redis://", prefix="queries", timeout=None)
+        )
+        self.embed = MagicMock(side_effect=lambda text: EMBEDDINGS[text])
+
+    def test_it_normalizes_queries(self):
+        """
+        It ignores case, punctuation and whitespace
+        """
+        assert normalize_query(" Circular-Design ") == "circular design"
+        assert normalize_query("circular_design?") == "circular design"
+
+    def test_it_matches_normalized_queries_without_embedding_them(self):
+        """
+        It finds queries which are the same once normalized, without
+        calling the embedding model
+        """
+        semantic_cache = SemanticQueryCache(self.cache, threshold=0.95, max_queries=10)
+        semantic_cache.add("circular design", self.embed)
+        self.embed.reset_mock()
+        assert semantic_cache.find("Circular-Design ", self.embed) == (
+            "circular design"
+        )
+        self.embed.assert_not_called()
+
+    def test_it_matches_similar_queries(self):
+        """
+        It finds the most similar answered query above its threshold
+        """
+        semantic_cache = SemanticQueryCache(self.cache, threshold=0.95, max_queries=10)
+        semantic_cache.add("circular design", self.embed)
+        semantic_cache.add("open source hardware", self.embed)
+        assert semantic_cache.find("Designing for circularity", self.embed) == (
+            "circular design"
+        )
+        strict_cache = SemanticQueryCache(self.cache, threshold=0.99, max_queries=10)
+        assert strict_cache.find("Designing for circularity", self.embed) is None
+
+    def test_it_sees_queries_answered_by_other_processes(self):
+        """
+        It reloads the answered queries when another process adds one
+        """
+        semantic_cache = SemanticQueryCache(self.cache, threshold=0.95, max_queries=10)
+        assert semantic_cache.find("circular design", self.embed) is None
+        SemanticQueryCache(self.cache, threshold=0.95, max_queries=10).add(
+            "circular design", self.embed
+        )
+        assert semantic_cache.find("circular design", self.embed) == ("circular design")
+
+    def test_it_keeps_the_most_recently_answered_queries(self):
+        """
+        It evicts the least recently answered queries beyond its maximum,
+        from redis and from memory
+        """
+        semantic_cache = SemanticQueryCache(self.cache, threshold=0.95, max_queries=2)
+        semantic_cache.add("circular design", self.embed)
+        assert semantic_cache.find("circular design", self.embed) == "circular design"
+        semantic_cache.add("open source hardware", self.embed)
+        semantic_cache.add("designing for circularity", self.embed)
+        assert semantic_cache.find("circular design", self.embed) == (
+            "designing for circularity"
+        )
+        assert semantic_cache.find("open source hardware", self.embed) == (
+            "open source hardware"
+        )
+        assert set(self.cache.redis.hkeys("queries_semantic_queries")) == {
+            b"open source hardware",
+            b"designing for circularity",
+        }
+        assert self.cache.redis.zcard("queries_semantic_order") == 2
+
+    def test_it_only_loads_new_queries(self):
+        """
+        It only fetches the queries answered since it last looked
+        """
+        semantic_cache = SemanticQueryCache(self.cache, threshold=0.95, max_queries=10)
+        semantic_cache.add("circular design", self.embed)
+        semantic_cache.find("circular design", self.embed)
+        semantic_cache.add("open source hardware", self.embed)
+        hmget = MagicMock(wraps=self.cache.redis.hmget)
+        self.cache.redis.hmget = hmget
+        assert semantic_cache.find("circular design", self.embed) == "circular design"
+        hmget.assert_called_once_with(
+            "queries_semantic_queries", [b"open source hardware"]
+        )
+        assert semantic_cache.find("open source hardware", self.embed) == (
+            "open source hardware"
+        )
+        hmget.assert_called_once()
+
+    def test_it_starts_over_when_redis_is_emptied(self):
+        """
+        It forgets the queries it loaded when the cache is flushed
+        """
+        semantic_cache = SemanticQueryCache(self.cache, threshold=0.95, max_queries=10)
+        semantic_cache.add("circular design", self.embed)
+        semantic_cache.add("open source hardware", self.embed)
+        semantic_cache.find("circular design", self.embed)
+        self.cache.redis.flushall()
+        semantic_cache.add("open source hardware", self.embed)
+        assert semantic_cache.find("circular design", self.embed) is None
+        assert semantic_cache.find("open source hardware", self.embed) == (
+            "open source hardware"
+        )
@@ -0,0 +1,201 @@
+import json
+import threading
+import time
+
+import pytest  # type: ignore
+
+from ddlh.rag.summarization import (
+    BatchedSummarizer,
+    BatchedSummary,
+    ConcurrentSummarizer,
+)
+
+
+class TestConcurrentSummarizer:
+
+    def test_it_keeps_relevant_summaries_in_rank_order(self):
+        """
+        It returns the first relevant summaries in rank order, whatever
+        order they finish in
+        """
+        delays = {"a": 0.05, "b": 0.0, "c": 0.02, "d": 0.0}
+
+        def summarize(candidate):
+            time.sleep(delays[candidate])
+            return candidate.upper()
+
+        summarizer: ConcurrentSummarizer[str, str] = ConcurrentSummarizer(concurrency=4)
+        summaries = summarizer.first_relevant(
+            ["a", "b", "c", "d"], summarize, lambda s: s != "B", limit=2
+        )
+        assert summaries == [("a", "A"), ("c", "C")]
+
+    def test_it_runs_summaries_concurrently_within_its_limit(self):
+        """
+        It runs up to `concurrency` summaries at once, and no more
+        """
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def summarize(candidate):
+            with lock:
+                running.append(candidate)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(candidate)
+            return candidate
+
+        summarizer: ConcurrentSummarizer[int, int] = ConcurrentSummarizer(concurrency=3)
+        summaries = summarizer.first_relevant(
+            list(range(9)), summarize, lambda s: True, limit=9
+        )
+        assert [candidate for (candidate, _s) in summaries] == list(range(9))
+        assert max(peak) == 3
+
+    def test_it_stops_once_it_has_enough_summaries(self):
+        """
+        It cancels summaries which haven't started once it has enough
+        relevant ones
+        """
+        started = []
+
+        def summarize(candidate):
+            started.append(candidate)
+            time.sleep(0.02)
+            return candidate
+
+        summarizer: ConcurrentSummarizer[int, int] = ConcurrentSummarizer(concurrency=1)
+        summaries = summarizer.first_relevant(
+            [1, 2, 3, 4, 5], summarize, lambda s: True, limit=1
+        )
+        time.sleep(0.1)
+        assert summaries == [(1, 1)]
+        assert started[0] == 1
+        assert len(started) <= 2
+
+    def test_it_skips_summaries_which_time_out(self):
+        """
+        It moves on without summaries which take longer than its timeout
+        """
+        release = threading.Event()
+
+        def summarize(candidate):
+            if candidate == "slow":
+                release.wait(1)
+            return candidate
+
+        summarizer: ConcurrentSummarizer[str, str] = ConcurrentSummarizer(
+            concurrency=2, timeout=0.05
+        )
+        summaries = summarizer.first_relevant(
+            ["slow", "fast"], summarize, lambda s: True, limit=2
+        )
+        release.set()
+        assert summaries == [("fast", "fast")]
+
+    def test_it_times_summaries_from_when_they_start(self):
+        """
+        It waits at most `timeout` seconds for each summary from when it
+        started, rather than from when it got round to waiting for it
+        """
+        release = threading.Event()
+
+        def summarize(candidate):
+            if candidate.startswith("slow"):
+                release.wait(1)
+            return candidate
+
+        summarizer: ConcurrentSummarizer[str, str] = ConcurrentSummarizer(
+            concurrency=3, timeout=0.1
+        )
+        start = time.monotonic()
+        summaries = summarizer.first_relevant(
+            ["slow1", "slow2", "fast"], summarize, lambda s: True, limit=3
+        )
+        elapsed = time.monotonic() - start
+        release.set()
+        assert summaries == [("fast", "fast")]
+        assert elapsed < 0.18
+
+    def test_it_waits_for_summaries_to_start(self):
+        """
+        It gives summaries queued behind others their whole timeout once
+        they start
+        """
+
+        def summarize(candidate):
+            time.sleep(0.06)
+            return candidate
+
+        summarizer: ConcurrentSummarizer[int, int] = ConcurrentSummarizer(
+            concurrency=1, timeout=0.1
+        )
+        summaries = summarizer.first_relevant(
+            [1, 2, 3], summarize, lambda s: True, limit=3
+        )
+        assert summaries == [(1, 1), (2, 2), (3, 3)]
+
+
+class TestBatchedSummarizer:
+
+    def setup_method(self, method):
+        self.prompts = []
+        self.output = json.dumps(
+            {
+                "documents": [
+                    {"number": 1, "relevant": False, "summary": ""},
+                    {"number": 2, "relevant": True, "summary": "This document b"},
+                    {"number": 3, "relevant": True, "summary": "This document c"},
+                ],
+                "top_sentence": "A top sentence.",
+            }
+        )
+
+    def complete(self, prompt):
+        self.prompts.append(prompt)
+        return self.output
+
+    def test_it_summarizes_every_candidate_in_one_call(self):
+        """
+        It asks for every summary at once, and returns the relevant ones in
+        rank order
+        """
+        summarizer = BatchedSummarizer(self.complete, context_tokens=1000)
+        summary = summarizer.summarize(
+            "{query}: {context}", "query", [["a1"], ["b1", "b2"], ["c1"]]
+        )
+        assert summary == BatchedSummary(
+            "A top sentence.", [(1, "This document b"), (2, "This document c")]
+        )
+        assert self.prompts == [
+            "query: Document 1:\na1\n\nDocument 2:\nb1\n...\nb2\n\nDocument 3:\nc1"
+        ]
+
+    def test_it_fits_excerpts_in_its_token_budget(self):
+        """
+        It includes the first chunk of each candidate before any second
+        chunk, and stops at its token budget
+        """
+        summarizer = BatchedSummarizer(self.complete, context_tokens=3)
+        excerpts = summarizer._select_excerpts([["a1", "a2"], ["b1", "b2"], ["c1"]])
+        assert excerpts == {0: ["a1"], 1: ["b1"], 2: ["c1"]}
+
+    @pytest.mark.parametrize(
+        "output",
+        [
+            "Not JSON",
+            "[]",
+            '{"documents": [], "top_sentence": null}',
+            '{"documents": [{"number": 9, "relevant": true}], "top_sentence": ""}',
+            '{"documents": ["a"], "top_sentence": ""}',
+        ],
+    )
+    def test_it_rejects_invalid_answers(self, output):
+        """
+        It returns nothing when the answer isn't valid
+        """
+        self.output = output
+        summarizer = BatchedSummarizer(self.complete, context_tokens=1000)
+        assert summarizer.summarize("{query}{context}", "query", [["a1"]]) is None
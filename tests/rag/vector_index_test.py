@@ -0,0 +1,78 @@
+import numpy as np
+import pytest  # type: ignore
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+from ddlh.rag.vector_index import IndexedChunk, LocalVectorIndex, write_vector_index
+
+
+def make_chunk(node_id, doc_id):
+    node = TextNode(
+        id_=node_id,
+        text=f"text of {node_id}",
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)},
+    )
+    return IndexedChunk(node_id, node.text, node_to_metadata_dict(node))
+
+
+class TestLocalVectorIndex:
+
+    @pytest.fixture(autouse=True)
+    def setup_index(self, tmp_path):
+        self.path = str(tmp_path / "vectors.bin")
+        self.chunks = [
+            make_chunk("n1", "doc1"),
+            make_chunk("n2", "doc1"),
+            make_chunk("n3", "doc2"),
+        ]
+        self.embeddings = np.array(
+            [[2.0, 0.0], [0.6, 0.8], [0.0, 1.0]], dtype=np.float32
+        )
+
+    def test_it_returns_the_most_similar_chunks(self):
+        """
+        It returns the top k chunks by cosine similarity, best first, as
+        nodes pointing to their documents
+        """
+        write_vector_index(self.path, self.chunks, self.embeddings)
+        results = LocalVectorIndex(self.path).query([1.0, 0.1], top_k=2)
+        assert results is not None
+        assert [result.node.node_id for result in results] == ["n1", "n2"]
+        assert results[0].score == pytest.approx(1 / np.hypot(1.0, 0.1))
+        assert results[0].node.ref_doc_id == "doc1"
+        assert results[0].node.get_content() == "text of n1"
+
+    def test_it_memory_maps_the_embeddings(self):
+        """
+        It maps the embeddings from the file rather than reading them
+        """
+        write_vector_index(self.path, self.chunks, self.embeddings)
+        index = LocalVectorIndex(self.path)
+        index.query([1.0, 0.0], top_k=1)
+        assert index._loaded is not None
+        assert isinstance(index._loaded.embeddings, np.memmap)
+
+    def test_it_reloads_replaced_files(self):
+        """
+        It picks up a new file written in place of the old one
+        """
+        index = LocalVectorIndex(self.path)
+        assert index.query([1.0, 0.0], top_k=1) is None
+        write_vector_index(self.path, self.chunks[:1], self.embeddings[:1])
+        results = index.query([1.0, 0.0], top_k=3)
+        assert results is not None
+        assert len(results) == 1
+        write_vector_index(self.path, self.chunks, self.embeddings)
+        results = index.query([1.0, 0.0], top_k=3)
+        assert results is not None
+        assert len(results) == 3
+
+    def test_it_ignores_unusable_files(self):
+        """
+        It returns nothing for corrupt files, or embeddings of another size
+        """
+        write_vector_index(self.path, self.chunks, self.embeddings)
+        assert LocalVectorIndex(self.path).query([1.0, 0.0, 0.0], top_k=1) is None
+        with open(self.path, "wb") as file:
+            file.write(b"garbage")
+        assert LocalVectorIndex(self.path).query([1.0, 0.0], top_k=1) is None
@@ -0,0 +1,54 @@
+from unittest.mock import MagicMock, call
+
+import pytest  # type: ignore
+
+from ddlh.rate_limiting import RedisTokenBucket
+
+
+class TestRedisTokenBucket:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.redis = MagicMock()
+        self.acquire_script = MagicMock()
+        self.penalize_script = MagicMock()
+        self.redis.register_script.side_effect = [
+            self.acquire_script,
+            self.penalize_script,
+        ]
+        self.sleep = mocker.patch("ddlh.rate_limiting.sleep")
+        self.bucket = RedisTokenBucket(self.redis, "the_key", rate=5.0, capacity=5)
+
+    def test_acquire_runs_the_script_against_the_shared_key(self):
+        """
+        It takes tokens from the bucket stored in redis under the given key
+        """
+        self.acquire_script.return_value = b"0"
+        self.bucket.acquire()
+        self.acquire_script.assert_called_with(keys=["the_key"], args=[5.0, 5])
+        self.sleep.assert_not_called()
+
+    def test_acquire_waits_until_a_token_is_available(self):
+        """
+        It sleeps for as long as redis says it needs to,
+        then tries again
+        """
+        self.acquire_script.side_effect = [b"0.2", b"0.05", b"0"]
+        self.bucket.acquire()
+        assert self.acquire_script.call_count == 3
+        assert self.sleep.call_args_list == [call(0.2), call(0.05)]
+
+    def test_try_acquire_returns_the_wait_time(self):
+        """
+        try_acquire does not block, but returns the time to wait
+        """
+        self.acquire_script.return_value = b"0.2"
+        assert self.bucket.try_acquire() == 0.2
+        self.sleep.assert_not_called()
+
+    def test_penalize_blocks_the_shared_bucket(self):
+        """
+        penalize blocks the bucket for everyone for the given time
+        """
+        self.bucket.penalize(30.0)
+        self.penalize_script.assert_called_with(keys=["the_key"], args=[30.0])
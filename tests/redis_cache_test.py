@@ -0,0 +1,313 @@
+from unittest.mock import MagicMock
+
+import fakeredis
+import pytest  # type: ignore
+
+from ddlh.redis_cache import RedisCache, RedisCacheConfig
+
+
+class TestRedisCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.redis = fakeredis.FakeRedis()
+        mocker.patch("ddlh.redis_cache.redis.from_url", return_value=self.redis)
+        self.thread = mocker.patch("ddlh.redis_cache.Thread")
+        self.thread.side_effect = lambda target, args, daemon: MagicMock(
+            start=lambda: target(*args)
+        )
+        self.func = MagicMock(return_value={"the": "value"})
+
+    def create_cache(self, timeout=60, stale_timeout=600):
+        config = RedisCacheConfig(
+            redis_url="redis://",
+            prefix="prefix",
+            timeout=timeout,
+            stale_timeout=stale_timeout,
+        )
+        return RedisCache(config)
+
+    def test_it_computes_and_stores_missing_values(self):
+        """
+        It calls the function on a miss, and caches the result
+        """
+        cache = self.create_cache()
+        assert cache.cached("all", ["docs"], self.func) == {"the": "value"}
+        self.func.assert_called_once_with("docs")
+        assert cache.get_if_cached("all", ["docs"]) == {"the": "value"}
+
+    def test_it_serves_fresh_values_from_the_cache(self):
+        """
+        It doesn't call the function again while the value is fresh
+        """
+        cache = self.create_cache()
+        cache.cached("all", ["docs"], self.func)
+        cache.cached("all", ["docs"], self.func)
+        self.func.assert_called_once()
+        self.thread.assert_not_called()
+
+    def test_values_expire_after_the_stale_timeout(self):
+        """
+        Values are kept for the timeout plus the stale timeout
+        """
+        cache = self.create_cache()
+        cache.cached("all", ["docs"], self.func)
+        assert 600 < self.redis.ttl("prefix_all_docs") <= 660
+        assert 0 < self.redis.ttl("prefix_all_docs:fresh") <= 60
+
+    def test_stale_values_are_served_while_refreshing(self):
+        """
+        Once stale, the cached value is returned while a single
+        caller refreshes it in the background
+        """
+        cache = self.create_cache()
+        cache.cached("all", ["docs"], self.func)
+        self.redis.delete("prefix_all_docs:fresh")
+        self.func.return_value = {"new": "value"}
+        self.thread.side_effect = None
+
+        assert cache.cached("all", ["docs"], self.func) == {"the": "value"}
+        assert cache.cached("all", ["docs"], self.func) == {"the": "value"}
+        self.thread.assert_called_once()
+
+        target = self.thread.call_args.kwargs["target"]
+        target(*self.thread.call_args.kwargs["args"])
+        assert cache.cached("all", ["docs"], self.func) == {"new": "value"}
+        assert not self.redis.exists("prefix_all_docs:lock")
+
+    def test_callers_wait_for_the_lock_holder_on_a_miss(self):
+        """
+        On a miss, callers which can't take the lock get the value
+        computed by the caller holding it, rather than computing it again
+        """
+        cache = self.create_cache()
+        cache.config.lock_timeout = 0.1
+        self.redis.lock("prefix_all_docs:lock").acquire()
+        self.redis.set("prefix_all_docs", '{"computed": "elsewhere"}')
+        assert cache.cached("all", ["docs"], self.func) == {"computed": "elsewhere"}
+        self.func.assert_not_called()
+
+    def test_callers_compute_the_value_if_waiting_times_out(self):
+        """
+        If the value doesn't appear while waiting for the lock,
+        callers compute it themselves
+        """
+        cache = self.create_cache()
+        cache.config.lock_timeout = 0.1
+        self.redis.lock("prefix_all_docs:lock").acquire()
+        assert cache.cached("all", ["docs"], self.func) == {"the": "value"}
+        self.func.assert_called_once()
+
+    def test_values_without_timeout_never_expire(self):
+        """
+        Without a timeout, values are stored forever and are always fresh
+        """
+        cache = self.create_cache(timeout=None)
+        cache.cached("query", ["q"], self.func)
+        cache.cached("query", ["q"], self.func)
+        self.func.assert_called_once()
+        assert self.redis.ttl("prefix_query_q") == -1
+
+    def test_serializers(self):
+        """
+        It uses the given serializer and deserializer
+        """
+        cache = self.create_cache()
+        value = cache.cached(
+            "query",
+            ["q"],
+            lambda q: [q],
+            serializer=lambda v: {"items": v},
+            deserializer=lambda attrs: tuple(attrs["items"]),
+        )
+        assert value == ["q"]
+        assert cache.get_if_cached(
+            "query", ["q"], deserializer=lambda attrs: tuple(attrs["items"])
+        ) == ("q",)
+
+    def test_get_many_uses_a_single_mget(self, mocker):
+        """
+        get_many looks up every key in one round trip,
+        returning None for misses
+        """
+        cache = self.create_cache()
+        cache.store("get", ["a"], {"id": "a"})
+        mget = mocker.patch.object(self.redis, "mget", wraps=self.redis.mget)
+        assert cache.get_many("get", [["a"], ["b"]]) == [{"id": "a"}, None]
+        mget.assert_called_once()
+
+    def test_cached_many_computes_only_misses_in_a_batch(self):
+        """
+        cached_many computes only the missing values, with a single call
+        to the batch function, and stores them
+        """
+        cache = self.create_cache()
+        cache.store("get", ["a"], {"id": "a"})
+        batch_func = MagicMock(side_effect=lambda args: [{"id": a[0]} for a in args])
+        values = cache.cached_many(
+            "get", [["a"], ["b"], ["c"]], self.func, batch_func=batch_func
+        )
+        assert values == [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+        batch_func.assert_called_once_with([["b"], ["c"]])
+        self.func.assert_not_called()
+        assert cache.get_many("get", [["b"], ["c"]]) == [{"id": "b"}, {"id": "c"}]
+        assert 0 < self.redis.ttl("prefix_get_b:fresh") <= 60
+
+    def test_cached_many_falls_back_to_func(self):
+        """
+        Without a batch function, cached_many calls func for each miss
+        """
+        cache = self.create_cache()
+        values = cache.cached_many("get", [["a"], ["b"]], lambda id: {"id": id})
+        assert values == [{"id": "a"}, {"id": "b"}]
+
+    def test_cached_many_refreshes_stale_values(self):
+        """
+        cached_many returns stale values, and refreshes them in the background
+        """
+        cache = self.create_cache()
+        cache.store_many("get", [["a"], ["b"]], [{"v": 1}, {"v": 1}])
+        self.redis.delete("prefix_get_b:fresh")
+        batch_func = MagicMock(side_effect=lambda args: [{"v": 2} for _a in args])
+        values = cache.cached_many(
+            "get", [["a"], ["b"]], self.func, batch_func=batch_func
+        )
+        assert values == [{"v": 1}, {"v": 1}]
+        batch_func.assert_called_once_with([["b"]])
+        assert cache.get_many("get", [["a"], ["b"]]) == [{"v": 1}, {"v": 2}]
+
+
+class TestRedisCacheLocalTier:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.redis = fakeredis.FakeRedis()
+        mocker.patch("ddlh.redis_cache.redis.from_url", return_value=self.redis)
+        mocker.patch("ddlh.redis_cache.RedisCache._subscribe")
+        self.func = MagicMock(return_value={"the": "value"})
+        config = RedisCacheConfig(
+            redis_url="redis://",
+            prefix="prefix",
+            timeout=60,
+            local_max_bytes=1024,
+            local_timeout=600,
+        )
+        self.cache = RedisCache(config)
+
+    def test_it_keeps_fresh_values_in_memory(self):
+        """
+        Fresh values are served from memory without going to redis
+        """
+        self.cache.store("query", ["q"], {"the": "value"})
+        first = self.cache.get_if_cached("query", ["q"])
+        self.redis.flushall()
+        assert self.cache.get_if_cached("query", ["q"]) is first
+
+    def test_local_entries_expire_with_redis_freshness(self):
+        """
+        Local entries are kept no longer than the redis freshness timeout
+        """
+        assert self.cache.local is not None
+        assert self.cache.local.ttl == 60
+
+    def test_writes_publish_invalidations(self):
+        """
+        Writing a value drops the local copy, and tells other processes
+        to do the same
+        """
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe("prefix:invalidate")
+        pubsub.get_message(timeout=1)
+        self.cache.store("query", ["q"], {"the": "value"})
+        self.cache.get_if_cached("query", ["q"])
+        self.cache.store("query", ["q"], {"new": "value"})
+        assert self.cache.get_if_cached("query", ["q"]) == {"new": "value"}
+        message = pubsub.get_message(timeout=1)
+        assert message is not None
+        assert message["data"] == b"prefix_query_q"
+
+    def test_invalidation_messages_drop_local_copies(self):
+        """
+        Invalidation messages from other processes drop the local copy
+        """
+        self.cache.store("query", ["q"], {"the": "value"})
+        self.cache.get_if_cached("query", ["q"])
+        self.redis.set("prefix_query_q", '{"new": "value"}')
+        self.cache._on_invalidation({"data": b"prefix_query_q"})
+        assert self.cache.get_if_cached("query", ["q"]) == {"new": "value"}
+
+    def test_stale_values_are_not_kept_in_memory(self):
+        """
+        Stale values are not kept locally, so that they get refreshed
+        """
+        self.cache.store("query", ["q"], {"the": "value"})
+        self.redis.delete("prefix_query_q:fresh")
+        self.cache.get_if_cached("query", ["q"])
+        assert self.cache.local is not None
+        assert self.cache.local.size == 0
+
+
+class TestRedisCacheCodecs:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.redis = fakeredis.FakeRedis()
+        mocker.patch("ddlh.redis_cache.redis.from_url", return_value=self.redis)
+
+    def create_cache(self, **kwargs):
+        return RedisCache(
+            RedisCacheConfig(
+                redis_url="redis://", prefix="prefix", timeout=60, **kwargs
+            )
+        )
+
+    def test_values_written_with_other_codecs_are_readable(self):
+        """
+        Values can be read whatever the codec they were written with
+        """
+        self.create_cache(codec="msgpack", compression="zstd").store(
+            "query", ["q"], {"the": "value"}
+        )
+        self.redis.set("prefix_query_old", '{"plain": "json"}')
+        cache = self.create_cache()
+        assert cache.get_if_cached("query", ["q"]) == {"the": "value"}
+        assert cache.get_if_cached("query", ["old"]) == {"plain": "json"}
+
+    def test_undecodable_values_are_misses(self):
+        """
+        Values which can't be decoded are recomputed
+        """
+        self.redis.set("prefix_query_q", b"\x00?n")
+        cache = self.create_cache()
+        assert cache.cached("query", ["q"], lambda q: {"q": q}) == {"q": "q"}
+
+    def test_size_metrics(self):
+        """
+        size_metrics counts keys and bytes per cache prefix
+        """
+        cache = self.create_cache()
+        cache.store("all", ["documents"], {"a": 1})
+        cache.store("all", ["themes"], {"a": 1})
+        cache.store("query", ["q"], [1, 2, 3])
+        metrics = cache.size_metrics()
+        assert metrics == {
+            "all": {"keys": 2, "bytes": 2 * len(b'\x00jn{"a":1}')},
+            "query": {"keys": 1, "bytes": len(b"\x00jn[1,2,3]")},
+        }
+
+    def test_size_metrics_of_other_types(self):
+        """
+        size_metrics counts the fields of hashes and the members of sorted
+        sets, and keeps prefixes of more than one word together
+        """
+        cache = self.create_cache()
+        cache.store("document_summary", ["q", "doc1"], "summary")
+        self.redis.hset("prefix_semantic_queries", "query", b"1234")
+        self.redis.zadd("prefix_semantic_order", {"query": 1})
+        self.redis.hset("prefix_rate_limit_app1", "tokens", b"5")
+        metrics = cache.size_metrics()
+        assert metrics == {
+            "document_summary": {"keys": 1, "bytes": len(b'\x00jn"summary"')},
+            "semantic": {"keys": 2, "bytes": len(b"query1234") + len(b"query")},
+            "rate_limit": {"keys": 1, "bytes": len(b"tokens5")},
+        }
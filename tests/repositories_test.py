@@ -1,8 +1,16 @@
+from typing import Any
 from unittest.mock import MagicMock, call
 
 import more_itertools as mit
+import pytest  # type: ignore
 
-from ddlh.repositories import DocumentsRepository
+from ddlh.repositories import (
+    DocumentsRepository,
+    DocumentsRepositoryProvider,
+    SnapshotError,
+    snapshot_version,
+)
+from ddlh.utils import url_to_id
 
 
 class TestDocumentsRepository:
@@ -42,7 +50,7 @@ class TestDocumentsRepository:
             {"id": "format2_id", "fields": {"name": "Format 2"}},
         ]
 
-        self.documents = [
+        self.documents: list[dict[str, Any]] = [
             {
                 "id": "doc1_id",
                 "fields": {
@@ -139,13 +147,42 @@ class TestDocumentsRepository:
         calls = self.airtable.all.call_args_list
         assert call("themes") in calls
 
-    def test_it_gets_the_format_for_each_document(self):
+    def test_it_gets_all_formats_in_bulk(self):
         """
-        It gets the corresponding format for each format id encountered
+        It retrieves all rows of the formats table at once, rather than
+        getting the format for each document individually
         """
         self.create_db()
-        calls = self.airtable.get.call_args_list
-        assert call("formats", "format_id") in calls
+        calls = self.airtable.all.call_args_list
+        assert call("formats") in calls
+        self.airtable.get.assert_not_called()
+
+    def test_it_uses_a_constant_number_of_airtable_requests(self):
+        """
+        The number of airtable lookups does not depend on the number of documents
+        """
+        self.create_db()
+        calls = self.airtable.all.call_count
+        self.documents.extend(
+            {**row, "id": row["id"] + "_copy"} for row in list(self.documents)
+        )
+        self.airtable.all.reset_mock()
+        self.create_db()
+        assert self.airtable.all.call_count == calls
+
+    def test_it_sets_the_format_of_each_document(self):
+        """
+        It sets the format name and type from live formats only
+        """
+        db = self.create_db()
+        documents = {doc.link: doc for doc in db.get_all_documents()}
+        assert documents["doc1"].format == "Format"
+        assert documents["doc1"].format_type == "type"
+        assert [doc.link for doc in db.get_documents_for_format_type("type")] == [
+            "doc1",
+            "doc2",
+            "doc3",
+        ]
 
     def test_get_all_documents_returns_live_documents(self):
         """
@@ -239,6 +276,38 @@ class TestDocumentsRepository:
         assert "tag2" in tags2
         assert "tag3" in tags2
 
+    def test_has_document_checks_known_document_ids(self):
+        """
+        has_document is true for the ids of live documents only
+        """
+        db = self.create_db()
+        assert db.has_document(url_to_id("doc1"))
+        assert not db.has_document("missing")
+
+    def test_lookups_for_unknown_names_return_nothing(self):
+        """
+        Looking up unknown themes, tags or format types returns nothing,
+        and does not modify the repository
+        """
+        db = self.create_db()
+        assert db.get_documents_for_tag("missing") == []
+        assert db.get_documents_for_theme("missing") == []
+        assert db.get_documents_for_format_type("missing") == []
+        assert db.get_tags_for_theme("missing") == []
+        assert db.get_theme("missing") is None
+        assert "missing" not in db.get_all_tags()
+
+    def test_postings_store_document_ids(self):
+        """
+        Tag, theme and format postings hold document ids, so lookups
+        don't need to hash links
+        """
+        db = self.create_db()
+        theme = db.get_theme("theme1")
+        assert theme is not None
+        assert theme.documents == [url_to_id("doc1")]
+        assert db.tags["tag1"] == [url_to_id("doc1")]
+
     def test_get_theme_returns_theme_metadata(self):
         """
         get_theme returns metadata for the passed theme
@@ -265,3 +334,185 @@ class TestDocumentsRepository:
         assert len(featured) == 2
         assert featured[0].link == "doc3"
         assert featured[1].link == "doc1"
+
+    def test_get_featured_documents_skips_documents_which_are_not_live(self):
+        """
+        Featured documents which are not live are left out
+        """
+        self.featured_documents.append(
+            {"id": "fd_3", "fields": {"document": ["doc4_id"]}}
+        )
+        db = self.create_db()
+
+        assert [doc.link for doc in db.get_featured_documents()] == ["doc3", "doc1"]
+
+    def test_get_stats(self):
+        """
+        get_stats counts documents, themes, formats and authors
+        """
+        stats = self.create_db().get_stats()
+        assert stats.total_documents == 3
+        assert stats.total_themes == 2
+        assert stats.total_text_format == 0
+        assert stats.total_unique_authors == 3
+
+
+class TestDocumentsRepositorySnapshot(TestDocumentsRepository):
+    """
+    Runs every repository test against a repository restored from a
+    binary snapshot of the original
+    """
+
+    def create_db(self):
+        db = DocumentsRepository(self.airtable, version=7)
+        return DocumentsRepository.from_snapshot(db.to_snapshot())
+
+    def test_snapshot_keeps_the_version(self):
+        """
+        The snapshot records the repository version
+        """
+        snapshot = DocumentsRepository(self.airtable, version=7).to_snapshot()
+        assert snapshot_version(snapshot) == 7
+        assert DocumentsRepository.from_snapshot(snapshot).version == 7
+
+    def test_snapshot_keeps_documents(self):
+        """
+        Documents restored from a snapshot are equal to the originals
+        """
+        db = DocumentsRepository(self.airtable)
+        restored = DocumentsRepository.from_snapshot(db.to_snapshot())
+        assert restored.get_all_documents() == db.get_all_documents()
+        assert restored.get_all_themes() == db.get_all_themes()
+
+    def test_corrupt_snapshots_are_rejected(self):
+        """
+        Snapshots in an unknown format raise a SnapshotError
+        """
+        snapshot = DocumentsRepository(self.airtable).to_snapshot()
+        with pytest.raises(SnapshotError):
+            DocumentsRepository.from_snapshot(b"garbage")
+        with pytest.raises(SnapshotError):
+            DocumentsRepository.from_snapshot(snapshot[:-10])
+
+
+class TestDocumentsRepositoryProvider:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.airtable = MagicMock()
+        self.airtable.all.return_value = []
+        self.now = 1000.0
+        self.monotonic = mocker.patch("ddlh.repositories.monotonic")
+        self.monotonic.side_effect = lambda: self.now
+        self.thread = mocker.patch("ddlh.repositories.Thread")
+        self.thread.side_effect = lambda target, daemon: MagicMock(start=target)
+
+    def create_provider(self, refresh_interval=60, cache=None):
+        return DocumentsRepositoryProvider(
+            self.airtable, cache=cache, refresh_interval=refresh_interval
+        )
+
+    def test_it_builds_the_repository_on_first_use(self):
+        """
+        It builds a repository snapshot the first time it is requested
+        """
+        provider = self.create_provider()
+        assert provider.version == 0
+        repository = provider.get()
+        assert isinstance(repository, DocumentsRepository)
+        assert repository.version == 1
+        assert provider.version == 1
+
+    def test_it_reuses_the_snapshot(self):
+        """
+        It serves the same snapshot to every caller while it is fresh,
+        without reading airtable again
+        """
+        provider = self.create_provider()
+        first = provider.get()
+        calls = self.airtable.all.call_count
+        self.now += 30
+        second = provider.get()
+        assert first is second
+        assert self.airtable.all.call_count == calls
+        self.thread.assert_not_called()
+
+    def test_it_refreshes_stale_snapshots_in_the_background(self):
+        """
+        Once the snapshot is older than the refresh interval, it is rebuilt
+        in a background thread and swapped in with a new version number
+        """
+        provider = self.create_provider()
+        first = provider.get()
+        self.now += 61
+        stale = provider.get()
+        assert stale is first
+        self.thread.assert_called_once()
+        fresh = provider.get()
+        assert fresh is not first
+        assert fresh.version == 2
+
+    def test_it_never_refreshes_without_an_interval(self):
+        """
+        It keeps the first snapshot forever when no refresh interval is set
+        """
+        provider = self.create_provider(refresh_interval=None)
+        first = provider.get()
+        self.now += 1_000_000
+        assert provider.get() is first
+        self.thread.assert_not_called()
+
+    def test_it_publishes_built_snapshots(self):
+        """
+        With a cache, it publishes the snapshots it builds, versioned with
+        a counter shared between processes
+        """
+        cache = MagicMock()
+        cache.get_bytes.return_value = None
+        cache.increment.return_value = 42
+        repository = self.create_provider(cache=cache).get()
+        assert repository.version == 42
+        cache.increment.assert_called_with("repository", ["version"])
+        cache.set_bytes.assert_called_once()
+        prefix, args, snapshot = cache.set_bytes.call_args.args
+        assert (prefix, args) == ("repository", ["snapshot"])
+        assert snapshot_version(snapshot) == 42
+
+    def test_it_loads_published_snapshots(self):
+        """
+        With a cache, it loads a published snapshot instead of reading airtable
+        """
+        snapshot = DocumentsRepository(self.airtable, version=5).to_snapshot()
+        self.airtable.reset_mock()
+        cache = MagicMock()
+        cache.get_bytes.return_value = snapshot
+        repository = self.create_provider(cache=cache).get()
+        assert repository.version == 5
+        self.airtable.all.assert_not_called()
+        cache.set_bytes.assert_not_called()
+
+    def test_it_keeps_the_current_snapshot_if_unchanged(self):
+        """
+        When refreshing, it does not decode a published snapshot
+        with the same version as the current one
+        """
+        cache = MagicMock()
+        cache.get_bytes.return_value = DocumentsRepository(
+            self.airtable, version=5
+        ).to_snapshot()
+        provider = self.create_provider(cache=cache)
+        first = provider.get()
+        self.now += 61
+        provider.get()
+        assert provider.get() is first
+
+    def test_it_rebuilds_on_corrupt_snapshots(self):
+        """
+        It ignores published snapshots which can't be decoded
+        """
+        cache = MagicMock()
+        cache.get_bytes.return_value = b"garbage"
+        cache.increment.return_value = 3
+        repository = self.create_provider(cache=cache).get()
+        assert repository.version == 3
+        self.airtable.all.assert_called()
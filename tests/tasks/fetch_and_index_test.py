@@ -0,0 +1,62 @@
+from unittest.mock import MagicMock
+
+import pytest  # type: ignore
+from flask import Flask
+
+from ddlh.tasks import fetch_and_index, finish_indexing
+
+
+class TestFetchAndIndex:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        self.flask = Flask("test")
+        self.rag_index = MagicMock()
+        self.flask.config["rag_index"] = self.rag_index
+        self.fetch_document = mocker.patch("ddlh.tasks.fetch_document")
+        self.fetch_document.side_effect = lambda document: f"{document.id} text"
+        self.documents = [MagicMock(id="doc1"), MagicMock(id="doc2")]
+
+    def test_it_indexes_the_fetched_batch(self):
+        """
+        It fetches every document in the batch and adds them to the index,
+        in order
+        """
+        with self.flask.app_context():
+            fetch_and_index.apply(args=(self.documents,)).get()
+            self.rag_index.add_documents.assert_called_once_with(
+                ["doc1 text", "doc2 text"], version=None
+            )
+
+    def test_it_returns_only_the_document_ids(self):
+        """
+        It returns the ids of the documents, rather than their text
+        """
+        with self.flask.app_context():
+            result = fetch_and_index.apply(args=(self.documents,)).get()
+            assert result == ["doc1", "doc2"]
+
+    def test_it_indexes_into_the_given_version(self):
+        """
+        When reindexing, it adds the documents to the index version being
+        built
+        """
+        with self.flask.app_context():
+            fetch_and_index.apply(args=(self.documents,), kwargs={"version": 2}).get()
+            assert self.rag_index.add_documents.call_args.kwargs["version"] == 2
+
+
+class TestFinishIndexing:
+
+    def test_it_finishes_indexing_with_every_batch(self):
+        """
+        It finishes indexing with the document ids of every batch
+        """
+        flask = Flask("test")
+        rag_index = MagicMock()
+        flask.config["rag_index"] = rag_index
+        with flask.app_context():
+            finish_indexing.apply(args=([["doc1", "doc2"], ["doc3"]],)).get()
+            rag_index.finish_indexing.assert_called_once_with(
+                ["doc1", "doc2", "doc3"], version=None
+            )
@@ -17,8 +17,10 @@ class TestIndex:
 
     def test_it_indexes_the_documents(self):
         """
-        It passes the documents to the RAG indexer
+        It passes the documents to the RAG indexer, pruning any others
         """
         with self.flask.app_context():
             index.apply(args=(self.documents,)).get()
-            self.rag_index.index_documents.assert_called_with(self.documents)
+            self.rag_index.index_documents.assert_called_with(
+                self.documents, prune=True
+            )
@@ -0,0 +1,49 @@
+from unittest.mock import MagicMock, call
+
+import pytest  # type: ignore
+from flask import Flask
+
+from ddlh.models import DocumentSummary
+from ddlh.tasks import query
+
+
+class TestQuery:
+
+    @pytest.fixture(autouse=True)
+    def setup_mocks(self, mocker):
+        mocker.patch.dict("os.environ", {"REDIS_URL": "redis://"})
+        self.flask = Flask("test")
+        self.rag_index = MagicMock()
+        self.flask.config["rag_index"] = self.rag_index
+        self.socketio = mocker.patch("ddlh.tasks.SocketIO").return_value
+        self.format_document_summary = mocker.patch(
+            "ddlh.tasks.format_document_summary",
+            side_effect=lambda summary: f"<p>{summary.document}</p>",
+        )
+        self.format_search_result = mocker.patch(
+            "ddlh.tasks.format_search_result", return_value="<p>all</p>"
+        )
+        self.summaries = [
+            DocumentSummary(document="doc1", summary="one"),
+            DocumentSummary(document="doc2", summary="two"),
+        ]
+
+        def run_query(query, on_document_summary):
+            for summary in self.summaries:
+                on_document_summary(summary)
+            return MagicMock(summary=MagicMock())
+
+        self.rag_index.query.side_effect = run_query
+
+    def test_it_streams_document_summaries_before_the_result(self):
+        """
+        It emits each document summary as it is ready, then the whole result
+        """
+        with self.flask.app_context():
+            result = query.apply(args=("query",), task_id="task")
+            result.get()
+        assert self.socketio.emit.call_args_list == [
+            call("document_summary", {"msg": "<p>doc1</p>"}, to="task"),
+            call("document_summary", {"msg": "<p>doc2</p>"}, to="task"),
+            call("msg", {"msg": "<p>all</p>"}, to="task"),
+        ]